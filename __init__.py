@@ -8,7 +8,6 @@ __copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com> ' \
                 'based on the Goodreads work by Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import time
 import re
 # from urllib import quote
 from six.moves.urllib.parse import quote
@@ -45,7 +44,7 @@ class Kyobobook(Source):
     name = 'KyoboBook'
     description = _('Downloads metadata and covers from kyobobook.co.kr')
     author = 'YongSeok Choi'
-    version = (1, 0, 2)
+    version = (1, 1, 0)
     minimum_calibre_version = (0, 8, 0)
     
     ID_NAME = 'kyobobook'
@@ -71,6 +70,7 @@ class Kyobobook(Source):
     # http://www.kyobobook.co.kr/product/detailViewEng.laf?barcode=9788936472016
     
     BASE_URL = 'http://www.kyobobook.co.kr'
+    IMAGE_URL = 'http://image.kyobobook.co.kr'
     SEARCH_URL = 'https://search.kyobobook.co.kr/web/search?vPstrKeyWord=%s'  # UTF-8
     SEARCH_ISBN_URL = SEARCH_URL  # UTF-8
     # SEARCH_ISBN_PATH = "/search/SearchCommonMain.jsp?vPstrCategory=TOT&vPplace=top&vPstrKeyWord=%s"
@@ -172,16 +172,158 @@ class Kyobobook(Source):
             isbn = identifiers.get('isbn', None)
             if isbn is not None:
                 book_id = self.cached_isbn_to_identifier(isbn)
+                if book_id is None:
+                    # 교보문고의 책 상품 코드는 ISBN과 같다.
+                    from calibre_plugins.kyobobook.importer import to_barcode
+                    book_id = to_barcode(isbn)
         if book_id is not None:
             url = self.cached_identifier_to_cover_url(book_id)
+            if url is None:
+                url = self._get_stored_cover_url(book_id)
         
         return url
     
+    def _get_stored_cover_url(self, book_id):
+        # Cover urls of books parsed or imported earlier, possibly by another calibre process
+        from calibre_plugins.kyobobook.cache import record_store
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        try:
+            record, fetched = record_store.get(book_id, PARSER_VERSION)
+        except Exception:
+            return None
+        if record is None:
+            return None
+        if not record['cover']:
+            # Imported and reparsed records have cover urls nobody checked yet, see download_cover
+            candidates = record.get('cover_candidates')
+            return candidates[0][0] if candidates else None
+        self.cache_identifier_to_cover_url(book_id, record['cover'])
+        return record['cover']
+    
     def identify(self, log, result_queue, abort, title=None, authors=None, identifiers=None, timeout=30):
         """
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         """
+        from calibre_plugins.kyobobook.deadline import Deadline
+        # Every request of this identify and its workers shares the timeout and the abort
+        return self._identify_until(log, result_queue, abort, title, authors, identifiers, timeout,
+                                    Deadline(timeout, abort))
+    
+    def _identify_until(self, log, result_queue, abort, title, authors, identifiers, timeout, deadline):
+        # identify, stopping once deadline is cancelled. download_cover passes its own deadline
+        from calibre_plugins.kyobobook.timing import PhaseTimer, identify_stats
+        from calibre_plugins.kyobobook.tracing import tracer
+        from calibre_plugins.kyobobook.profiling import profiler
+        from calibre_plugins.kyobobook.cache import configure_caches
+        configure_caches()
+        timer = PhaseTimer()
+        try:
+            with profiler.profile('identify-%s' % ((identifiers or {}).get('isbn') or title)), \
+                    tracer.span('identify', title=title, authors=authors, identifiers=identifiers) as span:
+                error = self._identify(log, result_queue, abort, title, authors, identifiers, timeout, timer, deadline)
+                if error:
+                    span.set(outcome='error: %s' % error)
+                return error
+        finally:
+            timer.stop()
+            log.info(timer.summary())
+            identify_stats.record(timer)
+    
+    def _identify(self, log, result_queue, abort, title, authors, identifiers, timeout, timer, deadline):
+        if identifiers is None:
+            identifiers = {}
+        br = self.browser
+        from calibre_plugins.kyobobook.deadline import Cancelled
+        from calibre_plugins.kyobobook.speculation import Speculation, speculative_search_enabled
+        import calibre_plugins.kyobobook.config as cfg
+        engine = None
+        if cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_ASYNC_ENGINE, False):
+            # Coroutines on one event loop instead of a thread per match, see engine.py
+            from calibre_plugins.kyobobook.engine import async_engine as engine
+        
+        speculation = None
+        if identifiers.get('isbn') and title and authors and speculative_search_enabled():
+            # The search by title and authors, started if the ISBN has to be searched on kyobobook.
+            # It runs in a thread of its own, mechanize browsers can not be shared between threads
+            spec_br = br.clone_browser()
+            speculation = Speculation(lambda d: self._find_matches(log, spec_br, title, authors, None, timeout, timer,
+                                                                   d, engine), deadline)
+        try:
+            matches, query, error = self._find_matches(log, br, title, authors, identifiers, timeout, timer, deadline,
+                                                       engine, speculation)
+        except BaseException:
+            if speculation is not None:
+                speculation.cancel()
+            raise
+        if speculation is not None and (matches or matches is None or error is not None):
+            # Found by ISBN or stopped, the title and authors search is not needed
+            speculation.cancel()
+        if matches is None or error is not None:
+            return error
+        
+        if deadline.cancelled():
+            return
+        
+        if not matches:
+            if speculation is not None and speculation.started:
+                log.info('No matches found with identifiers, using the title and authors search sent alongside')
+                try:
+                    matches, query, error = speculation.result()
+                except Cancelled:
+                    return
+                if matches is None or error is not None:
+                    return error
+            elif identifiers and title and authors:
+                log.info('No matches found with identifiers, retrying using only'
+                         ' title and authors')
+                return self._identify(log, result_queue, abort, title, authors, None, timeout, timer, deadline)
+        if not matches:
+            log.error('No matches found with query: %r' % query)
+            return
+        
+        from calibre_plugins.kyobobook.worker import Worker
+        workers = [Worker(url, result_queue, br, log, i, self, timeout=timeout, timer=timer, deadline=deadline)
+                   for i, url in enumerate(matches)]
+        
+        if engine is not None:
+            with timer('workers'):
+                try:
+                    engine.run(engine.details(workers), deadline)
+                except Cancelled:
+                    pass
+            return None
+        
+        with timer('workers'):
+            # The workers all start at once, ConcurrencyLimiter and RateLimiter pace their requests
+            started = []
+            for w in workers:
+                if deadline.cancelled():
+                    break
+                w.start()
+                started.append(w)
+            
+            # Workers still running once the identify is aborted or out of time stop before their next request
+            while not deadline.cancelled():
+                a_worker_is_alive = False
+                for w in started:
+                    w.join(0.2)
+                    if deadline.cancelled():
+                        break
+                    if w.is_alive():
+                        a_worker_is_alive = True
+                if not a_worker_is_alive:
+                    break
+        
+        return None
+    
+    def _find_matches(self, log, br, title, authors, identifiers, timeout, timer, deadline, engine=None,
+                      speculation=None):
+        """
+        The detail page urls of the books matching identifiers, or title and authors.
+        Returns (matches, query, error), matches is None and error the error of identify if it should stop.
+        speculation is started just before kyobobook is searched.
+        """
         if identifiers is None:
             identifiers = {}
         matches = []
@@ -191,83 +333,176 @@ class Kyobobook(Source):
         # able to go straight to the URL for that book.
         book_id = identifiers.get(self.ID_NAME, None)
         isbn = check_isbn(identifiers.get('isbn', None))
-        br = self.browser
+        # Books we have catalogued before are found in the local index without searching kyobobook
+        from calibre_plugins.kyobobook.metrics import metrics
+        from calibre_plugins.kyobobook.deadline import Cancelled
+        from calibre_plugins.kyobobook.resilience import CircuitOpen
+        with timer('index'):
+            indexed = [] if book_id else self._get_indexed_matches(log, title, authors, isbn)
+        if not book_id:
+            metrics.cache_lookup('index', bool(indexed))
         if book_id:
             matches.append('%s/product/detailViewKor.laf?barcode=%s' % (self.BASE_URL, book_id))
+        elif indexed:
+            matches.extend(indexed)
         else:
             query = self.create_query(log, title=title, authors=authors, identifiers=identifiers)
             if query is None:
                 log.error('Insufficient metadata to construct query')
-                return
-            try:
-                log.info('Querying: %s' % query)
-                response = br.open_novisit(query, timeout=timeout)
-                
+                return None, query, None
+            with timer('search_cache'):
+                cached = self._get_cached_matches(log, br, query, isbn, title, authors, timeout)
+            metrics.cache_lookup('search', cached is not None)
+            if cached is not None:
+                matches.extend(cached)
+            else:
+                # The book pages and the cover probes after the search need connections to these hosts
+                from calibre_plugins.kyobobook.transport import prewarm
+                if speculation is not None:
+                    speculation.start()
+                prewarm([self.BASE_URL, self.IMAGE_URL], timeout, br)
                 try:
-                    raw = response.read().strip()
-                    # open('E:\\t11.html', 'wb').write(raw) # XXXX
-                    
-                    # # by sseeookk
-                    # # euc-kr at kyobobook
-                    raw = raw.decode('utf-8', errors='replace')
-                    # # raw = raw.decode('euc-kr', errors='replace')
-                    # raw = raw.decode('euc-kr', errors='ignore')
-                    
-                    if not raw:
-                        log.error('Failed to get raw result for query: %r' % query)
-                        return
-                    root = fromstring(clean_ascii_chars(raw))
+                    log.info('Querying: %s' % query)
+                    if engine is not None:
+                        found = engine.run(engine.search(self, log, br, query, isbn, title, authors, timeout, timer,
+                                                         deadline), deadline)
+                    else:
+                        found = self._search(log, br, query, isbn, title, authors, timeout, timer, deadline)
+                except CircuitOpen as e:
+                    log.error('Skipped searching, %s: %s' % (e, query))
+                    return None, query, 'Skipped: %s' % e
+                except Cancelled as e:
+                    log.info('Stopped before searching (%s): %s' % (e, query))
+                    return None, query, None
                 except Exception as e:
-                    msg = 'Failed to parse kyobobook page for query: %r' % query
-                    log.exception(msg, exc_info=e)
-                    return msg
-                
-                if isbn:
-                    self._parse_search_isbn_results(log, isbn, root, matches, timeout)
-                
-                # For ISBN based searches we have already done everything we need to
-                # So anything from this point below is for title/author based searches.
-                if not isbn:
-                    # Now grab the first value from the search results, provided the
-                    # title and authors appear to be for the same book
-                    self._parse_search_results(log, title, authors, root, matches, timeout)
-            
-            except Exception as e:
-                err = 'Failed to make identify query: %r' % query
-                log.exception(err)
-                return as_unicode(e)
+                    err = 'Failed to make identify query: %r' % query
+                    log.exception(err)
+                    return None, query, as_unicode(e)
+                if found is None:
+                    return None, query, 'Failed to parse kyobobook page for query: %r' % query
+                matches.extend(found)
+        return matches, query, None
+    
+    def _get_indexed_matches(self, log, title, authors, isbn=None):
+        """
+        Return the detail page urls of catalogued books that have isbn, or if there is no
+        isbn that confidently match title and authors.
+        """
+        from calibre_plugins.kyobobook.index import catalog_index
+        from calibre_plugins.kyobobook.importer import to_barcode
+        import calibre_plugins.kyobobook.config as cfg
         
-        if abort.is_set():
-            return
+        max_results = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_MAX_DOWNLOADS]
+        try:
+            if isbn:
+                barcode = to_barcode(isbn)
+                barcodes = [barcode] if barcode and catalog_index.has(barcode) else []
+            elif title:
+                barcodes = catalog_index.find(title, authors, limit=max_results)
+            else:
+                barcodes = []
+        except Exception as e:
+            log.exception('Failed to search the local catalog index', exc_info=e)
+            return []
+        if barcodes:
+            log.info('Found %d matches in the local catalog index for: %s :: %s :: %s'
+                     % (len(barcodes), isbn, title, authors))
+        return ['%s/product/detailViewKor.laf?barcode=%s' % (self.BASE_URL, b) for b in barcodes]
+    
+    def _search(self, log, br, query, isbn, title, authors, timeout, timer=None, deadline=None):
+        """
+        Fire the search query and return the urls of the matching detail pages.
+        Returns None if the search page could not be parsed.
+        """
+        from calibre_plugins.kyobobook.transport import open_url
+        from calibre_plugins.kyobobook.timing import PhaseTimer
+        if timer is None:
+            timer = PhaseTimer('search')
         
-        if not matches:
-            if identifiers and title and authors:
-                log.info('No matches found with identifiers, retrying using only'
-                         ' title and authors')
-                return self.identify(log, result_queue, abort, title=title, authors=authors, timeout=timeout)
-            log.error('No matches found with query: %r' % query)
-            return
+        with timer('search_fetch') as span:
+            span.set(url=query)
+            response = open_url(br, query, timeout, deadline, hedge=True)
+        try:
+            with timer('search_read') as span:
+                raw = response.read().strip()
+                span.set(bytes=len(raw))
+        except Exception as e:
+            msg = 'Failed to parse kyobobook page for query: %r' % query
+            log.exception(msg, exc_info=e)
+            return None
+        return self.parse_search_page(log, query, raw, isbn, title, authors, timeout, timer)
+    
+    def parse_search_page(self, log, query, raw, isbn, title, authors, timeout, timer):
+        """
+        Archive and parse a downloaded search page, see _search.
+        """
+        from calibre_plugins.kyobobook.cache import metadata_cache, LAYER_SEARCH
+        from calibre_plugins.kyobobook.archive import archive_page, KIND_SEARCH
         
-        from calibre_plugins.kyobobook.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in enumerate(matches)]
+        matches = []
+        try:
+            with timer('archive'):
+                archive_page(log, query, KIND_SEARCH, raw)
+            # open('E:\\t11.html', 'wb').write(raw) # XXXX
+            
+            # # by sseeookk
+            # # euc-kr at kyobobook
+            with timer('search_decode'):
+                raw = raw.decode('utf-8', errors='replace')
+            # # raw = raw.decode('euc-kr', errors='replace')
+            # raw = raw.decode('euc-kr', errors='ignore')
+            
+            if not raw:
+                log.error('Failed to get raw result for query: %r' % query)
+                return matches
+            with timer('search_clean'):
+                raw = clean_ascii_chars(raw)
+            with timer('search_fromstring'):
+                root = fromstring(raw)
+        except Exception as e:
+            msg = 'Failed to parse kyobobook page for query: %r' % query
+            log.exception(msg, exc_info=e)
+            return None
         
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
+        with timer('search_parse') as span:
+            if isbn:
+                self._parse_search_isbn_results(log, isbn, root, matches, timeout)
+            
+            # For ISBN based searches we have already done everything we need to
+            # So anything from this point below is for title/author based searches.
+            if not isbn:
+                # Now grab the first value from the search results, provided the
+                # title and authors appear to be for the same book
+                self._parse_search_results(log, title, authors, root, matches, timeout)
+            span.set(matches=len(matches))
         
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+        if matches:
+            metadata_cache.put(LAYER_SEARCH, query, list(matches))
+        return matches
+    
+    def _get_cached_matches(self, log, br, query, isbn, title, authors, timeout):
+        """
+        Return the cached detail page urls for query, or None if they have to be fetched.
+        Expired results are only used when stale-while-revalidate is enabled, and are
+        refreshed in the background.
+        """
+        from calibre_plugins.kyobobook.cache import metadata_cache, revalidator, LAYER_SEARCH
+        import calibre_plugins.kyobobook.config as cfg
         
-        return None
+        cached, stale = metadata_cache.get(LAYER_SEARCH, query)
+        if cached is None:
+            return None
+        if stale:
+            if not cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_STALE_WHILE_REVALIDATE, False):
+                return None
+            from calibre.utils.logging import default_log
+            br = br.clone_browser()
+            revalidator.submit((LAYER_SEARCH, query),
+                               lambda: self._search(default_log, br, query, isbn, title, authors, timeout))
+            log.info('Using expired cached results for query, refreshing in background: %s' % query)
+        else:
+            log.info('Using cached results for query: %s' % query)
+        return list(cached)
     
     def _parse_search_isbn_results(self, log, orig_isbn, root, matches, timeout):
         results = root.xpath('//div[@class="list_search_result"]//div[@class="title"]/ancestor::tr')
@@ -398,14 +633,18 @@ class Kyobobook(Source):
                 break
     
     def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers=None, timeout=30):
+        from calibre_plugins.kyobobook.deadline import Deadline
         if identifiers is None:
             identifiers = {}
+        # The identify below and the cover download share the timeout
+        deadline = Deadline(timeout, abort)
         cached_url = self.get_cached_cover_url(identifiers)
         if cached_url is None:
             log.info('No cached cover found, running identify')
             rq = Queue()
-            self.identify(log, rq, abort, title=title, authors=authors, identifiers=identifiers)
+            self._identify_until(log, rq, abort, title, authors, identifiers, timeout, deadline)
             if abort.is_set():
+                log.info('Aborted, not looking for a cover')
                 return
             results = []
             while True:
@@ -422,12 +661,24 @@ class Kyobobook(Source):
             log.info('No cover found')
             return
         
-        if abort.is_set():
+        if deadline.cancelled():
+            if abort.is_set():
+                log.info('Aborted, not downloading the cover from:', cached_url)
+            else:
+                log.warning('No time left of %s seconds, not downloading the cover from:' % timeout, cached_url)
             return
+        from calibre_plugins.kyobobook.transport import open_url
+        from calibre_plugins.kyobobook.tracing import tracer
         br = self.browser
         log('Downloading cover from:', cached_url)
         try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+            with tracer.span('download_cover', url=cached_url) as span:
+                cdata = open_url(br, cached_url, timeout, deadline).read()
+                span.set(bytes=len(cdata))
+            # The cover url of an imported record was never checked, see Worker.cover_ok
+            if len(cdata) <= 1000:
+                log.warning('Broken cover image from:', cached_url)
+                return
             result_queue.put((self, cdata))
         except Exception as e:
             log.exception('Failed to download cover from:', cached_url, exe_info=e)
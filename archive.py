@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import zlib
+import hashlib
+import sqlite3
+from queue import Queue, Full
+from threading import Lock, Thread
+
+from calibre.utils.config import config_dir
+
+"""
+When archiving is turned on in the preferences, every search and details page downloaded
+from kyobobook is kept here, zlib compressed and stored once per distinct content (sha1 of
+the raw bytes). Pages are compressed and written by a background thread, not by identify.
+When the kyobobook markup changes and the parse_* methods are fixed, the records can be
+rebuilt from the archive without downloading anything:
+
+    calibre-debug -e archive.py -- reparse [processes]
+"""
+
+KIND_SEARCH = 'search'
+KIND_DETAIL = 'detail'
+
+# Pages stored between two checks of the size of the archive
+PRUNE_EVERY = 256
+
+# Pages waiting for the background writer, more are not archived
+MAX_PENDING = 256
+
+
+class PageArchive(object):
+    """
+    Content addressed store of raw kyobobook pages in an SQLite database.
+    When max_pages is set, the pages fetched longest ago are dropped beyond it.
+    """
+    
+    def __init__(self, path, max_pages=None):
+        self.path = path
+        self.max_pages = max_pages
+        self._lock = Lock()
+        self._conn = None
+        self._stores = 0
+        self._pending = Queue(maxsize=MAX_PENDING)
+        self._writer = None
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         'url TEXT NOT NULL, kind TEXT NOT NULL, fetched REAL NOT NULL, digest TEXT NOT NULL, '
+                         'PRIMARY KEY (url, digest))')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def store(self, url, kind, raw, fetched=None):
+        return self.store_many([(url, kind, raw, fetched)])[0]
+    
+    def store_many(self, pages):
+        """
+        Store (url, kind, raw, fetched) pages in one transaction, returns their digests.
+        """
+        rows = [(url, kind, raw, fetched or time.time(), hashlib.sha1(raw).hexdigest())
+                for url, kind, raw, fetched in pages]
+        blobs = [(digest, zlib.compress(raw, 9)) for url, kind, raw, fetched, digest in rows]
+        with self._lock:
+            conn = self.conn
+            conn.executemany('INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)', blobs)
+            conn.executemany('INSERT OR REPLACE INTO pages (url, kind, fetched, digest) VALUES (?, ?, ?, ?)',
+                             [(url, kind, fetched, digest) for url, kind, raw, fetched, digest in rows])
+            conn.commit()
+            before, self._stores = self._stores, self._stores + len(rows)
+            if self.max_pages and before // PRUNE_EVERY != self._stores // PRUNE_EVERY:
+                self._prune(self.max_pages)
+        return [digest for url, kind, raw, fetched, digest in rows]
+    
+    def store_later(self, url, kind, raw):
+        """
+        Queue a page for the background writer. Returns False if too many pages are waiting already.
+        """
+        with self._lock:
+            if self._writer is None:
+                self._writer = Thread(target=self._write, name='KyoboBook archive')
+                self._writer.daemon = True
+                self._writer.start()
+        try:
+            self._pending.put_nowait((url, kind, raw, time.time()))
+        except Full:
+            return False
+        return True
+    
+    def _write(self):
+        from calibre.utils.logging import default_log
+        while True:
+            pages = [self._pending.get()]
+            # Everything that arrived meanwhile goes in the same transaction
+            while not self._pending.empty() and len(pages) < MAX_PENDING:
+                pages.append(self._pending.get_nowait())
+            try:
+                self.store_many(pages)
+            except Exception as e:
+                default_log.exception('Failed to archive %d pages' % len(pages), exc_info=e)
+            finally:
+                for _ in pages:
+                    self._pending.task_done()
+    
+    def flush(self):
+        """
+        Wait until the pages queued by store_later are written.
+        """
+        self._pending.join()
+    
+    def iter_pages(self, kind=None):
+        """
+        Yield (url, kind, fetched, compressed data) for the latest copy of every archived page.
+        """
+        sql = ('SELECT p.url, p.kind, MAX(p.fetched), b.data FROM pages p JOIN blobs b ON b.digest = p.digest '
+               '%s GROUP BY p.url' % ('WHERE p.kind = ?' if kind else ''))
+        self.conn  # make sure the database exists
+        # A connection of its own, so that the archive can be streamed while pages are being stored
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            for row in conn.execute(sql, (kind,) if kind else ()):
+                yield row
+        finally:
+            conn.close()
+    
+    def count(self, kind=None):
+        with self._lock:
+            if kind:
+                return self.conn.execute('SELECT COUNT(DISTINCT url) FROM pages WHERE kind=?', (kind,)).fetchone()[0]
+            return self.conn.execute('SELECT COUNT(DISTINCT url) FROM pages').fetchone()[0]
+    
+    def prune(self, max_pages=None):
+        """
+        Drop every copy of the pages fetched longest ago until at most max_pages urls are left,
+        and the contents no page refers to any more. Returns the number of urls dropped.
+        """
+        with self._lock:
+            return self._prune(max_pages or self.max_pages)
+    
+    def _prune(self, max_pages):
+        if not max_pages:
+            return 0
+        conn = self.conn
+        excess = conn.execute('SELECT COUNT(DISTINCT url) FROM pages').fetchone()[0] - max_pages
+        if excess <= 0:
+            return 0
+        conn.execute('DELETE FROM pages WHERE url IN '
+                     '(SELECT url FROM pages GROUP BY url ORDER BY MAX(fetched) LIMIT ?)', (excess,))
+        conn.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM pages)')
+        conn.commit()
+        return excess
+    
+    def clear(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute('DELETE FROM pages')
+            conn.execute('DELETE FROM blobs')
+            conn.commit()
+            # Give the space back, the archive is usually the largest of the plugin's files
+            conn.execute('VACUUM')
+
+
+def archive_page(log, url, kind, raw):
+    """
+    Queue a downloaded page for the archive if the user has turned archiving on.
+    """
+    import calibre_plugins.kyobobook.config as cfg
+    if not cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_ARCHIVE_PAGES, False):
+        return
+    if not page_archive.store_later(url, kind, raw):
+        # The writer is behind, losing a page of the archive is better than waiting for it
+        log.warning('Too many pages waiting to be archived, not archived: %r' % url)
+
+
+def reparse(log, processes=1, archive=None, store=None, index=None):
+    """
+    Run the current parser over every archived details page and replace the stored records.
+    Returns (pages parsed, records written).
+    """
+    from calibre_plugins.kyobobook.parsing import ParsePool
+    from calibre_plugins.kyobobook.cache import record_store
+    from calibre_plugins.kyobobook.worker import PARSER_VERSION
+    from calibre_plugins.kyobobook.index import catalog_index
+    archive = archive or page_archive
+    store = store or record_store
+    index = index or catalog_index
+    
+    pool = ParsePool(log, processes)
+    start = time.time()
+    parsed = written = 0
+    batch, fetched_map = [], {}
+    
+    def flush():
+        records = []
+        for url, record, candidates in pool.map(batch):
+            if record is None:
+                log.error('Could not reparse archived page: %r' % url)
+                continue
+            records.append((record, candidates, fetched_map[url]))
+        # The covers can not be checked offline. The cover checked when the page was downloaded is kept,
+        # without one the candidates are checked when the record is first used, see Worker.get_stored_record
+        covers = store.covers(record['id'] for record, candidates, fetched in records)
+        for record, candidates, fetched in records:
+            record['cover'] = covers.get(record['id'])
+            if record['cover'] is None and candidates:
+                record['cover_candidates'] = [list(c) for c in candidates]
+        store.put_many(PARSER_VERSION, [r[0] for r in records], fetched=[r[2] for r in records])
+        index.add_many((record['id'], record['title'], [a[0] for a in record['authors']],
+                        record.get('publisher'), record.get('series')) for record, candidates, fetched in records)
+        del batch[:]
+        fetched_map.clear()
+        return len(records)
+    
+    try:
+        # Pages are handed out in batches so that memory use does not grow with the archive
+        for url, kind, fetched, data in archive.iter_pages(KIND_DETAIL):
+            batch.append((url, zlib.decompress(data)))
+            fetched_map[url] = fetched
+            parsed += 1
+            if len(batch) >= 1000:
+                written += flush()
+        written += flush()
+    finally:
+        pool.shutdown()
+    
+    log.info('Reparsed %d archived pages into %d records in %.1f seconds' % (parsed, written, time.time() - start))
+    return parsed, written
+
+
+page_archive = PageArchive(os.path.join(config_dir, 'plugins', 'KyoboBook', 'pages.sqlite'))
+
+
+if __name__ == '__main__':
+    # calibre-debug -e archive.py -- reparse [processes]
+    import sys
+    from calibre.utils.logging import default_log
+    args = sys.argv[1:]
+    if not args or args[0] != 'reparse':
+        print('Usage: calibre-debug -e archive.py -- reparse [processes]')
+        raise SystemExit(1)
+    reparse(default_log, processes=int(args[1]) if len(args) > 1 else 1)
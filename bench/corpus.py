@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import json
+import zlib
+import struct
+from html import escape
+
+"""
+Offline copy of kyobobook pages for benchmarks.
+
+corpus/manifest.json lists the books of the corpus. For every book there is a details
+page in corpus/detail/<barcode>.html (EUC-KR, detailViewKor or detailViewEng layout) and
+a cover in corpus/covers/<barcode>.*. Search pages (UTF-8) recorded for a keyword are
+listed under "searches", any other search is answered from the manifest.
+
+    python bench/corpus.py seed          write the pages of the manifest books again
+    python bench/corpus.py synth 1000    add 1000 generated books in corpus/synth (not in git)
+    calibre-debug -e bench/corpus.py -- record 9788936470111 ...
+                                         download real pages into the corpus
+"""
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+DETAIL_URL = 'http://www.kyobobook.co.kr/product/detailView%s.laf?ejkGb=%s&mallGb=%s&barcode=%s&orderClick=LAG&Kc='
+IMAGE_URL = 'http://image.kyobobook.co.kr/images/book/%s/%s/%s%s.jpg'
+
+# Layout of the pages of the plugin's markup fixes (2021-07), only what the parsers look at is
+# reproduced faithfully, the rest is filler so that the pages have a realistic size.
+NAV_FILLER = ''.join(
+    '<li class="gnb_item"><a href="/category/%03d">%s %d</a>'
+    '<ul class="sub">%s</ul></li>\n' % (
+        i, '카테고리', i, ''.join('<li><a href="/category/%03d/%02d">분야 %d-%d</a></li>' % (i, j, i, j)
+                                 for j in range(12)))
+    for i in range(40))
+SCRIPT_FILLER = '<script type="text/javascript">\n%s</script>\n' % ''.join(
+    'var _kyobo_%d = {"id": %d, "track": "detail", "pos": [%s]};\n' % (i, i, ','.join(str(j) for j in range(20)))
+    for i in range(120))
+
+DETAIL_TEMPLATE = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" lang="ko">
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=euc-kr" />
+<title>%(title)s - 인터넷교보문고</title>
+<meta property="og:title" content="%(title)s" />
+<meta property="og:image" content="%(og_image)s" />
+%(scripts)s
+</head>
+<body>
+<div id="header"><ul class="gnb">
+%(nav)s
+</ul></div>
+<div id="container">
+<div class="location_zone pathGroup">
+%(locations)s
+</div>
+<div class="box_detail_point">
+<h1 class="title">
+%(title)s
+<script type="text/javascript">titleTracking('%(barcode)s');</script>
+</h1>
+<div class="info">
+%(info)s
+</div>
+<div class="author">
+%(authors)s
+<span title="출판사" class="name"><a href="/search/SearchCommonMain.jsp?vPstrCategory=KOR&amp;vPpubCD=04129&amp;vPsKeywordInfo=%(publisher)s">%(publisher)s</a></span>
+<span class="line">|</span>
+<span class="date" title="출간일">%(pubdate)s 출간</span>
+</div>
+<div class="review">%(rating)s</div>
+</div>
+<div class="cover"><a href="#"><img src="%(cover_image)s" alt="%(title)s" /></a></div>
+<div class="book_info_basic2">
+<span title="ISBN-13">%(barcode)s</span>
+%(language)s
+</div>
+<div class="box_detail_content">
+<h2 class="title_detail_basic">책소개</h2>
+<!-- *** s:책소개 *** -->
+<div class="box_detail_article">%(description)s</div>
+<!-- *** //e:책소개 *** -->
+</div>
+<div class="box_detail_content">
+<h2 class="title_detail_basic">목차</h2>
+<div class="box_detail_article">%(toc)s</div>
+</div>
+</div>
+<div id="footer"><p>(주)교보문고 | 서울시 종로구 종로 1</p></div>
+</body>
+</html>
+'''
+
+SEARCH_TEMPLATE = '''<!DOCTYPE html>
+<html lang="ko">
+<head>
+<meta charset="UTF-8" />
+<title>%(keyword)s - 통합검색 - 인터넷교보문고</title>
+%(scripts)s
+</head>
+<body>
+<div id="header"><ul class="gnb">
+%(nav)s
+</ul></div>
+<div class="list_search_result">
+<table class="type_list">
+<tbody>
+%(rows)s
+</tbody>
+</table>
+</div>
+</body>
+</html>
+'''
+
+SEARCH_ROW_TEMPLATE = '''<tr>
+<td class="image"><div class="cover"><a href="%(url)s"><img src="%(image)s" alt="" /></a></div></td>
+<td class="detail">
+<div class="title"><a href="%(url)s"><strong>%(title)s</strong></a></div>
+<div class="author">%(authors)s <span class="line">|</span> %(publisher)s</div>
+</td>
+</tr>
+'''
+
+NOT_FOUND_PAGE = '''<html><head><meta http-equiv="Content-Type" content="text/html; charset=euc-kr" />
+<title> - 인터넷교보문고</title></head><body><div id="errorMessage">상품 정보가 없습니다.</div></body></html>
+'''
+
+
+def detail_url(book):
+    if book.get('layout') == 'Eng':
+        return DETAIL_URL % ('Eng', 'BNT', 'ENG', book['barcode'])
+    return DETAIL_URL % ('Kor', 'KOR', 'KOR', book['barcode'])
+
+
+def image_url(barcode, size='xlarge'):
+    return IMAGE_URL % (size, barcode[-3:], size[0], barcode)
+
+
+def detail_page(book):
+    """
+    Details page for a manifest book, EUC-KR encoded like kyobobook's.
+    """
+    barcode = book['barcode']
+    spliter = ' / ' if book.get('layout') == 'Eng' else ', '
+    authors = []
+    # Contributors with the same role share one name span, the role follows it
+    for role in _roles(book['authors']):
+        names = [escape(a) for a, r in book['authors'] if r == role]
+        authors.append('<span class="name"><a href="#">%s</a></span> %s <span class="line">|</span>'
+                       % (spliter.join(names), escape(role)))
+    info = ''
+    if book.get('series'):
+        info = '%s %s\n<span class="line">|</span>\n' % (escape(book['series']), book.get('series_index') or 1)
+    info += book.get('edition') or '양장'
+    pubdate = book.get('pubdate') or '2014-03-20'
+    y, m, d = pubdate.split('-')
+    rating = ''
+    if book.get('rating'):
+        rating = '<a href="#review"><img src="/images/star%d.gif" alt="5점 만점에 %d점" /></a>' % (
+            book['rating'], book['rating'])
+    language = ''
+    if book.get('language'):
+        language = '<p>언어 : %s</p>' % escape(book['language'])
+    description = book.get('description') or _description(book)
+    toc = ''.join('<p>%d장 %s %d</p>' % (i, escape(book['title']), i) for i in range(1, 15))
+    html = DETAIL_TEMPLATE % dict(
+        title=escape(book['title']), barcode=barcode, info=info, authors='\n'.join(authors),
+        publisher=escape(book.get('publisher') or ''), pubdate='%s년 %s월 %s일' % (y, m, d), rating=rating,
+        og_image=image_url(barcode) if book.get('cover', True) else
+        'http://image.kyobobook.co.kr/newimages/apps/b2b_academy/common/noimage_150_215.gif',
+        cover_image=image_url(barcode, 'large'), language=language, description=description, toc=toc,
+        locations='\n'.join('<p class="location">%s</p>' % escape(c) for c in book.get('categories') or []),
+        nav=NAV_FILLER, scripts=SCRIPT_FILLER)
+    return html.encode('euc-kr', 'xmlcharrefreplace')
+
+
+def search_page(keyword, books):
+    rows = []
+    for book in books:
+        rows.append(SEARCH_ROW_TEMPLATE % dict(
+            url=escape(detail_url(book)), image=image_url(book['barcode'], 'medium'), title=escape(book['title']),
+            authors=', '.join('<a href="#">%s</a>' % escape(a) for a, r in book['authors']),
+            publisher=escape(book.get('publisher') or '')))
+    html = SEARCH_TEMPLATE % dict(keyword=escape(keyword), rows=''.join(rows), nav=NAV_FILLER, scripts='')
+    return html.encode('utf-8')
+
+
+def not_found_page():
+    return NOT_FOUND_PAGE.encode('euc-kr')
+
+
+def cover_image(barcode, width=120, height=174):
+    """
+    A generated PNG cover, different for every barcode.
+    """
+    seed = int(barcode[-6:])
+    rows = []
+    for y in range(height):
+        row = bytearray(b'\0')
+        for x in range(width):
+            row += bytes(((seed + y // 8) & 0xff, (x * y // 64) & 0xff, (seed >> 8) & 0xff))
+        rows.append(bytes(row))
+    
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(b''.join(rows), 9)) + chunk(b'IEND', b''))
+
+
+def _roles(authors):
+    roles = []
+    for a, r in authors:
+        if r not in roles:
+            roles.append(r)
+    return roles
+
+
+def _description(book):
+    sentences = ['<p>%s은(는) %s의 대표작으로, 오랫동안 독자들의 사랑을 받아 온 책이다.</p>' % (
+        escape(book['title']), escape(book['authors'][0][0]))]
+    sentences += ['<p>%d. 이 책은 %s에 대한 이야기를 담고 있으며, 개정판에서는 새로운 내용을 더했다.</p>' % (
+        i, escape(book['title'])) for i in range(1, 12)]
+    return '\n'.join(sentences)
+
+
+def normalize_keyword(keyword):
+    return ' '.join(keyword.replace('+', ' ').lower().split())
+
+
+class Corpus(object):
+    """
+    The books and pages of a corpus directory, and of its synth sub directory if there is one.
+    """
+    
+    def __init__(self, corpus_dir=CORPUS_DIR):
+        self.corpus_dir = corpus_dir
+        self.books = []
+        self.searches = {}
+        for d in (corpus_dir, os.path.join(corpus_dir, 'synth')):
+            path = os.path.join(d, 'manifest.json')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    manifest = json.loads(f.read().decode('utf-8'))
+                for book in manifest.get('books', []):
+                    book['dir'] = d
+                    self.books.append(book)
+                for keyword, name in manifest.get('searches', {}).items():
+                    self.searches[normalize_keyword(keyword)] = os.path.join(d, name)
+        self.by_barcode = dict((b['barcode'], b) for b in self.books)
+    
+    def detail(self, barcode):
+        book = self.by_barcode.get(barcode)
+        if book is None:
+            return None
+        with open(os.path.join(book['dir'], 'detail', barcode + '.html'), 'rb') as f:
+            return f.read()
+    
+    def cover(self, barcode):
+        """
+        Return (data, content type) of the cover of barcode, or (None, None).
+        """
+        book = self.by_barcode.get(barcode)
+        if book is None or not book.get('cover', True):
+            return None, None
+        for ext, ctype in (('.jpg', 'image/jpeg'), ('.png', 'image/png'), ('.gif', 'image/gif')):
+            path = os.path.join(book['dir'], 'covers', barcode + ext)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read(), ctype
+        return None, None
+    
+    def search(self, keyword):
+        """
+        Return the recorded search page for keyword, otherwise a page listing the corpus
+        books that have keyword as barcode or every word of keyword in their title and authors.
+        """
+        keyword = normalize_keyword(keyword)
+        path = self.searches.get(keyword)
+        if path is not None:
+            with open(path, 'rb') as f:
+                return f.read()
+        words = keyword.split()
+        found = []
+        for book in self.books:
+            if book['barcode'] == keyword:
+                found.append(book)
+                continue
+            text = (book['title'] + ' ' + ' '.join(a for a, r in book['authors'])).lower()
+            if words and all(w in text for w in words):
+                found.append(book)
+        return search_page(keyword, found[:20])
+
+
+def write_book(d, book):
+    for sub in ('detail', 'covers'):
+        if not os.path.exists(os.path.join(d, sub)):
+            os.makedirs(os.path.join(d, sub))
+    with open(os.path.join(d, 'detail', book['barcode'] + '.html'), 'wb') as f:
+        f.write(detail_page(book))
+    if book.get('cover', True):
+        with open(os.path.join(d, 'covers', book['barcode'] + '.png'), 'wb') as f:
+            f.write(cover_image(book['barcode']))
+
+
+def seed(corpus_dir=CORPUS_DIR):
+    """
+    Write the details pages, covers and recorded searches of the manifest books.
+    """
+    with open(os.path.join(corpus_dir, 'manifest.json'), 'rb') as f:
+        manifest = json.loads(f.read().decode('utf-8'))
+    books = dict((b['barcode'], b) for b in manifest['books'])
+    for book in manifest['books']:
+        if not book.get('recorded'):
+            write_book(corpus_dir, book)
+    for keyword, name in manifest.get('searches', {}).items():
+        barcodes = manifest.get('search_results', {}).get(keyword, [])
+        if not os.path.exists(os.path.join(corpus_dir, 'search')):
+            os.makedirs(os.path.join(corpus_dir, 'search'))
+        with open(os.path.join(corpus_dir, name), 'wb') as f:
+            f.write(search_page(keyword, [books[b] for b in barcodes]))
+
+
+def synth(count, corpus_dir=CORPUS_DIR):
+    """
+    Generate count books from the manifest books, with their own barcodes, in corpus/synth.
+    """
+    with open(os.path.join(corpus_dir, 'manifest.json'), 'rb') as f:
+        templates = [b for b in json.loads(f.read().decode('utf-8'))['books'] if not b.get('recorded')]
+    d = os.path.join(corpus_dir, 'synth')
+    books = []
+    for i in range(count):
+        book = dict(templates[i % len(templates)])
+        prefix = '979119%06d' % i
+        book['barcode'] = prefix + str(-sum(int(c) * (3 if j % 2 else 1) for j, c in enumerate(prefix)) % 10)
+        book['title'] = '%s %d' % (book['title'], i + 1)
+        book['authors'] = [[a if n else '%s%d' % (a, i % 97), r] for n, (a, r) in enumerate(book['authors'])]
+        book['cover'] = i % 10 != 9  # some books have no cover, like on kyobobook
+        books.append(book)
+        write_book(d, book)
+    with open(os.path.join(d, 'manifest.json'), 'wb') as f:
+        f.write(json.dumps({'books': books}, ensure_ascii=False, indent=1).encode('utf-8'))
+    return books
+
+
+def record(barcodes, corpus_dir=CORPUS_DIR):
+    """
+    Download the real search, details and cover pages of barcodes into the corpus.
+    Needs calibre and network access.
+    """
+    from calibre import browser
+    from calibre.utils.logging import default_log
+    from calibre_plugins.kyobobook import Kyobobook
+    from calibre_plugins.kyobobook.worker import Worker
+    
+    br = browser()
+    path = os.path.join(corpus_dir, 'manifest.json')
+    with open(path, 'rb') as f:
+        manifest = json.loads(f.read().decode('utf-8'))
+    for barcode in barcodes:
+        search = br.open_novisit(Kyobobook.SEARCH_ISBN_URL % barcode, timeout=30).read()
+        links = re.findall(r'href="([^"]*detailView(Kor|Eng)\.laf[^"]*barcode=%s[^"]*)"' % barcode,
+                           search.decode('utf-8', 'replace'))
+        if not links:
+            default_log.error('Not found on kyobobook: %s' % barcode)
+            continue
+        url, layout = links[0][0].replace('&amp;', '&'), links[0][1]
+        raw = br.open_novisit(url, timeout=30).read()
+        w = Worker(url, None, None, default_log, 0, None)
+        root = w.parse_page(raw)
+        record = w.parse_record(root) if root is not None else None
+        if record is None:
+            default_log.error('Could not parse the details page of: %s' % barcode)
+            continue
+        for sub in ('search', 'detail', 'covers'):
+            if not os.path.exists(os.path.join(corpus_dir, sub)):
+                os.makedirs(os.path.join(corpus_dir, sub))
+        with open(os.path.join(corpus_dir, 'search', barcode + '.html'), 'wb') as f:
+            f.write(search)
+        with open(os.path.join(corpus_dir, 'detail', barcode + '.html'), 'wb') as f:
+            f.write(raw)
+        if record['cover']:
+            with open(os.path.join(corpus_dir, 'covers', barcode + '.jpg'), 'wb') as f:
+                f.write(br.open_novisit(record['cover'], timeout=30).read())
+        manifest['books'] = [b for b in manifest['books'] if b['barcode'] != barcode]
+        manifest['books'].append({
+            'barcode': barcode, 'title': record['title'], 'authors': record['authors'], 'layout': layout,
+            'publisher': record['publisher'], 'pubdate': record['pubdate'], 'cover': bool(record['cover']),
+            'recorded': True})
+        manifest.setdefault('searches', {})[barcode] = 'search/%s.html' % barcode
+        default_log.info('Recorded %s: %s' % (barcode, record['title']))
+    with open(path, 'wb') as f:
+        f.write(json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    if args == ['seed']:
+        seed()
+    elif len(args) == 2 and args[0] == 'synth':
+        print('Generated %d books' % len(synth(int(args[1]))))
+    elif len(args) > 1 and args[0] == 'record':
+        record(args[1:])
+    else:
+        print('Usage: python bench/corpus.py seed | synth <count>')
+        print('       calibre-debug -e bench/corpus.py -- record <isbn> ...')
+        raise SystemExit(1)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from queue import Queue
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from corpus import Corpus, CORPUS_DIR  # noqa: E402
+from parsers import QuietLog  # noqa: E402
+from standin import StandinServer  # noqa: E402
+
+"""
+Runs identify() and download_cover() calls concurrently against the stand-in server:
+
+    calibre-debug -e bench/loadtest.py -- --concurrency 8 --requests 200 --latency 0.2 --jitter 0.1
+
+Reports latency percentiles, throughput, the peak thread count and RSS, and the requests
+per kyobobook host. For identify it also splits the time of the calls with several matches:
+until the first and the last result, and from the last result until identify returned, which
+is where the waits for the per host connection limit and the polling of the workers show up.
+
+Unless --warm is given, the plugin's caches, record store and index are emptied before every
+round over the corpus books, so every call goes to the server. Generate more books with
+"python bench/corpus.py synth 1000" to get long rounds.
+"""
+
+
+class TimedQueue(Queue):
+    # Result queue that remembers when each result arrived
+    
+    def __init__(self):
+        Queue.__init__(self)
+        self.times = []
+    
+    def put(self, item, *args, **kwargs):
+        self.times.append(time.perf_counter())
+        Queue.put(self, item, *args, **kwargs)
+
+
+class Sampler(threading.Thread):
+    # Peak thread count and resident memory during the run
+    
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self, name='loadtest-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+    
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError, AttributeError):
+            return 0
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, self.rss())
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        try:
+            import resource
+            # ru_maxrss is in KiB on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_rss = max(self.peak_rss, maxrss if sys.platform == 'darwin' else maxrss * 1024)
+        except ImportError:
+            pass
+
+
+def isolate(tdir):
+    """
+    Point the plugin's stores at empty files in tdir and forget the cached pages.
+    """
+    from calibre_plugins.kyobobook.cache import metadata_cache, record_store
+    from calibre_plugins.kyobobook.index import catalog_index
+    from calibre_plugins.kyobobook.archive import page_archive
+    metadata_cache.clear()
+    for store, name in ((record_store, 'cache.sqlite'), (catalog_index, 'index.sqlite'),
+                        (page_archive, 'pages.sqlite')):
+        store._conn = None
+        store.path = os.path.join(tdir, name)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def call(plugin, kind, book, timeout):
+    """
+    Run one identify or download_cover call and return what was measured.
+    """
+    log = QuietLog()
+    abort = threading.Event()
+    rq = TimedQueue()
+    authors = [a for a, r in book['authors']]
+    start = time.perf_counter()
+    error = None
+    try:
+        if kind == 'cover':
+            error = plugin.download_cover(log, rq, abort, title=book['title'], authors=authors,
+                                          identifiers={'isbn': book['barcode']}, timeout=timeout)
+        elif kind == 'title':
+            error = plugin.identify(log, rq, abort, title=book['title'], authors=authors, timeout=timeout)
+        else:
+            error = plugin.identify(log, rq, abort, identifiers={'isbn': book['barcode']}, timeout=timeout)
+    except Exception as e:
+        error = repr(e)
+    end = time.perf_counter()
+    times = rq.times
+    return {'kind': kind, 'latency': end - start, 'results': len(times), 'error': error,
+            'first': times[0] - start if times else None, 'last': times[-1] - start if times else None,
+            'tail': end - times[-1] if times else None}
+
+
+def workload(books, requests, title_ratio, cover_ratio):
+    # Every book in turn, as isbn, title/author or cover lookups spread over the run
+    jobs = []
+    for i in range(requests):
+        book = books[i % len(books)]
+        if cover_ratio and (i * cover_ratio) % 1 + cover_ratio >= 1:
+            kind = 'cover'
+        elif title_ratio and (i * title_ratio) % 1 + title_ratio >= 1:
+            kind = 'title'
+        else:
+            kind = 'isbn'
+        jobs.append((kind, book))
+    return jobs
+
+
+def run(opts):
+    from calibre_plugins.kyobobook import Kyobobook
+    from calibre_plugins.kyobobook.transport import STANDIN_ENV
+    from calibre_plugins.kyobobook.ratelimit import rate_limiter
+    import calibre_plugins.kyobobook.config as cfg
+    
+    corpus = Corpus(opts.corpus)
+    server = StandinServer(opts.corpus, latency=opts.latency, jitter=opts.jitter, error_rate=opts.error_rate,
+                           timeout_rate=opts.timeout_rate, hang=opts.hang, throttle=opts.throttle, seed=1).start()
+    os.environ[STANDIN_ENV] = server.url
+    if opts.rate:
+        rate_limiter.rate, rate_limiter.burst = opts.rate, max(opts.rate * 2, 1)
+    if opts.max_downloads:
+        # Only changes the prefs in memory, they are not saved
+        cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_MAX_DOWNLOADS] = opts.max_downloads
+    # Never touch the user's own stores
+    tdir = tempfile.mkdtemp(prefix='kyobobook-loadtest-')
+    isolate(tdir)
+    
+    jobs = workload(corpus.books, opts.requests, opts.title_ratio, opts.cover_ratio)
+    rounds = [jobs] if opts.warm else [jobs[i:i + len(corpus.books)] for i in range(0, len(jobs), len(corpus.books))]
+    plugin = Kyobobook(None)
+    sampler = Sampler()
+    sampler.start()
+    results = []
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=opts.concurrency) as pool:
+            for n, jobs in enumerate(rounds):
+                if n and not opts.warm:
+                    rdir = os.path.join(tdir, str(n))
+                    os.makedirs(rdir)
+                    isolate(rdir)
+                    plugin = Kyobobook(None)
+                results.extend(pool.map(lambda job, plugin=plugin: call(plugin, job[0], job[1], opts.timeout), jobs))
+        elapsed = time.perf_counter() - start
+    finally:
+        sampler.stop()
+        server.stop()
+        del os.environ[STANDIN_ENV]
+        shutil.rmtree(tdir, ignore_errors=True)
+    return results, elapsed, sampler, server.stats()
+
+
+def report(results, elapsed, sampler, stats, concurrency):
+    print('%d calls, concurrency %d, %.1f s, %.1f calls/s' % (len(results), concurrency, elapsed,
+                                                               len(results) / elapsed))
+    print('peak threads %d, peak RSS %.1f MiB' % (sampler.peak_threads, sampler.peak_rss / 1024 / 1024))
+    print()
+    print('%-8s %6s %6s %9s %9s %9s %9s' % ('call', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for kind in ('isbn', 'title', 'cover'):
+        latencies = [r['latency'] * 1000 for r in results if r['kind'] == kind]
+        if latencies:
+            errors = sum(1 for r in results if r['kind'] == kind and (r['error'] or not r['results']))
+            print('%-8s %6d %6d %9.0f %9.0f %9.0f %9.0f' % (
+                kind, len(latencies), errors, percentile(latencies, 50), percentile(latencies, 95),
+                percentile(latencies, 99), max(latencies)))
+    print()
+    # Spread: first to last result, mostly waits for the per host connection limit (ConcurrencyLimiter).
+    # Tail: identify polls join(0.2) on every worker until all are done.
+    print('identify by number of results (p50 ms)')
+    print('%8s %6s %9s %9s %9s %9s %12s' % ('results', 'count', 'first', 'last', 'tail', 'total', 'spread'))
+    identifies = [r for r in results if r['kind'] != 'cover']
+    for count in sorted(set(r['results'] for r in identifies)):
+        rs = [r for r in identifies if r['results'] == count]
+        if not count:
+            print('%8d %6d %9s %9s %9s %9.0f %12s' % (count, len(rs), '-', '-', '-',
+                                                       percentile([r['latency'] * 1000 for r in rs], 50), '-'))
+            continue
+        print('%8d %6d %9.0f %9.0f %9.0f %9.0f %12.0f' % (
+            count, len(rs), percentile([r['first'] * 1000 for r in rs], 50),
+            percentile([r['last'] * 1000 for r in rs], 50), percentile([r['tail'] * 1000 for r in rs], 50),
+            percentile([r['latency'] * 1000 for r in rs], 50),
+            percentile([(r['last'] - r['first']) * 1000 for r in rs], 50)))
+    print()
+    print('%-26s %9s %12s' % ('host', 'requests', 'KiB'))
+    for host, count in sorted(stats['requests'].items()):
+        print('%-26s %9d %12.0f' % (host, count, stats['bytes'].get(host, 0) / 1024))
+    print('statuses: %s' % ', '.join('%s: %d' % s for s in sorted(stats['statuses'].items())))
+    errors = Counter(r['error'] for r in results if r['error'])
+    for error, count in errors.most_common(5):
+        print('error x%d: %s' % (count, error))
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Load test identify and download_cover against the stand-in server')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--title-ratio', type=float, default=0.3, help='fraction of title/author identifies')
+    parser.add_argument('--cover-ratio', type=float, default=0.2, help='fraction of download_cover calls')
+    parser.add_argument('--timeout', type=int, default=30)
+    parser.add_argument('--max-downloads', type=int, default=None, help='override KEY_MAX_DOWNLOADS')
+    parser.add_argument('--rate', type=float, default=None, help='override the requests/s per host limit')
+    parser.add_argument('--warm', action='store_true', help='keep the caches between calls')
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--hang', type=float, default=60.0)
+    parser.add_argument('--throttle', type=float, default=None)
+    opts = parser.parse_args(args)
+    results, elapsed, sampler, stats = run(opts)
+    report(results, elapsed, sampler, stats, opts.concurrency)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
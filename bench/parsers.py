@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import copy
+import json
+import time
+import platform
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from corpus import Corpus, CORPUS_DIR, detail_url  # noqa: E402
+
+"""
+Times every parser of the plugin separately over the pages of the benchmark corpus:
+
+    calibre-debug -e bench/parsers.py -- [--save] [--threshold 25] [--passes 20] [--corpus dir]
+
+For every parser it reports the time (best of 5 runs) and the peak Python allocation per page.
+--save writes them to bench/parsers-baseline.json, which is machine specific and not in git.
+When a baseline exists, the exit status is 1 if a parser got slower than the baseline by more
+than --threshold percent.
+"""
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parsers-baseline.json')
+
+
+class QuietLog(object):
+    # The parsers log every search result, which would be timed too
+    
+    def _quiet(self, *args, **kwargs):
+        pass
+    
+    debug = info = warning = warn = error = exception = _quiet
+
+
+class CoverProbe(object):
+    # Answer of the cover image check in parse_cover, instead of a request to kyobobook
+    
+    def info(self):
+        return {'Content-Length': '20000'}
+    
+    def close(self):
+        pass
+
+
+def detail_parsers(worker):
+    return [
+        ('parse_page', None),
+        ('parse_title_series', worker.parse_title_series),
+        ('parse_authors', worker.parse_authors),
+        ('parse_comments', worker.parse_comments),
+        ('parse_cover', worker.parse_cover),
+        ('parse_publisher_and_date', worker.parse_publisher_and_date),
+        ('parse_tags', worker.parse_tags),
+        ('_parse_language', worker._parse_language),
+    ]
+
+
+def load(corpus):
+    """
+    Return [(worker, raw, root)] for the details pages and [(title, authors, root)] for the search pages.
+    """
+    from lxml.html import fromstring
+    from calibre.utils.cleantext import clean_ascii_chars
+    from calibre_plugins.kyobobook.worker import Worker
+    
+    log = QuietLog()
+    details = []
+    for book in corpus.books:
+        worker = Worker(detail_url(book), None, object(), log, 0, None)
+        raw = corpus.detail(book['barcode'])
+        root = worker.parse_page(raw)
+        if root is None:
+            print('Skipping unparsable page: %s' % book['barcode'])
+            continue
+        details.append((worker, raw, root))
+    searches = []
+    for book in corpus.books:
+        raw = corpus.search(book['title'])
+        root = fromstring(clean_ascii_chars(raw.decode('utf-8', errors='replace')))
+        searches.append((book['title'], [a for a, r in book['authors']], root))
+    return details, searches
+
+
+def measure(calls, passes, repeat=5):
+    """
+    calls: (func, prepare) per page, func is called with a fresh prepare() every time.
+    Returns (best seconds per call, mean peak bytes per call).
+    """
+    best = None
+    for _ in range(repeat):
+        elapsed = 0
+        for _ in range(passes):
+            # Prepared outside of the timed loop, one pass at a time to keep the memory use low
+            args = [(func, prepare()) for func, prepare in calls]
+            start = time.perf_counter()
+            for func, arg in args:
+                func(arg)
+            elapsed += time.perf_counter() - start
+        elapsed /= passes * len(calls)
+        best = elapsed if best is None else min(best, elapsed)
+    
+    tracemalloc.start()
+    try:
+        peaks = 0
+        for func, prepare in calls:
+            arg = prepare()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            func(arg)
+            peaks += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return best, peaks / max(len(calls), 1)
+
+
+def run(corpus_dir=CORPUS_DIR, passes=20):
+    import calibre_plugins.kyobobook.worker as worker_module
+    from calibre_plugins.kyobobook import Kyobobook
+    
+    details, searches = load(Corpus(corpus_dir))
+    # parse_cover checks the image url with a request, answer it locally
+    open_url = worker_module.open_url
+    worker_module.open_url = lambda br, url, timeout, deadline=None, head=False: CoverProbe()
+    results = {}
+    try:
+        names = [name for name, func in detail_parsers(details[0][0])]
+        for name in names:
+            calls = []
+            for worker, raw, root in details:
+                if name == 'parse_page':
+                    calls.append((worker.parse_page, lambda raw=raw: raw))
+                else:
+                    # Some parsers remove nodes from the tree, every call gets its own copy
+                    func = dict(detail_parsers(worker))[name]
+                    calls.append((func, lambda root=root: copy.deepcopy(root)))
+            results[name] = measure(calls, passes)
+        
+        plugin = Kyobobook(None)
+        log = QuietLog()
+        calls = []
+        for title, authors, root in searches:
+            def parse(root, title=title, authors=authors):
+                plugin._parse_search_results(log, title, authors, root, [], 30)
+            calls.append((parse, lambda root=root: root))
+        results['_parse_search_results'] = measure(calls, passes)
+        
+        calls = [(lambda authors: list(plugin.get_author_tokens(authors)), lambda authors=authors: authors)
+                 for title, authors, root in searches]
+        results['get_author_tokens'] = measure(calls, passes * 10)
+    finally:
+        worker_module.open_url = open_url
+    return dict((name, {'us': t * 1e6, 'kib': m / 1024}) for name, (t, m) in results.items())
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results next to the baseline and return the names of the parsers that regressed.
+    """
+    regressed = []
+    print('%-26s %12s %12s %10s %10s' % ('parser', 'us/page', 'baseline', 'change', 'peak KiB'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = ''
+        if base:
+            pct = (result['us'] / base['us'] - 1) * 100
+            change = '%+.1f%%' % pct
+            if pct > threshold:
+                regressed.append(name)
+                change += ' !'
+        print('%-26s %12.1f %12s %10s %10.1f' % (name, result['us'], '%.1f' % base['us'] if base else '-',
+                                                  change, result['kib']))
+    return regressed
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Time the kyobobook parsers over the benchmark corpus')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--passes', type=int, default=20, help='calls per page and run')
+    parser.add_argument('--threshold', type=float, default=25.0, help='allowed slow down, percent')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    opts = parser.parse_args(args)
+    
+    results = run(opts.corpus, opts.passes)
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline, 'rb') as f:
+            baseline = json.loads(f.read().decode('utf-8'))['parsers']
+    regressed = compare(results, baseline, opts.threshold)
+    if opts.save:
+        with open(opts.baseline, 'wb') as f:
+            f.write(json.dumps({'python': platform.python_version(), 'machine': platform.machine(),
+                                'saved': time.strftime('%Y-%m-%d %H:%M:%S'), 'parsers': results},
+                               indent=1).encode('utf-8'))
+        print('Saved baseline: %s' % opts.baseline)
+    elif regressed:
+        print('Slower than the baseline by more than %.0f%%: %s' % (opts.threshold, ', '.join(regressed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from corpus import Corpus, CORPUS_DIR, detail_url  # noqa: E402
+
+"""
+Parses the details pages of the benchmark corpus with a ParsePool (parsing.py) of more and
+more processes and reports the pages per second and the speed up over one process:
+    
+    calibre-debug -e bench/scaling.py -- [--pages 2000] [--processes 1,2,4,8] [--corpus dir]
+
+The pages of the corpus are repeated until there are --pages of them. With
+"python bench/corpus.py synth 1000" the pages are not all the same.
+"""
+
+
+def load(corpus, pages):
+    books = [(detail_url(book), corpus.detail(book['barcode'])) for book in corpus.books]
+    books = [(url, raw) for url, raw in books if raw]
+    return [books[i % len(books)] for i in range(pages)]
+
+
+def measure(pages, processes):
+    from calibre.utils.logging import default_log
+    from calibre_plugins.kyobobook.parsing import ParsePool
+    with ParsePool(default_log, processes) as pool:
+        # The worker processes are started and have imported the plugin before the clock starts
+        list(pool.map(pages[:processes * 2], chunksize=1))
+        start = time.perf_counter()
+        failed = sum(1 for url, record, candidates in pool.map(pages) if record is None)
+        elapsed = time.perf_counter() - start
+    return elapsed, failed
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Parse the corpus pages with 1, 2, 4 ... processes')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--processes', default='1,2,4,8', help='comma separated process counts')
+    opts = parser.parse_args(args)
+    
+    pages = load(Corpus(opts.corpus), opts.pages)
+    print('%d pages, %d cores' % (len(pages), os.cpu_count() or 1))
+    print('%10s %10s %10s %10s %10s' % ('processes', 'seconds', 'pages/s', 'speed up', 'per core'))
+    base = None
+    for processes in [int(p) for p in opts.processes.split(',')]:
+        elapsed, failed = measure(pages, processes)
+        rate = len(pages) / elapsed
+        base = base or rate
+        print('%10d %10.2f %10.0f %9.2fx %9.0f%%' % (processes, elapsed, rate, rate / base,
+                                                     rate / base / processes * 100))
+        if failed:
+            print('%d pages could not be parsed' % failed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import sys
+import time
+import random
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from corpus import Corpus, CORPUS_DIR, not_found_page  # noqa: E402
+
+"""
+Local HTTP server standing in for search.kyobobook.co.kr, www.kyobobook.co.kr and
+image.kyobobook.co.kr, serving the benchmark corpus. The plugin sends its requests here
+when KYOBOBOOK_STANDIN_URL is set (see transport.py):
+
+    python bench/standin.py --port 8765 --latency 0.2 --jitter 0.1 --error-rate 0.02
+    KYOBOBOOK_STANDIN_URL=http://127.0.0.1:8765 calibre-debug -g
+
+Requests are http://<stand-in>/<kyobobook host>/<path>?<query>.
+"""
+
+BARCODE_PAT = re.compile(r'(\d{13})')
+
+
+class StandinServer(object):
+    """
+    latency, jitter : seconds added to every response (latency + uniform(0, jitter))
+    error_rate : fraction of requests answered with a 500
+    timeout_rate : fraction of requests that hang for hang seconds before being answered
+    throttle : requests per second per host above which requests get a 429 with Retry-After
+    """
+    
+    def __init__(self, corpus_dir=CORPUS_DIR, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, timeout_rate=0.0, hang=60.0, throttle=None, seed=None):
+        self.corpus = Corpus(corpus_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.reset_stats()
+        
+        server = self
+        
+        class Handler(StandinHandler):
+            standin = server
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+    
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='kyobobook-standin')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def reset_stats(self):
+        with self._lock:
+            self.requests = Counter()
+            self.statuses = Counter()
+            self.bytes_sent = Counter()
+    
+    def stats(self):
+        """
+        Requests, responses by status and bytes sent, per kyobobook host.
+        """
+        with self._lock:
+            return {'requests': dict(self.requests), 'statuses': dict(self.statuses),
+                    'bytes': dict(self.bytes_sent)}
+    
+    def _count(self, host, status, size):
+        with self._lock:
+            self.requests[host] += 1
+            self.statuses[status] += 1
+            self.bytes_sent[host] += size
+    
+    def _throttled(self, host):
+        # Fixed one second window per host
+        if not self.throttle:
+            return False
+        now = int(time.time())
+        with self._lock:
+            window, count = self._windows.get(host, (now, 0))
+            if window != now:
+                window, count = now, 0
+            self._windows[host] = (window, count + 1)
+            return count >= self.throttle
+    
+    def _roll(self):
+        with self._lock:
+            return self.random.random(), self.random.random(), self.random.uniform(0, self.jitter)
+    
+    def respond(self, host, path, query):
+        """
+        Return (status, headers, body) for a kyobobook request.
+        """
+        params = parse_qs(query)
+        if host == 'search.kyobobook.co.kr':
+            keyword = params.get('vPstrKeyWord', [''])[0]
+            return 200, {'Content-Type': 'text/html; charset=UTF-8'}, self.corpus.search(keyword)
+        if host == 'www.kyobobook.co.kr' and 'detailView' in path:
+            raw = self.corpus.detail(params.get('barcode', [''])[0])
+            # Kyobobook answers unknown barcodes with an empty page, not a 404
+            return 200, {'Content-Type': 'text/html; charset=euc-kr'}, raw if raw is not None else not_found_page()
+        if host == 'image.kyobobook.co.kr':
+            match = BARCODE_PAT.search(path)
+            if match:
+                data, ctype = self.corpus.cover(match.group(1))
+                if data is not None:
+                    return 200, {'Content-Type': ctype}, data
+        return 404, {'Content-Type': 'text/plain'}, b'Not found'
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    standin = None
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        self._handle(send_body=True)
+    
+    def do_HEAD(self):
+        self._handle(send_body=False)
+    
+    def _handle(self, send_body):
+        server = self.standin
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip('/').partition('/')
+        path = '/' + path
+        
+        error, hang, jitter = server._roll()
+        delay = server.latency + jitter
+        if server._throttled(host):
+            status, headers, body = 429, {'Content-Type': 'text/plain', 'Retry-After': '1'}, b'Too many requests'
+        elif error < server.error_rate:
+            status, headers, body = 500, {'Content-Type': 'text/plain'}, b'Internal server error'
+        else:
+            if hang < server.timeout_rate:
+                delay += server.hang
+            status, headers, body = server.respond(host, path, parts.query)
+        if delay:
+            time.sleep(delay)
+        
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. it timed out
+            pass
+        server._count(host, status, len(body) if send_body else 0)
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the benchmark corpus as kyobobook')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds, up to')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 500 responses')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of requests that hang')
+    parser.add_argument('--hang', type=float, default=60.0, help='seconds a hanging request hangs')
+    parser.add_argument('--throttle', type=float, default=None, help='requests/s per host before 429s')
+    parser.add_argument('--seed', type=int, default=None)
+    opts = parser.parse_args(args)
+    server = StandinServer(opts.corpus, opts.host, opts.port, latency=opts.latency, jitter=opts.jitter,
+                           error_rate=opts.error_rate, timeout_rate=opts.timeout_rate, hang=opts.hang,
+                           throttle=opts.throttle, seed=opts.seed)
+    print('Serving %d books, set KYOBOBOOK_STANDIN_URL=%s' % (len(server.corpus.books), server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.stats())
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
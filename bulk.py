@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import os
+import json
+import time
+import zlib
+from itertools import islice
+from collections import OrderedDict, deque
+from threading import Thread, Lock, Condition, Event
+
+"""
+[ 참고 ]============================================================
+* 목록에 있는 책들의 정보를 한꺼번에 받는다.
+  calibre-debug -e bulk.py -- books.txt [--out results.jsonl] [--threads 8] [--processes 8]
+* books.txt 에는 한 줄에 책 한 권씩, ISBN 만 쓰거나 ISBN, 제목, 저자를 탭으로 나눠서 쓴다.
+  ISBN 을 비워 두면(탭으로 시작) 제목과 저자로 검색한다. 저자가 여럿이면 ' & ' 로 나눈다. # 으로 시작하는 줄은 건너뛴다.
+* 책 페이지는 fetcher 스레드들이 Worker 의 메서드로 받는다(캐시, rate limit, 재시도, 저장은 identify 와 같다).
+  --processes 를 주면 파싱은 ParsePool 의 프로세스들이 한다(parsing.py). 표지 확인과 Metadata 만들기는
+  fetcher 스레드에서 한다.
+* 싼 일부터 한다(Scheduler). 저장소에 있는 책, ISBN 으로 책 페이지 하나만 받으면 되는 책, 검색 페이지와
+  책 페이지 여러 개를 받아야 하는 제목/저자 검색 순서다. 그래도 검색이 끝까지 밀리지 않도록 --search-threads 개의
+  스레드는 ISBN 책이 남아 있어도 검색을 한다. ISBN 으로 찾지 못한 책은 identify 처럼 제목과 저자로 다시 검색한다.
+* 저장소나 캐시에 있는 책은 받지 않는다(--no-cache 로 끈다). 받은 책은 저장소, 색인, 캐시에 들어가고
+  --out 파일에 끝나는 대로 한 줄씩 JSON 으로 쓴다.
+* --checkpoint 파일에는 끝난 책을 한 줄씩 쓴다. 중간에 멈춘 뒤 같은 명령을 다시 실행하면 끝난 책은 건너뛴다.
+* 큰 목록은 여러 프로세스로 나눠서 받는다. ISBN 의 해시로 나눠서(shard_of) 프로세스마다 --shard 1/4, 2/4 ... 를 준다.
+    calibre-debug -e bulk.py -- books.txt --out results.jsonl --checkpoint done.txt --shard 1/4 --rate-file rate.sqlite
+  --out, --checkpoint 파일은 shard 마다 따로 쓰고(results.1-4.jsonl), 끝난 뒤 --merge 4 로 합친다.
+    calibre-debug -e bulk.py -- books.txt --out results.jsonl --checkpoint done.txt --merge 4
+  --rate-file 을 같이 쓰는 프로세스들은 rate limit 의 token bucket 을 그 파일에서 함께 쓰므로(ratelimit.SharedBuckets)
+  모두 합쳐서 한 프로세스의 속도로 교보문고에 요청을 보낸다. 동시 요청 수 제한은 프로세스마다 따로 한다.
+"""
+
+DEFAULT_THREADS = 8
+
+# Books done between two progress lines in the log
+PROGRESS_EVERY = 100
+
+# The work of a book, cheapest first, see Scheduler
+CACHED = 0  # a stored record, no request
+ISBN = 1  # one details page
+SEARCH = 2  # a search page and up to KEY_MAX_DOWNLOADS details pages
+
+OUTCOMES = ('cached', 'fetched', 'searched', 'failed')
+
+
+class Book(object):
+    """
+    One line of the list of books. key is the line itself, barcode is None if there is no valid ISBN.
+    """
+    
+    def __init__(self, key, isbn=None, title=None, authors=None):
+        from calibre_plugins.kyobobook.importer import to_barcode
+        self.key = key
+        self.isbn, self.title, self.authors = isbn, title, authors
+        self.barcode = to_barcode(isbn) if isbn else None
+
+
+def parse_book(line):
+    # An ISBN, or tab separated ISBN, title and authors
+    fields = [field.strip() for field in line.split('\t')] + ['', '']
+    isbn, title, authors = fields[:3]
+    authors = [author.strip() for author in authors.split('&') if author.strip()]
+    return Book(line, isbn or None, title or None, authors or None)
+
+
+class ResultSink(object):
+    # The result queue of a bulk Worker, hands its Metadata to the runner
+    
+    def __init__(self, runner, key):
+        self.runner, self.key = runner, key
+    
+    def put(self, mi):
+        self.runner.found(self.key, mi)
+
+
+def shard_of(book, shards):
+    """
+    The shard (0 to shards - 1) of a book, the same in every process and for its ISBN-10 and ISBN-13.
+    """
+    key = book.barcode or book.key
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def shard_path(path, shard, shards):
+    # results.jsonl -> results.2-4.jsonl for the second of four shards
+    root, ext = os.path.splitext(path)
+    return '%s.%d-%d%s' % (root, shard + 1, shards, ext)
+
+
+class Checkpoint(object):
+    """
+    The books already done, one line of the list per line in path. Lines are appended as books
+    are done, so a run stopped at any point can be started again.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self.done = set(read_lines(path)) if os.path.exists(path) else set()
+        self._file = io.open(path, 'a', encoding='utf-8')
+    
+    def __contains__(self, key):
+        return key in self.done
+    
+    def add(self, key):
+        with self._lock:
+            self.done.add(key)
+            self._file.write(key + '\n')
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Scheduler(object):
+    """
+    The books waiting for a fetcher thread, the cheapest first: CACHED, then ISBN, then SEARCH.
+    At most search_slots threads search while cheaper books are waiting, so that the searches
+    get their share of the requests and are not all left to the end.
+    """
+    
+    def __init__(self, search_slots):
+        self.search_slots = search_slots
+        self._cond = Condition(Lock())
+        self._queues = (deque(), deque(), deque())  # by priority
+        self._searching = 0
+        self._closed = False
+    
+    def put(self, book, priority):
+        with self._cond:
+            self._queues[priority].append(book)
+            self._cond.notify()
+    
+    def close(self):
+        """
+        No more books will be put, except those of the threads still at work.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    
+    def get(self):
+        """
+        Block until there is a book. Returns it and its priority, or (None, None) once the scheduler is closed and empty.
+        """
+        with self._cond:
+            while True:
+                cached, isbn, search = self._queues
+                if cached:
+                    return cached.popleft(), CACHED
+                if search and (self._searching < self.search_slots or not isbn):
+                    self._searching += 1
+                    return search.popleft(), SEARCH
+                if isbn:
+                    return isbn.popleft(), ISBN
+                if self._closed:
+                    return None, None
+                self._cond.wait()
+    
+    def done(self, priority):
+        # The book got with get is done
+        if priority == SEARCH:
+            with self._cond:
+                self._searching -= 1
+
+
+class BulkRunner(object):
+    """
+    Gets the details of many books. threads fetcher threads download the pages and
+    a ParsePool parses them, in processes processes if more than 1, see Scheduler for the order of the books.
+    on_result(key, mi) is called from a fetcher thread with the Metadata of every book found.
+    The books of checkpoint are skipped and the books found are added to it.
+    """
+    
+    def __init__(self, log, threads=DEFAULT_THREADS, processes=1, timeout=30, use_cache=True, on_result=None,
+                 checkpoint=None, search_threads=None):
+        from calibre_plugins.kyobobook import Kyobobook
+        from calibre_plugins.kyobobook.timing import PhaseTimer
+        self.log = log
+        self.threads, self.processes = threads, processes
+        self.search_threads = search_threads or max(1, threads // 4)
+        self.timeout, self.use_cache = timeout, use_cache
+        self.on_result = on_result
+        self.checkpoint = checkpoint
+        self.plugin = Kyobobook(None)
+        self.timer = PhaseTimer('bulk')
+        self.abort = Event()
+        self._lock = Lock()
+        self.stats = {'books': 0, 'skipped': 0, 'cached': 0, 'fetched': 0, 'searched': 0, 'failed': 0}
+        self.parser = None
+        self.scheduler = None
+        self._start = None
+    
+    def count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+            done = sum(self.stats[o] for o in OUTCOMES)
+            books = self.stats['books']
+        if outcome in OUTCOMES and done % PROGRESS_EVERY == 0:
+            self.log.info('Bulk: %d of %d books done in %.0f seconds' % (done, books, time.time() - self._start))
+    
+    def found(self, key, mi):
+        if self.on_result is not None:
+            self.on_result(key, mi)
+    
+    def run(self, books):
+        """
+        Get the details of every Book of books, returns the stats.
+        """
+        from calibre_plugins.kyobobook.parsing import ParsePool
+        from calibre_plugins.kyobobook.cache import configure_caches
+        configure_caches()
+        self._start = time.time()
+        self.scheduler = Scheduler(self.search_threads)
+        fetchers = [Thread(target=self._fetcher, name='KyoboBook bulk %d' % i) for i in range(self.threads)]
+        self.parser = ParsePool(self.log, self.processes)
+        with self.parser:
+            for t in fetchers:
+                t.daemon = True
+                t.start()
+            try:
+                # Read in chunks, so that the stored books of a chunk are looked up at once
+                books = iter(books)
+                for chunk in iter(lambda: list(islice(books, 500)), []):
+                    if self.abort.is_set():
+                        break
+                    self.schedule(chunk)
+            except BaseException:
+                # Interrupted, the books still waiting are skipped
+                self.abort.set()
+                raise
+            finally:
+                self.scheduler.close()
+                for t in fetchers:
+                    t.join()
+        from calibre_plugins.kyobobook.archive import page_archive
+        # The archive is written in the background, and the process usually exits after the run
+        page_archive.flush()
+        self.timer.stop()
+        self.stats['seconds'] = time.time() - self._start
+        self.log.info('Bulk: %(books)d books, %(skipped)d done before, %(cached)d cached, %(fetched)d downloaded, '
+                      '%(searched)d searched, %(failed)d failed in %(seconds).1f seconds' % self.stats)
+        self.log.info(self.timer.summary())
+        return self.stats
+    
+    def schedule(self, books):
+        if self.checkpoint is not None:
+            for book in books:
+                if book.key in self.checkpoint:
+                    self.count('skipped')
+            books = [book for book in books if book.key not in self.checkpoint]
+        stored = self.stored(book.barcode for book in books if book.barcode)
+        for book in books:
+            self.count('books')
+            if book.barcode in stored:
+                self.scheduler.put(book, CACHED)
+            elif book.barcode or not book.title:
+                # Without an ISBN or a title lookup reports the book as failed
+                self.scheduler.put(book, ISBN)
+            else:
+                self.scheduler.put(book, SEARCH)
+    
+    def stored(self, barcodes):
+        # The barcodes with a record parsed from a details page, only used to order the books
+        if not self.use_cache:
+            return set()
+        from calibre_plugins.kyobobook.cache import record_store
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        try:
+            return record_store.page_barcodes(barcodes, PARSER_VERSION)
+        except Exception as e:
+            self.log.exception('Failed to look up the stored records', exc_info=e)
+            return set()
+    
+    def _fetcher(self):
+        while True:
+            book, priority = self.scheduler.get()
+            if book is None or self.abort.is_set():
+                return
+            try:
+                outcome = self.search(book) if priority == SEARCH else self.lookup(book)
+            except Exception as e:
+                self.log.exception('Bulk lookup failed for: %s' % book.key, exc_info=e)
+                outcome = 'failed'
+            finally:
+                self.scheduler.done(priority)
+            if outcome == 'failed' and priority != SEARCH and book.barcode and book.title:
+                # Like identify, a book not found by its ISBN is searched by title and authors
+                self.log.info('Searching by title and authors instead: %s' % book.key)
+                self.scheduler.put(book, SEARCH)
+                continue
+            self.count(outcome)
+            # Failed books are tried again by the next run
+            if outcome != 'failed' and self.checkpoint is not None:
+                self.checkpoint.add(book.key)
+    
+    def lookup(self, book):
+        """
+        Get the details of a book by its ISBN with the steps of Worker.get_details, the page is parsed
+        by the ParsePool. Returns 'cached', 'fetched' or 'failed'.
+        """
+        from calibre_plugins.kyobobook.worker import Worker
+        from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+        if book.barcode is None:
+            self.log.error('Not an ISBN: %r' % book.key)
+            return 'failed'
+        url = '%s/product/detailViewKor.laf?barcode=%s' % (self.plugin.BASE_URL, book.barcode)
+        w = Worker(url, ResultSink(self, book.key), self.plugin.browser, self.log, 0, self.plugin,
+                   timeout=self.timeout, timer=self.timer, deadline=Deadline(self.timeout, self.abort))
+        # A partial record imported from a catalog export is not enough, the details page is fetched for it
+        if self.use_cache and w.lookup_cache(partial=False):
+            return 'cached'
+        
+        try:
+            raw = w.fetch_page()
+        except Cancelled as e:
+            self.log.info('Stopped getting details (%s): %r' % (e, url))
+            return 'failed'
+        except Exception as e:
+            w.fetch_failed(e)
+            return 'cached' if w.use_imported_record() else 'failed'
+        
+        try:
+            record, candidates = w.parse_fetched(raw, self.parser)
+            if record is None:
+                self.log.error('Could not parse details page: %r' % url)
+                return 'failed'
+            with self.timer('parse_cover'):
+                record['cover'] = w.check_cover(candidates)
+        except Cancelled as e:
+            self.log.info('Stopped getting details (%s): %r' % (e, url))
+            return 'failed'
+        w.save_record(record)
+        return 'fetched'
+    
+    def search(self, book):
+        """
+        Search a book by title and authors with identify, returns 'searched' or 'failed'.
+        Only the most relevant match is kept.
+        """
+        from queue import Queue, Empty
+        results = Queue()
+        error = self.plugin.identify(self.log, results, self.abort, title=book.title, authors=book.authors,
+                                     identifiers={}, timeout=self.timeout)
+        found = []
+        while True:
+            try:
+                found.append(results.get_nowait())
+            except Empty:
+                break
+        if not found:
+            self.log.error('Nothing found for: %s%s' % (book.key, ' (%s)' % error if error else ''))
+            return 'failed'
+        self.found(book.key, min(found, key=lambda mi: mi.source_relevance))
+        return 'searched'
+
+
+def read_lines(path):
+    # One entry per line, blank lines and lines starting with # are skipped
+    with io.open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def read_books(path):
+    for line in read_lines(path):
+        yield parse_book(line)
+
+
+def merge_shards(log, out, checkpoint, shards):
+    """
+    Merge the --out and --checkpoint files of shards shards into out and checkpoint,
+    together with what these already hold. A book found more than once is written once, the last one found.
+    """
+    if out:
+        results = OrderedDict()
+        for path in [out] + [shard_path(out, i, shards) for i in range(shards)]:
+            if not os.path.exists(path):
+                continue
+            with io.open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key = json.loads(line)['key']
+                    except (ValueError, KeyError):
+                        # The last line of a shard that was killed while writing it
+                        log.warning('Skipped a broken line of: %s' % path)
+                        continue
+                    results.pop(key, None)
+                    results[key] = line.rstrip('\n')
+        _replace(out, results.values())
+        log.info('Merged %d books into: %s' % (len(results), out))
+    if checkpoint:
+        done = OrderedDict()
+        for path in [checkpoint] + [shard_path(checkpoint, i, shards) for i in range(shards)]:
+            if os.path.exists(path):
+                done.update((key, True) for key in read_lines(path))
+        _replace(checkpoint, done)
+        log.info('Merged %d done books into: %s' % (len(done), checkpoint))
+
+
+def _replace(path, lines):
+    # Written next to path and renamed, so that an interrupted merge leaves path as it was
+    tmp = path + '.tmp'
+    with io.open(tmp, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+    os.replace(tmp, path)
+
+
+def result_line(key, mi):
+    return json.dumps({
+        'key': key, 'identifiers': mi.get_identifiers(),
+        'title': mi.title, 'authors': mi.authors, 'publisher': mi.publisher,
+        'pubdate': mi.pubdate.strftime('%Y-%m-%d') if mi.pubdate else None,
+        'series': mi.series, 'tags': list(mi.tags or []), 'has_cover': bool(mi.has_cover),
+    }, ensure_ascii=False)
+
+
+def main(args=None):
+    import argparse
+    from calibre.utils.logging import default_log
+    from calibre_plugins.kyobobook.parsing import MAX_PROCESSES
+    parser = argparse.ArgumentParser(description='Get the kyobobook details of a list of books')
+    parser.add_argument('books', nargs='?', help='file with one book per line: an ISBN, or ISBN, title and '
+                                                   'authors separated by tabs. Not used with --merge')
+    parser.add_argument('--out', help='write the books found to this file, one JSON object per line')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help='fetcher threads')
+    parser.add_argument('--search-threads', type=int, default=None,
+                        help='fetcher threads that search by title and authors while books with an ISBN are '
+                             'waiting, a quarter of the threads by default')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='parser processes, at most %d and the number of cores. 1 (the default) parses in '
+                             'the fetcher threads' % MAX_PROCESSES)
+    parser.add_argument('--timeout', type=int, default=30)
+    parser.add_argument('--no-cache', action='store_true', help='download the books already stored too')
+    parser.add_argument('--checkpoint', help='file of the books done, they are skipped when the run is started again')
+    parser.add_argument('--shard', help='K/N, get only the books of shard K of N, 1 <= K <= N')
+    parser.add_argument('--rate-file', help='share the rate limit with the other processes using this file')
+    parser.add_argument('--merge', type=int, metavar='N', help='merge the --out and --checkpoint files of N shards')
+    opts = parser.parse_args(args)
+    
+    if opts.merge:
+        merge_shards(default_log, opts.out, opts.checkpoint, opts.merge)
+        return 0
+    if not opts.books:
+        parser.error('the list of books is required, except with --merge')
+    
+    books = read_books(opts.books)
+    if opts.shard:
+        try:
+            shard, shards = [int(n) for n in opts.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be K/N')
+        if not 1 <= shard <= shards:
+            parser.error('--shard must be K/N with 1 <= K <= N')
+        shard -= 1
+        books = (book for book in books if shard_of(book, shards) == shard)
+        if opts.out:
+            opts.out = shard_path(opts.out, shard, shards)
+        if opts.checkpoint:
+            opts.checkpoint = shard_path(opts.checkpoint, shard, shards)
+    if opts.rate_file:
+        from calibre_plugins.kyobobook.ratelimit import rate_limiter
+        rate_limiter.share(opts.rate_file)
+    
+    out = io.open(opts.out, 'a', encoding='utf-8') if opts.out else None
+    checkpoint = Checkpoint(opts.checkpoint) if opts.checkpoint else None
+    lock = Lock()
+    
+    def on_result(key, mi):
+        if out is not None:
+            line = result_line(key, mi)
+            with lock:
+                out.write(line + '\n')
+                out.flush()
+    
+    runner = BulkRunner(default_log, threads=opts.threads, processes=opts.processes, timeout=opts.timeout,
+                        use_cache=not opts.no_cache, on_result=on_result, checkpoint=checkpoint,
+                        search_threads=opts.search_threads)
+    try:
+        runner.run(books)
+    except KeyboardInterrupt:
+        runner.abort.set()
+    finally:
+        if out is not None:
+            out.close()
+        if checkpoint is not None:
+            checkpoint.close()
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
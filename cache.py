@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import json
+import zlib
+import gzip
+import sqlite3
+from threading import Thread, RLock, Lock
+from queue import Queue
+from itertools import repeat
+from collections import OrderedDict
+
+from calibre.utils.config import config_dir
+
+LAYER_SEARCH = 'search'  # search query url -> list of detail page urls
+LAYER_DETAIL = 'detail'  # detail page url -> parsed book record (see Worker.parse_record)
+
+# Where a stored record came from
+SOURCE_PAGE = 'page'  # parsed from a kyobobook details page
+SOURCE_IMPORT = 'import'  # imported from a catalog export, see importer.py
+
+# Seconds an entry is considered fresh
+DEFAULT_TTLS = {
+    LAYER_SEARCH: 24 * 60 * 60,
+    LAYER_DETAIL: 7 * 24 * 60 * 60,
+}
+
+# Entries kept in memory, the least recently used are dropped first
+DEFAULT_MAX_ENTRIES = 5000
+
+# Records stored between two checks of the size of the record store
+PRUNE_EVERY = 256
+
+# First line of a cache snapshot file, see export_snapshot
+SNAPSHOT_FORMAT = 'kyobobook-cache'
+SNAPSHOT_VERSION = 1
+
+# PRAGMA user_version of the record store, see RecordStore.migrate
+SCHEMA_VERSION = 1
+
+# Shared by all record writes, json.dumps with arguments builds a new encoder on every call
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+class MetadataCache(object):
+    """
+    Thread safe cache of kyobobook search results and book details.
+    Expired entries are kept so that they can still be served while being refreshed.
+    At most max_entries are kept, the least recently used are dropped first.
+    """
+    
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_entries = max_entries
+        self._lock = RLock()
+        self._entries = OrderedDict()  # (layer, key) -> (fetched time, value), least recently used first
+    
+    def configure(self, ttls=None, max_entries=None):
+        with self._lock:
+            if ttls:
+                self.ttls.update(ttls)
+            if max_entries:
+                self.max_entries = max_entries
+                self._evict()
+    
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get(self, layer, key):
+        """
+        Return (value, stale). value is None if nothing is cached for key.
+        """
+        with self._lock:
+            entry = self._entries.get((layer, key))
+            if entry is not None:
+                self._entries.move_to_end((layer, key))
+        if entry is None:
+            return None, False
+        fetched, value = entry
+        return value, time.time() - fetched > self.ttls[layer]
+    
+    def put(self, layer, key, value, fetched=None):
+        with self._lock:
+            self._entries[(layer, key)] = (fetched or time.time(), value)
+            self._entries.move_to_end((layer, key))
+            self._evict()
+    
+    def count(self, layer=None):
+        with self._lock:
+            if layer is None:
+                return len(self._entries)
+            return sum(1 for k in self._entries if k[0] == layer)
+    
+    def clear(self, layer=None):
+        with self._lock:
+            if layer is None:
+                self._entries.clear()
+            else:
+                for k in [k for k in self._entries if k[0] == layer]:
+                    del self._entries[k]
+
+
+class RecordStore(object):
+    """
+    Parsed book records persisted in an SQLite database.
+    Records are keyed by barcode and the version of the parser that produced them,
+    so records written by older parse_* code are never returned.
+    When max_records is set, the records fetched longest ago are dropped beyond it.
+    """
+    
+    def __init__(self, path, max_records=None):
+        self.path = path
+        self.max_records = max_records
+        self._lock = Lock()
+        self._conn = None
+        self._puts = 0
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Without a sync on every commit, with WAL a power failure can only lose the last commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                         'barcode TEXT NOT NULL, parser_version INTEGER NOT NULL, '
+                         'fetched REAL NOT NULL, data BLOB NOT NULL, source TEXT NOT NULL, '
+                         'PRIMARY KEY (barcode, parser_version))')
+            # For dropping the oldest records, see prune
+            conn.execute('CREATE INDEX IF NOT EXISTS records_fetched ON records (fetched)')
+            self.migrate(conn)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def migrate(conn):
+        # Bring a database written by an earlier version of the plugin up to SCHEMA_VERSION
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(records)')]
+            if 'source' not in columns:
+                # Every record stored before catalog imports was parsed from a details page
+                conn.execute("ALTER TABLE records ADD COLUMN source TEXT NOT NULL DEFAULT '%s'" % SOURCE_PAGE)
+        if version < SCHEMA_VERSION:
+            conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+    
+    @staticmethod
+    def dumps(record):
+        return RecordStore.pack(JSON_ENCODER.encode(record).encode('utf-8'))
+    
+    @staticmethod
+    def pack(data):
+        # Small records, like imported catalog rows, cost more time to compress than they save
+        if len(data) < 1024:
+            return data
+        return zlib.compress(data)
+    
+    @staticmethod
+    def loads(data):
+        if data[:1] != b'{':
+            data = zlib.decompress(data)
+        return json.loads(data.decode('utf-8'))
+    
+    def get(self, barcode, parser_version, source=None):
+        """
+        Return (record, fetched time), or (None, None) if there is no record for barcode, from source if it is given.
+        """
+        where, params = ('', ()) if source is None else (' AND source=?', (source,))
+        with self._lock:
+            row = self.conn.execute('SELECT fetched, data FROM records WHERE barcode=? AND parser_version=?' + where,
+                                    (barcode, parser_version) + params).fetchone()
+        if row is None:
+            return None, None
+        return self.loads(row[1]), row[0]
+    
+    def iter_records(self, parser_version):
+        for barcode, fetched, source, data in self.iter_rows(parser_version):
+            yield self.loads(data)
+    
+    def iter_rows(self, parser_version):
+        """
+        Yield (barcode, fetched, source, data) for every record of parser_version, data as stored.
+        """
+        # A connection of its own, so that the store can be streamed while records are being written
+        self.conn  # make sure the database exists
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            for row in conn.execute('SELECT barcode, fetched, source, data FROM records WHERE parser_version=?',
+                                    (parser_version,)):
+                yield row
+        finally:
+            conn.close()
+    
+    def put(self, barcode, parser_version, record, fetched=None, source=SOURCE_PAGE):
+        with self._lock:
+            conn = self.conn
+            conn.execute('INSERT OR REPLACE INTO records (barcode, parser_version, fetched, data, source) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (barcode, parser_version, fetched or time.time(), self.dumps(record), source))
+            # Records of older parsers can never be read again
+            conn.execute('DELETE FROM records WHERE barcode=? AND parser_version<>?', (barcode, parser_version))
+            conn.commit()
+            self._puts += 1
+            if self.max_records and self._puts % PRUNE_EVERY == 0:
+                self._prune(self.max_records)
+    
+    def put_many(self, parser_version, records, fetched=None, source=SOURCE_PAGE):
+        """
+        Store many records in a single transaction, like put. fetched is the time of every record,
+        or a list of the time of each record.
+        """
+        records = list(records)
+        if not isinstance(fetched, (list, tuple)):
+            fetched = repeat(fetched or time.time())
+        dumps = self.dumps
+        with self._lock:
+            conn = self.conn
+            conn.executemany('INSERT OR REPLACE INTO records (barcode, parser_version, fetched, data, source) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             ((r['id'], parser_version, t, dumps(r), source) for r, t in zip(records, fetched)))
+            conn.executemany('DELETE FROM records WHERE barcode=? AND parser_version<>?',
+                             ((r['id'], parser_version) for r in records))
+            conn.commit()
+    
+    def merge_rows(self, parser_version, rows):
+        """
+        Store (barcode, fetched, source, data) rows in a single transaction, data already dumped.
+        A row only replaces a stored record that was fetched earlier, and never replaces a record
+        parsed from a kyobobook page with an imported one. Returns the number of rows written.
+        """
+        with self._lock:
+            conn = self.conn
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT INTO records (barcode, parser_version, fetched, data, source) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (barcode, parser_version) DO UPDATE SET '
+                'fetched=excluded.fetched, data=excluded.data, source=excluded.source '
+                'WHERE excluded.fetched > records.fetched AND NOT (records.source=? AND excluded.source<>?)',
+                ((barcode, parser_version, fetched, data, source, SOURCE_PAGE, SOURCE_PAGE)
+                 for barcode, fetched, source, data in rows))
+            conn.commit()
+            return conn.total_changes - before
+    
+    def count(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+    
+    def prune(self, max_records=None):
+        """
+        Drop the records fetched longest ago until at most max_records are left.
+        Returns the number of records dropped.
+        """
+        with self._lock:
+            return self._prune(max_records or self.max_records)
+    
+    def _prune(self, max_records):
+        if not max_records:
+            return 0
+        conn = self.conn
+        excess = conn.execute('SELECT COUNT(*) FROM records').fetchone()[0] - max_records
+        if excess <= 0:
+            return 0
+        conn.execute('DELETE FROM records WHERE rowid IN (SELECT rowid FROM records ORDER BY fetched LIMIT ?)',
+                     (excess,))
+        conn.commit()
+        return excess
+    
+    def clear(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute('DELETE FROM records')
+            conn.commit()
+    
+    def covers(self, barcodes):
+        """
+        Return the cover urls of the records of barcodes parsed from a details page, by any parser,
+        as a dict by barcode. Those covers were checked when the page was downloaded.
+        """
+        found = {}
+        barcodes = list(barcodes)
+        with self._lock:
+            conn = self.conn
+            for i in range(0, len(barcodes), 500):
+                chunk = barcodes[i:i + 500]
+                for barcode, data in conn.execute(
+                        'SELECT barcode, data FROM records WHERE source=? AND barcode IN (%s) ORDER BY parser_version'
+                        % ','.join('?' * len(chunk)), [SOURCE_PAGE] + chunk):
+                    cover = self.loads(data).get('cover')
+                    if cover:
+                        found[barcode] = cover
+        return found
+    
+    def page_barcodes(self, barcodes, parser_version):
+        """
+        Return those of barcodes whose record was parsed from a kyobobook details page,
+        all of them if barcodes is None.
+        """
+        return self.stored_barcodes(barcodes, parser_version, source=SOURCE_PAGE)
+    
+    def stored_barcodes(self, barcodes, parser_version, source=None):
+        """
+        Return those of barcodes that have a record, from source if it is given. All of them if barcodes is None.
+        """
+        found = set()
+        where, params = ('', []) if source is None else (' AND source=?', [source])
+        with self._lock:
+            conn = self.conn
+            if barcodes is None:
+                found.update(r[0] for r in conn.execute(
+                    'SELECT barcode FROM records WHERE parser_version=?' + where, [parser_version] + params))
+                return found
+            barcodes = list(barcodes)
+            for i in range(0, len(barcodes), 500):
+                chunk = barcodes[i:i + 500]
+                found.update(r[0] for r in conn.execute(
+                    'SELECT barcode FROM records WHERE parser_version=?%s AND barcode IN (%s)'
+                    % (where, ','.join('?' * len(chunk))), [parser_version] + params + chunk))
+        return found
+
+
+class Revalidator(object):
+    """
+    Refreshes stale cache entries in background threads.
+    A refresh for a key that is already pending is not queued again.
+    """
+    
+    def __init__(self, num_threads=2):
+        self.num_threads = num_threads
+        self._queue = Queue()
+        self._pending = set()
+        self._lock = Lock()
+        self._threads = []
+    
+    def submit(self, key, func):
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            if not self._threads:
+                for i in range(self.num_threads):
+                    t = Thread(target=self._run, name='KyoboBook revalidator %d' % i)
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+        self._queue.put((key, func))
+        return True
+    
+    def _run(self):
+        from calibre.utils.logging import default_log
+        while True:
+            key, func = self._queue.get()
+            try:
+                func()
+            except Exception:
+                default_log.exception('Failed to refresh cached entry: %r' % (key,))
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+# Shared by all identify calls in this process
+metadata_cache = MetadataCache()
+record_store = RecordStore(os.path.join(config_dir, 'plugins', 'KyoboBook', 'cache.sqlite'))
+revalidator = Revalidator()
+
+
+def configure_caches():
+    """
+    Apply the cache size limits and expiry times of the plugin preferences.
+    """
+    import calibre_plugins.kyobobook.config as cfg
+    from calibre_plugins.kyobobook.archive import page_archive
+    c = cfg.plugin_prefs[cfg.STORE_NAME]
+    
+    def pref(key):
+        return c.get(key, cfg.DEFAULT_STORE_VALUES[key])
+    
+    metadata_cache.configure(ttls={LAYER_SEARCH: pref(cfg.KEY_SEARCH_TTL_HOURS) * 60 * 60,
+                                   LAYER_DETAIL: pref(cfg.KEY_DETAIL_TTL_DAYS) * 24 * 60 * 60},
+                             max_entries=pref(cfg.KEY_CACHE_MAX_ENTRIES))
+    # 0 is no limit
+    record_store.max_records = pref(cfg.KEY_STORE_MAX_RECORDS) or None
+    page_archive.max_pages = pref(cfg.KEY_ARCHIVE_MAX_PAGES) or None
+
+
+def export_snapshot(log, path, store=None):
+    """
+    Write every stored record of the current parser to a gzip compressed snapshot file:
+    a JSON header line, then one "barcode TAB fetched TAB source TAB record JSON" line per record.
+    Returns the number of records written.
+    """
+    from calibre_plugins.kyobobook.worker import PARSER_VERSION
+    store = store or record_store
+    start = time.time()
+    count = 0
+    with gzip.open(path, 'wb', compresslevel=6) as f:
+        f.write(json.dumps({'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                            'parser_version': PARSER_VERSION, 'exported': time.time()}).encode('utf-8') + b'\n')
+        for barcode, fetched, source, data in store.iter_rows(PARSER_VERSION):
+            if data[:1] != b'{':
+                data = zlib.decompress(data)
+            # json.dumps escapes tabs and newlines, a record is always a single line
+            f.write(b'\t'.join((barcode.encode('ascii'), repr(fetched).encode('ascii'), source.encode('ascii'),
+                                bytes(data))) + b'\n')
+            count += 1
+    log.info('Exported %d records to %s in %.1f seconds' % (count, path, time.time() - start))
+    return count
+
+
+def import_snapshot(log, path, batch_size=5000, store=None, index=None):
+    """
+    Load a snapshot written by export_snapshot into the record store and the catalog index,
+    streaming it in batches. Stored records fetched later than their snapshot copy are kept.
+    Returns (records read, records written).
+    """
+    from calibre_plugins.kyobobook.index import catalog_index
+    from calibre_plugins.kyobobook.worker import PARSER_VERSION
+    store = store or record_store
+    index = index or catalog_index
+    
+    start = time.time()
+    read = written = 0
+    with gzip.open(path, 'rb') as f:
+        header = json.loads(f.readline().decode('utf-8') or '{}')
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Not a kyobobook cache snapshot: %s' % path)
+        if header['parser_version'] != PARSER_VERSION:
+            # Records of another parser can never be read
+            log.error('Snapshot %s was made by parser version %s, this plugin uses %s, nothing imported' % (
+                path, header['parser_version'], PARSER_VERSION))
+            return 0, 0
+        
+        pack = store.pack
+        index.begin_bulk()
+        try:
+            rows, books = [], []
+            for line in f:
+                barcode, fetched, source, data = line.rstrip(b'\n').split(b'\t', 3)
+                record = json.loads(data.decode('utf-8'))
+                rows.append((barcode.decode('ascii'), float(fetched), source.decode('ascii'), pack(data)))
+                books.append((record['id'], record['title'], [a[0] for a in record['authors']],
+                              record.get('publisher'), record.get('series')))
+                if len(rows) >= batch_size:
+                    written += store.merge_rows(PARSER_VERSION, rows)
+                    index.add_many(books)
+                    read += len(rows)
+                    rows, books = [], []
+                    log.info('Imported %d snapshot records (%.0f/s)' % (read, read / max(time.time() - start, 0.001)))
+            written += store.merge_rows(PARSER_VERSION, rows)
+            index.add_many(books)
+            read += len(rows)
+        finally:
+            index.end_bulk()
+    store.prune()
+    log.info('Imported %d snapshot records, %d written, in %.1f seconds' % (read, written, time.time() - start))
+    return read, written
+
+
+if __name__ == '__main__':
+    # calibre-debug -e cache.py -- export|import <snapshot.gz>
+    import sys
+    from calibre.utils.logging import default_log
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == 'export':
+        export_snapshot(default_log, args[1])
+    elif len(args) == 2 and args[0] == 'import':
+        configure_caches()
+        import_snapshot(default_log, args[1])
+    else:
+        print('Usage: calibre-debug -e cache.py -- export <snapshot.gz>')
+        print('       calibre-debug -e cache.py -- import <snapshot.gz>')
+        raise SystemExit(1)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import os
+import re
+import json
+import time
+import random
+import socket
+import hashlib
+import threading
+from email.message import Message
+
+from six.moves.urllib.error import HTTPError, URLError
+
+from calibre_plugins.kyobobook.metrics import failure_kind
+
+"""
+[ 참고 ]============================================================
+* 교보문고와 주고받은 요청/응답(URL, 헤더, 상태, 본문, 걸린 시간)을 cassette 디렉터리에 녹화하고 나중에 그대로 재생한다.
+  녹화 : KYOBOBOOK_CASSETTE=record:/tmp/cassette calibre-debug -g
+  재생 : KYOBOBOOK_CASSETTE=replay:/tmp/cassette (가능한 빨리, rate limit 없이)
+         KYOBOBOOK_CASSETTE=replay-timed:/tmp/cassette (녹화할 때 걸린 시간대로)
+* 같은 URL 을 여러 번 요청하면 녹화된 순서대로 응답한다. 녹화되지 않은 URL 은 URLError 가 난다.
+* 표지 확인(parse_cover)은 HEAD 요청으로 녹화한다. HEAD 녹화가 없는 예전 cassette 는 같은 URL 의 GET 녹화로 대답한다.
+* 장애 흉내 : KYOBOBOOK_FAULTS='timeout=0.05,404=0.02,truncate=0.05,trickle=0.1,seed=1'
+  timeout, 404, 500, 503 : 그 비율만큼 요청이 실패한다. (timeout 은 timeout 만큼 기다린 뒤)
+  truncate : 본문이 절반에서 잘린다. trickle : 본문이 trickle_rate(bytes/s, 기본 16384) 속도로 온다.
+  url : 이 정규식에 맞는 URL 에만 장애를 낸다.
+  어느 요청에 장애가 날지는 seed, URL, 그 URL 의 몇 번째 요청인지로만 정해지므로 매번 같다.
+"""
+
+CASSETTE_ENV = 'KYOBOBOOK_CASSETTE'
+FAULTS_ENV = 'KYOBOBOOK_FAULTS'
+
+REQUESTS_FILE = 'requests.jsonl'
+BODIES_DIR = 'bodies'
+
+FAULTS = ('timeout', '404', '500', '503', 'truncate', 'trickle')
+
+
+def header_items(response):
+    # [[name, value], ...] of a response or an HTTPError, which may have no headers
+    info = getattr(response, 'info', None)
+    headers = info() if callable(info) else None
+    return [list(h) for h in headers.items()] if headers is not None else []
+
+
+def make_headers(items):
+    # Case insensitive like the headers of a mechanize response
+    headers = Message()
+    for name, value in items:
+        headers[name] = value
+    return headers
+
+
+class ReplayResponse(object):
+    """
+    A response served from memory, with the interface of the browser's responses used by the plugin.
+    """
+    
+    def __init__(self, url, status, headers, body, read_seconds=0, trickle_rate=None):
+        self.url, self.code = url, status
+        self.headers = make_headers(headers)
+        self._body = io.BytesIO(body)
+        self._read_seconds = read_seconds
+        self._trickle_rate = trickle_rate
+    
+    def read(self, size=-1):
+        data = self._body.read(size)
+        delay = self._read_seconds
+        self._read_seconds = 0
+        if self._trickle_rate:
+            delay += len(data) / self._trickle_rate
+        if delay > 0:
+            time.sleep(delay)
+        return data
+    
+    def info(self):
+        return self.headers
+    
+    def geturl(self):
+        return self.url
+    
+    def getcode(self):
+        return self.code
+    
+    def close(self):
+        pass
+
+
+def replay_error(url, error):
+    """
+    The exception the browser would have raised for a recorded or injected error.
+    """
+    if error['type'] == 'timeout':
+        return URLError(socket.timeout('timed out'))
+    if error['type'] == 'http':
+        return HTTPError(url, error['code'], error.get('message') or 'HTTP Error %d' % error['code'],
+                         make_headers(error.get('headers') or []), io.BytesIO(error.get('body') or b''))
+    return URLError(error.get('message') or 'error')
+
+
+class Recorder(object):
+    """
+    Sends every request through transport and writes the request and its response into directory.
+    """
+    
+    def __init__(self, directory, transport):
+        self.directory = directory
+        self.transport = transport
+        self.paced = transport.paced
+        self._lock = threading.Lock()
+        self._counts = {}
+        bodies = os.path.join(directory, BODIES_DIR)
+        if not os.path.exists(bodies):
+            os.makedirs(bodies)
+    
+    def _save_body(self, body):
+        digest = hashlib.sha1(body).hexdigest()
+        path = os.path.join(self.directory, BODIES_DIR, digest)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(body)
+        return digest
+    
+    def _write(self, entry):
+        with self._lock:
+            with open(os.path.join(self.directory, REQUESTS_FILE), 'ab') as f:
+                f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+    
+    def _next(self, url, head):
+        with self._lock:
+            n = self._counts[(url, head)] = self._counts.get((url, head), 0) + 1
+        return n
+    
+    def open(self, br, url, timeout, head=False):
+        n = self._next(url, head)
+        entry = {'url': url, 'n': n, 'time': time.time(),
+                 'request_headers': [list(h) for h in getattr(br, 'addheaders', None) or []]}
+        if head:
+            entry['head'] = True
+        start = time.perf_counter()
+        try:
+            response = self.transport.open(br, url, timeout, head=head)
+        except Exception as e:
+            entry['elapsed'] = time.perf_counter() - start
+            kind = failure_kind(e)
+            code = getattr(e, 'code', None)
+            if isinstance(code, int):
+                body = b''
+                try:
+                    body = e.read()
+                except Exception:
+                    pass
+                entry['error'] = {'type': 'http', 'code': code, 'message': str(getattr(e, 'msg', '') or ''),
+                                  'headers': header_items(e),
+                                  'body': self._save_body(body)}
+            else:
+                entry['error'] = {'type': 'timeout' if kind == 'timeout' else 'error', 'message': str(e)}
+            self._write(entry)
+            raise
+        entry['elapsed'] = time.perf_counter() - start
+        # The whole body is read now, the transport may have sent a GET for a head request
+        start = time.perf_counter()
+        body = response.read()
+        entry['read'] = time.perf_counter() - start
+        headers = header_items(response)
+        status = response.getcode() if callable(getattr(response, 'getcode', None)) else 200
+        entry.update({'status': status, 'headers': headers, 'body': self._save_body(body)})
+        self._write(entry)
+        return ReplayResponse(url, status, headers, body)
+
+
+class Player(object):
+    """
+    Answers every request from a directory written by Recorder, as fast as possible
+    or, when timed, taking as long as when it was recorded.
+    The n-th request of a url gets the n-th recorded response of that url,
+    head requests are counted apart from the others.
+    """
+    
+    def __init__(self, directory, timed=False):
+        self.directory = directory
+        self.timed = timed
+        # Replaying as fast as possible does not need to spare kyobobook
+        self.paced = timed
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._entries = {}  # (url, head) -> [entry, ...] in the order they were recorded
+        with open(os.path.join(directory, REQUESTS_FILE), 'rb') as f:
+            for line in f:
+                entry = json.loads(line.decode('utf-8'))
+                self._entries.setdefault((entry['url'], entry.get('head', False)), []).append(entry)
+        for entries in self._entries.values():
+            entries.sort(key=lambda e: e['n'])
+    
+    def _body(self, digest):
+        with open(os.path.join(self.directory, BODIES_DIR, digest), 'rb') as f:
+            return f.read()
+    
+    def open(self, br, url, timeout, head=False):
+        if head and (url, True) not in self._entries:
+            # Recorded before head requests were sent, the headers of a GET will do
+            head = False
+        entries = self._entries.get((url, head))
+        if not entries:
+            raise URLError('Not in the cassette: %s' % url)
+        with self._lock:
+            n = self._counts[(url, head)] = self._counts.get((url, head), 0) + 1
+        # Requests made more often than when recording get the last response again
+        entry = entries[min(n, len(entries)) - 1]
+        error = entry.get('error')
+        if self.timed:
+            elapsed = entry.get('elapsed', 0)
+            if timeout and elapsed > timeout:
+                time.sleep(timeout)
+                raise replay_error(url, {'type': 'timeout'})
+            time.sleep(elapsed)
+        if error is not None:
+            if error.get('body'):
+                error = dict(error, body=self._body(error['body']))
+            raise replay_error(url, error)
+        return ReplayResponse(url, entry['status'], entry['headers'], self._body(entry['body']),
+                              read_seconds=entry.get('read', 0) if self.timed else 0)
+
+
+def parse_faults(spec):
+    """
+    Parse 'timeout=0.05,404=0.02,trickle=0.1,trickle_rate=8192,seed=1,url=detail' into a dict.
+    """
+    faults = {'seed': 0, 'trickle_rate': 16384, 'url': None}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name == 'url':
+            faults['url'] = re.compile(value)
+        elif name == 'seed':
+            faults['seed'] = int(value)
+        elif name == 'trickle_rate':
+            faults['trickle_rate'] = float(value)
+        elif name in FAULTS:
+            faults[name] = float(value)
+        else:
+            raise ValueError('Unknown fault %r, expected one of %s' % (name, ', '.join(FAULTS)))
+    return faults
+
+
+class FaultInjector(object):
+    """
+    Makes some of the requests sent through transport fail, or their bodies truncated or slow.
+    Which request gets which fault only depends on the seed, the url and how many times the url
+    was requested before, so a run can be repeated exactly.
+    """
+    
+    def __init__(self, transport, faults):
+        self.transport = transport
+        self.paced = transport.paced
+        self.faults = parse_faults(faults) if isinstance(faults, str) else faults
+        self._lock = threading.Lock()
+        self._counts = {}
+    
+    def choose(self, url):
+        """
+        Return the fault of the next request of url, or None.
+        """
+        with self._lock:
+            n = self._counts[url] = self._counts.get(url, 0) + 1
+        pattern = self.faults.get('url')
+        if pattern is not None and not pattern.search(url):
+            return None
+        seed = int(hashlib.sha1(('%s %s %d' % (self.faults['seed'], url, n)).encode('utf-8')).hexdigest()[:12], 16)
+        roll = random.Random(seed).random()
+        for fault in FAULTS:
+            probability = self.faults.get(fault) or 0
+            if roll < probability:
+                return fault
+            roll -= probability
+        return None
+    
+    def open(self, br, url, timeout, head=False):
+        fault = self.choose(url)
+        if fault == 'timeout':
+            time.sleep(timeout or 0)
+            raise replay_error(url, {'type': 'timeout'})
+        if fault in ('404', '500', '503'):
+            raise replay_error(url, {'type': 'http', 'code': int(fault)})
+        response = self.transport.open(br, url, timeout, head=head)
+        if fault is None:
+            return response
+        body = response.read()
+        if fault == 'truncate':
+            body = body[:len(body) // 2]
+        headers = header_items(response)
+        status = response.getcode() if callable(getattr(response, 'getcode', None)) else 200
+        return ReplayResponse(url, status, headers, body,
+                              trickle_rate=self.faults['trickle_rate'] if fault == 'trickle' else None)
+
+
+def from_environ(transport):
+    """
+    Wrap transport as asked for by the KYOBOBOOK_CASSETTE and KYOBOBOOK_FAULTS environment variables.
+    """
+    cassette = os.environ.get(CASSETTE_ENV)
+    if cassette:
+        mode, _, directory = cassette.partition(':')
+        if mode == 'record':
+            transport = Recorder(directory, transport)
+        elif mode in ('replay', 'replay-timed'):
+            transport = Player(directory, timed=mode == 'replay-timed')
+        else:
+            raise ValueError('%s must be record:<dir>, replay:<dir> or replay-timed:<dir>' % CASSETTE_ENV)
+    faults = os.environ.get(FAULTS_ENV)
+    if faults:
+        transport = FaultInjector(transport, faults)
+    return transport
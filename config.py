@@ -9,6 +9,7 @@ __copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com> ' \
 __docformat__ = 'restructuredtext en'
 
 import copy
+import time
 from functools import partial
 
 # 20141108 16:27:50
@@ -21,17 +22,20 @@ except ImportError:
     from PyQt5 import QtGui
 try:
     from PyQt4.Qt import (QLabel, QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
-                          QCheckBox, QAbstractItemView, QHBoxLayout, QIcon, QInputDialog)
+                          QCheckBox, QAbstractItemView, QHBoxLayout, QIcon, QInputDialog, QPushButton,
+                          QGridLayout, QApplication)
 except ImportError:
     from PyQt5.Qt import (QLabel, QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
-                          QCheckBox, QAbstractItemView, QHBoxLayout, QIcon, QInputDialog)
+                          QCheckBox, QAbstractItemView, QHBoxLayout, QIcon, QInputDialog, QPushButton,
+                          QGridLayout, QApplication)
 
 try:
     from PyQt4.QtGui import (QSpinBox)
 except ImportError:
     from PyQt5.Qt import (QSpinBox)
 
-from calibre.gui2 import get_current_db, question_dialog, error_dialog
+from calibre.gui2 import (get_current_db, question_dialog, error_dialog, info_dialog,
+                          choose_files, choose_save_file)
 
 # 20141108
 # from calibre.gui2.complete import MultiCompleteLineEdit
@@ -46,12 +50,32 @@ KEY_MAX_DOWNLOADS = 'maxDownloads'
 KEY_GET_CATEGORY = 'getCategory'
 KEY_GET_ALL_AUTHORS = 'getAllAuthors'
 KEY_APPEND_TOC = 'appendTOC'
+KEY_STALE_WHILE_REVALIDATE = 'staleWhileRevalidate'
+KEY_ARCHIVE_PAGES = 'archivePages'
+KEY_SEARCH_TTL_HOURS = 'searchTTLHours'
+KEY_DETAIL_TTL_DAYS = 'detailTTLDays'
+KEY_CACHE_MAX_ENTRIES = 'cacheMaxEntries'
+KEY_STORE_MAX_RECORDS = 'storeMaxRecords'
+KEY_ARCHIVE_MAX_PAGES = 'archiveMaxPages'
+KEY_HEDGE_REQUESTS = 'hedgeRequests'
+KEY_ASYNC_ENGINE = 'asyncEngine'
+KEY_SPECULATIVE_SEARCH = 'speculativeSearch'
 
 DEFAULT_STORE_VALUES = {
     KEY_MAX_DOWNLOADS: 5,
     KEY_GET_CATEGORY: True,
     KEY_GET_ALL_AUTHORS: False,
-    KEY_APPEND_TOC: True
+    KEY_APPEND_TOC: True,
+    KEY_STALE_WHILE_REVALIDATE: False,
+    KEY_ARCHIVE_PAGES: False,
+    KEY_SEARCH_TTL_HOURS: 24,
+    KEY_DETAIL_TTL_DAYS: 7,
+    KEY_CACHE_MAX_ENTRIES: 5000,
+    KEY_STORE_MAX_RECORDS: 0,  # no limit
+    KEY_ARCHIVE_MAX_PAGES: 2000,  # 0 is no limit
+    KEY_HEDGE_REQUESTS: False,
+    KEY_ASYNC_ENGINE: False,
+    KEY_SPECULATIVE_SEARCH: False
 }
 
 # This is where all preferences for this plugin will be stored
@@ -126,6 +150,220 @@ class ConfigWidget(DefaultConfigWidget):
         self.toc_checkbox.setChecked(c.get(KEY_APPEND_TOC, DEFAULT_STORE_VALUES[KEY_APPEND_TOC]))
         # other_group_box_layout.addWidget(self.toc_checkbox, 2, 0, 1, 3)
         other_group_box_layout.addWidget(self.toc_checkbox)
+        
+        self.swr_checkbox = QCheckBox('Use expired cached results and refresh them in the background', self)
+        self.swr_checkbox.setToolTip(
+            'Books already looked up are returned from the cache at once even when\n'
+            'the cached copy has expired. The expired copy is then refreshed from\n'
+            'Kyobobook in the background and used for the next lookup.')
+        self.swr_checkbox.setChecked(
+            c.get(KEY_STALE_WHILE_REVALIDATE, DEFAULT_STORE_VALUES[KEY_STALE_WHILE_REVALIDATE]))
+        other_group_box_layout.addWidget(self.swr_checkbox)
+        
+        self.archive_checkbox = QCheckBox('Keep a compressed copy of every downloaded Kyobobook page', self)
+        self.archive_checkbox.setToolTip(
+            'Archived pages can be parsed again without downloading them when the\n'
+            'Kyobobook website changes and the plugin is updated for it.\n'
+            'Only the most recent pages are kept, see Archived pages kept on disk.')
+        self.archive_checkbox.setChecked(c.get(KEY_ARCHIVE_PAGES, DEFAULT_STORE_VALUES[KEY_ARCHIVE_PAGES]))
+        other_group_box_layout.addWidget(self.archive_checkbox)
+        
+        self.hedge_checkbox = QCheckBox('Send a second request when a Kyobobook page is slower than usual', self)
+        self.hedge_checkbox.setToolTip(
+            'When a search or book page takes longer than 95% of the recent ones,\n'
+            'the same page is requested again and whichever answer arrives first\n'
+            'is used. This cuts the wait for the occasional very slow page at the\n'
+            'cost of about 5% more requests. See Hedged requests in the metrics.')
+        self.hedge_checkbox.setChecked(c.get(KEY_HEDGE_REQUESTS, DEFAULT_STORE_VALUES[KEY_HEDGE_REQUESTS]))
+        other_group_box_layout.addWidget(self.hedge_checkbox)
+        
+        self.async_checkbox = QCheckBox('Download with one event loop instead of a thread per book', self)
+        self.async_checkbox.setToolTip(
+            'The search, the book pages and the cover checks are coroutines of an asyncio\n'
+            'event loop running in a single thread. Their requests are sent by a few more\n'
+            'threads and parsed by two more.\n'
+            'Useful when many books are downloaded at the same time.')
+        self.async_checkbox.setChecked(c.get(KEY_ASYNC_ENGINE, DEFAULT_STORE_VALUES[KEY_ASYNC_ENGINE]))
+        other_group_box_layout.addWidget(self.async_checkbox)
+        
+        self.speculative_checkbox = QCheckBox('Search by title and author at the same time as by ISBN', self)
+        self.speculative_checkbox.setToolTip(
+            'When a book has an ISBN, a title and authors, the title and author search\n'
+            'is sent together with the ISBN search instead of after it, and is used\n'
+            'only if nothing is found by ISBN. Books unknown by their ISBN are found\n'
+            'sooner, at the cost of one more search request for every book.')
+        self.speculative_checkbox.setChecked(
+            c.get(KEY_SPECULATIVE_SEARCH, DEFAULT_STORE_VALUES[KEY_SPECULATIVE_SEARCH]))
+        other_group_box_layout.addWidget(self.speculative_checkbox)
+        
+        cache_group_box = QGroupBox('Cache', self)
+        cache_group_box.setToolTip(
+            'Kyobobook search results and book details are kept so that books\n'
+            'already looked up are not downloaded again until they expire.\n'
+            'A snapshot of the stored book details can be exported here and\n'
+            'imported on another computer instead of downloading them again.')
+        self.l.addWidget(cache_group_box, self.l.rowCount(), 0, 1, 2)
+        cache_group_box_layout = QVBoxLayout()
+        cache_group_box.setLayout(cache_group_box_layout)
+        
+        cache_limits_layout = QGridLayout()
+        cache_group_box_layout.addLayout(cache_limits_layout)
+        self.search_ttl_spin = self._add_cache_spin(
+            cache_limits_layout, 'Search results expire after (hours):', 1, 24 * 365,
+            c.get(KEY_SEARCH_TTL_HOURS, DEFAULT_STORE_VALUES[KEY_SEARCH_TTL_HOURS]))
+        self.detail_ttl_spin = self._add_cache_spin(
+            cache_limits_layout, 'Book details expire after (days):', 1, 3650,
+            c.get(KEY_DETAIL_TTL_DAYS, DEFAULT_STORE_VALUES[KEY_DETAIL_TTL_DAYS]))
+        self.cache_max_entries_spin = self._add_cache_spin(
+            cache_limits_layout, 'Entries kept in memory:', 100, 1000000,
+            c.get(KEY_CACHE_MAX_ENTRIES, DEFAULT_STORE_VALUES[KEY_CACHE_MAX_ENTRIES]))
+        self.store_max_records_spin = self._add_cache_spin(
+            cache_limits_layout, 'Book details kept on disk:', 0, 100000000,
+            c.get(KEY_STORE_MAX_RECORDS, DEFAULT_STORE_VALUES[KEY_STORE_MAX_RECORDS]), 'No limit')
+        self.archive_max_pages_spin = self._add_cache_spin(
+            cache_limits_layout, 'Archived pages kept on disk:', 0, 100000000,
+            c.get(KEY_ARCHIVE_MAX_PAGES, DEFAULT_STORE_VALUES[KEY_ARCHIVE_MAX_PAGES]), 'No limit')
+        
+        self.cache_label = QLabel(self)
+        cache_group_box_layout.addWidget(self.cache_label)
+        
+        clear_buttons_layout = QHBoxLayout()
+        cache_group_box_layout.addLayout(clear_buttons_layout)
+        for text, layer in (('Clear search results', 'search'), ('Clear book details', 'detail'),
+                            ('Clear index', 'index'), ('Clear page archive', 'archive')):
+            button = QPushButton(text, self)
+            button.clicked.connect(partial(self.clear_cache, layer))
+            clear_buttons_layout.addWidget(button)
+        clear_buttons_layout.addStretch(1)
+        
+        snapshot_buttons_layout = QHBoxLayout()
+        cache_group_box_layout.addLayout(snapshot_buttons_layout)
+        export_button = QPushButton('Export snapshot...', self)
+        export_button.clicked.connect(self.export_snapshot)
+        snapshot_buttons_layout.addWidget(export_button)
+        import_button = QPushButton('Import snapshot...', self)
+        import_button.clicked.connect(self.import_snapshot)
+        snapshot_buttons_layout.addWidget(import_button)
+        snapshot_buttons_layout.addStretch(1)
+        self.refresh_cache_sizes()
+        
+        metrics_group_box = QGroupBox('Metrics', self)
+        metrics_group_box.setToolTip(
+            'Cache lookups and Kyobobook requests of the metadata downloads made\n'
+            'by this calibre process, since calibre started or Reset was pressed.\n'
+            'Latency is the time until Kyobobook starts answering.')
+        self.l.addWidget(metrics_group_box, self.l.rowCount(), 0, 1, 2)
+        metrics_group_box_layout = QVBoxLayout()
+        metrics_group_box.setLayout(metrics_group_box_layout)
+        
+        self.metrics_label = QLabel(self)
+        self.metrics_label.setTextFormat(Qt.RichText)
+        self.metrics_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        metrics_group_box_layout.addWidget(self.metrics_label)
+        
+        metrics_buttons_layout = QHBoxLayout()
+        metrics_group_box_layout.addLayout(metrics_buttons_layout)
+        refresh_button = QPushButton('Refresh', self)
+        refresh_button.clicked.connect(self.refresh_metrics)
+        metrics_buttons_layout.addWidget(refresh_button)
+        reset_button = QPushButton('Reset', self)
+        reset_button.clicked.connect(self.reset_metrics)
+        metrics_buttons_layout.addWidget(reset_button)
+        metrics_buttons_layout.addStretch(1)
+        self.refresh_metrics()
+    
+    def _add_cache_spin(self, layout, text, minimum, maximum, value, special=None):
+        row = layout.rowCount()
+        layout.addWidget(QLabel(text, self), row, 0)
+        spin = QSpinBox(self)
+        spin.setMinimum(minimum)
+        spin.setMaximum(maximum)
+        if special:
+            # Shown instead of the minimum
+            spin.setSpecialValueText(special)
+        spin.setProperty('value', value)
+        layout.addWidget(spin, row, 1)
+        return spin
+    
+    def refresh_cache_sizes(self):
+        from calibre_plugins.kyobobook.cache import metadata_cache, record_store
+        from calibre_plugins.kyobobook.index import catalog_index
+        from calibre_plugins.kyobobook.archive import page_archive
+        try:
+            self.cache_label.setText(
+                'In memory: %d, book details on disk: %d, indexed books: %d, archived pages: %d' % (
+                    metadata_cache.count(), record_store.count(), catalog_index.count(), page_archive.count()))
+        except Exception as e:
+            self.cache_label.setText('Could not read the cache: %s' % e)
+    
+    def clear_cache(self, layer):
+        from calibre_plugins.kyobobook.cache import metadata_cache, record_store, LAYER_SEARCH, LAYER_DETAIL
+        from calibre_plugins.kyobobook.index import catalog_index
+        from calibre_plugins.kyobobook.archive import page_archive
+        names = {'search': 'cached search results', 'detail': 'cached and stored book details',
+                 'index': 'local search index', 'archive': 'archived Kyobobook pages'}
+        if not question_dialog(self, 'Clear cache', 'Remove all %s?' % names[layer]):
+            return
+        if layer == 'search':
+            metadata_cache.clear(LAYER_SEARCH)
+        elif layer == 'detail':
+            metadata_cache.clear(LAYER_DETAIL)
+            record_store.clear()
+        elif layer == 'index':
+            catalog_index.clear()
+        elif layer == 'archive':
+            page_archive.clear()
+        self.refresh_cache_sizes()
+    
+    def export_snapshot(self):
+        from calibre.utils.logging import default_log
+        from calibre_plugins.kyobobook.cache import export_snapshot
+        path = choose_save_file(self, 'kyobobook-cache-snapshot', 'Export cache snapshot',
+                                filters=[('Cache snapshot', ['gz'])], all_files=False,
+                                initial_filename='kyobobook-cache.gz')
+        if not path:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            count = export_snapshot(default_log, path)
+        except Exception as e:
+            import traceback
+            QApplication.restoreOverrideCursor()
+            return error_dialog(self, 'Export failed', 'Could not export the cache snapshot: %s' % e,
+                                det_msg=traceback.format_exc(), show=True)
+        QApplication.restoreOverrideCursor()
+        info_dialog(self, 'Export cache snapshot', 'Exported %d book details to %s' % (count, path), show=True)
+    
+    def import_snapshot(self):
+        from calibre.utils.logging import default_log
+        from calibre_plugins.kyobobook.cache import import_snapshot
+        paths = choose_files(self, 'kyobobook-cache-snapshot', 'Import cache snapshot',
+                             filters=[('Cache snapshot', ['gz'])], all_files=False, select_only_single_file=True)
+        if not paths:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            read, written = import_snapshot(default_log, paths[0])
+        except Exception as e:
+            import traceback
+            QApplication.restoreOverrideCursor()
+            return error_dialog(self, 'Import failed', 'Could not import the cache snapshot: %s' % e,
+                                det_msg=traceback.format_exc(), show=True)
+        QApplication.restoreOverrideCursor()
+        self.refresh_cache_sizes()
+        info_dialog(self, 'Import cache snapshot',
+                    'Read %d book details, %d of them were newer than the ones already stored' % (read, written),
+                    show=True)
+    
+    def refresh_metrics(self):
+        from calibre_plugins.kyobobook.metrics import metrics
+        from calibre_plugins.kyobobook.ratelimit import concurrency_limiter
+        self.metrics_label.setText(format_metrics(metrics.snapshot(), concurrency_limiter.snapshot()))
+    
+    def reset_metrics(self):
+        from calibre_plugins.kyobobook.metrics import metrics
+        metrics.reset()
+        self.refresh_metrics()
     
     def commit(self):
         DefaultConfigWidget.commit(self)
@@ -135,5 +373,59 @@ class ConfigWidget(DefaultConfigWidget):
         new_prefs[KEY_GET_CATEGORY] = self.get_category_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GET_ALL_AUTHORS] = self.all_authors_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_APPEND_TOC] = self.toc_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_STALE_WHILE_REVALIDATE] = self.swr_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_ARCHIVE_PAGES] = self.archive_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_HEDGE_REQUESTS] = self.hedge_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_ASYNC_ENGINE] = self.async_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_SPECULATIVE_SEARCH] = self.speculative_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_SEARCH_TTL_HOURS] = int(self.search_ttl_spin.value())
+        new_prefs[KEY_DETAIL_TTL_DAYS] = int(self.detail_ttl_spin.value())
+        new_prefs[KEY_CACHE_MAX_ENTRIES] = int(self.cache_max_entries_spin.value())
+        new_prefs[KEY_STORE_MAX_RECORDS] = int(self.store_max_records_spin.value())
+        new_prefs[KEY_ARCHIVE_MAX_PAGES] = int(self.archive_max_pages_spin.value())
         
         plugin_prefs[STORE_NAME] = new_prefs
+        
+        from calibre_plugins.kyobobook.cache import configure_caches
+        configure_caches()
+
+
+def format_metrics(snapshot, limits=None):
+    """
+    HTML tables of a metrics snapshot for the metrics group box.
+    limits is the snapshot of the concurrency limiter, host -> {'limit', 'in_flight', 'latency'}.
+    """
+    def ms(seconds):
+        return '-' if seconds is None else '%.0f ms' % (seconds * 1000)
+    
+    rows = ['<tr><th align="left">Cache</th><th>Hits</th><th>Misses</th><th>Hit rate</th></tr>']
+    for layer, c in snapshot['cache'].items():
+        rate = '-' if c['hit_rate'] is None else '%.0f%%' % (c['hit_rate'] * 100)
+        rows.append('<tr><td>%s</td><td align="right">%d</td><td align="right">%d</td><td align="right">%s</td></tr>'
+                    % (layer, c['hits'], c['misses'], rate))
+    rows.append('<tr><th align="left">Requests</th><th>Count</th><th>Mean / p95</th><th>Downloaded</th></tr>')
+    for kind, f in snapshot['fetches'].items():
+        rows.append('<tr><td>%s</td><td align="right">%d</td><td align="right">%s / %s</td>'
+                    '<td align="right">%.1f KB</td></tr>' % (kind, f['count'], ms(f['mean']), ms(f['p95']),
+                                                             f['bytes'] / 1024))
+    if limits:
+        rows.append('<tr><th align="left">Host</th><th>Connections</th><th>In flight</th><th>Usual latency</th></tr>')
+        for host, l in sorted(limits.items()):
+            rows.append('<tr><td>%s</td><td align="right">%d</td><td align="right">%d</td><td align="right">%s</td></tr>'
+                        % (host, l['limit'], l['in_flight'], ms(l['latency'])))
+    failures = snapshot['failures']
+    return ('<table cellspacing="4">%s</table>'
+            '<p>Errors: %d, timeouts: %d, throttled by Kyobobook: %d, '
+            'waits for the request rate limit: %d (%.1f s)<br>'
+            'Retries: %d, skipped while Kyobobook was failing: %d<br>'
+            'Hedged requests: %s<br>'
+            'Connections opened: %d, reused: %d, opened ahead: %d<br>'
+            'Title and author searches alongside ISBN: %d sent, %d used<br>Since %s</p>' % (
+                ''.join(rows), failures['error'], failures['timeout'], failures['throttled'],
+                snapshot['rate_limited'], snapshot['rate_limited_seconds'], snapshot['retries'], snapshot['skipped'],
+                ', '.join('%s %d sent, %d answered first' % (kind, h['fired'], h['won'])
+                          for kind, h in snapshot['hedges'].items()),
+                snapshot['connections']['opened'], snapshot['connections']['reused'],
+                snapshot['connections']['warmed'],
+                snapshot['speculations']['started'], snapshot['speculations']['used'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['since']))))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from threading import Event
+
+"""
+[ 참고 ]============================================================
+* identify 하나에 주어진 시간(timeout)과 abort 를 Worker 스레드들까지 함께 쓴다.
+* 요청마다 timeout 대신 남은 시간을 쓰므로, 검색 → 책 페이지 → 표지 확인으로 갈수록 줄어든다.
+* abort 되거나 시간이 다 되면 다음 요청을 보내기 전에 Cancelled 가 나고 Worker 는 바로 끝난다.
+* child() 는 남은 시간과 abort 는 같이 쓰면서 따로 cancel() 할 수 있는 Deadline 이다(speculation.py).
+"""
+
+
+class Cancelled(Exception):
+    """
+    Raised instead of sending a request once the identify was aborted or ran out of time.
+    """
+
+
+class Deadline(object):
+    """
+    The time left for one identify or cover download, and its abort event.
+    """
+    
+    def __init__(self, timeout=None, abort=None):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout if timeout else None
+        self.abort = abort if abort is not None else Event()
+        self.parent = None
+    
+    def child(self):
+        """
+        A deadline with the same time left, cancelled with this one but also on its own by cancel().
+        """
+        child = Deadline(abort=Event())
+        child.timeout, child.expires = self.timeout, self.expires
+        child.parent = self
+        return child
+    
+    def cancel(self):
+        # Only for a child, the abort of an identify belongs to calibre
+        self.abort.set()
+    
+    def aborted(self):
+        return self.abort.is_set() or (self.parent is not None and self.parent.aborted())
+    
+    def remaining(self):
+        """
+        Seconds left, None if there is no time limit.
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+    
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+    
+    def cancelled(self):
+        return self.aborted() or self.expired()
+    
+    def check(self):
+        if self.aborted():
+            raise Cancelled('Aborted')
+        if self.expired():
+            raise Cancelled('No time left of %s seconds' % self.timeout)
+    
+    def timeout_for(self, timeout=None):
+        """
+        The timeout of the next request: timeout, but no more than the time left.
+        Raises Cancelled if there is nothing left.
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+    
+    def sleep(self, seconds):
+        """
+        Sleep for seconds, waking up as soon as the identify is aborted or out of time.
+        Returns False if it was.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self._wait(remaining)
+            return False
+        return not self._wait(seconds)
+    
+    def _wait(self, seconds):
+        # True if aborted within seconds
+        if self.parent is None:
+            return self.abort.wait(seconds)
+        end = time.monotonic() + seconds
+        while not self.aborted():
+            left = end - time.monotonic()
+            if left <= 0:
+                return False
+            # The abort of the parent does not wake this one up
+            self.abort.wait(min(left, 0.1))
+        return True
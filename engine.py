@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import asyncio
+import concurrent.futures
+from threading import Thread, Lock
+
+from calibre_plugins.kyobobook.transport import open_url
+from calibre_plugins.kyobobook.ratelimit import MAX_CONCURRENCY
+from calibre_plugins.kyobobook.pool import POOL_SIZES
+from calibre_plugins.kyobobook.cassette import ReplayResponse, header_items
+from calibre_plugins.kyobobook.resilience import CircuitOpen
+from calibre_plugins.kyobobook.deadline import Cancelled
+
+"""
+[ 참고 ]============================================================
+* 설정의 'Download with one event loop ...' 를 켜면 identify 가 Worker 스레드 대신 이 엔진을 쓴다.
+  identify(log, result_queue, abort, ...) 는 그대로이고 결과도 같은 result_queue 로 간다.
+* 검색, 책 페이지, 표지 확인은 전용 스레드 하나에서 도는 asyncio 이벤트 루프의 코루틴이다.
+  페이지 파싱, 캐시와 저장소는 PARSE_THREADS 개의 스레드에서 한다.
+* 요청은 IO_THREADS 개까지의 스레드에서 transport.open_url 로 보낸다. deadline, circuit breaker, 재시도,
+  ConcurrencyLimiter, RateLimiter, hedging, 연결 pool 은 스레드 방식과 같은 코드를 쓴다.
+  IO_THREADS 는 ConcurrencyLimiter 가 세 호스트에 한꺼번에 보낼 수 있는 최대 요청 수라서 동시 요청 수는
+  이 executor 가 아니라 호스트별 limit 이 정한다. 스레드는 필요할 때만 만든다.
+  요청이 수천 개라도 IO_THREADS 개를 넘는 요청은 스레드 없이 코루틴으로 차례를 기다린다.
+"""
+
+PARSE_THREADS = 2
+# The most requests ConcurrencyLimiter can let through to the search, www and image hosts at once,
+# so that its limits and not the executor bound the requests in flight. Threads are only started when needed
+IO_THREADS = MAX_CONCURRENCY * len(POOL_SIZES)
+# How often the thread waiting for run checks whether the identify was aborted
+POLL_INTERVAL = 0.2
+
+
+class AsyncEngine(object):
+    """
+    Runs the workers of identify calls as coroutines of one event loop, in a thread of its own.
+    Requests are sent by an executor of io_threads threads, parsing is done by one of parse_threads.
+    """
+    
+    def __init__(self, parse_threads=PARSE_THREADS, io_threads=IO_THREADS):
+        self.parse_threads, self.io_threads = parse_threads, io_threads
+        self.parse_executor = self.io_executor = None
+        self._lock = Lock()
+        self._loop = None
+    
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self.parse_executor = concurrent.futures.ThreadPoolExecutor(
+                    self.parse_threads, thread_name_prefix='KyoboBook parse')
+                self.io_executor = concurrent.futures.ThreadPoolExecutor(
+                    self.io_threads, thread_name_prefix='KyoboBook io')
+                loop = asyncio.new_event_loop()
+                t = Thread(target=loop.run_forever, name='KyoboBook asyncio')
+                t.daemon = True
+                t.start()
+                self._loop = loop
+            return self._loop
+    
+    def run(self, coro, deadline=None):
+        """
+        Run coro on the event loop and wait for its result in the calling thread.
+        It is cancelled once deadline is aborted or out of time, and Cancelled is raised.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._start())
+        while True:
+            try:
+                return future.result(POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if deadline is not None and deadline.cancelled():
+                    future.cancel()
+                    deadline.check()
+    
+    async def parse(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.parse_executor, fn, *args)
+    
+    # Identify
+    
+    async def search(self, plugin, log, br, query, isbn, title, authors, timeout, timer, deadline):
+        """
+        The coroutine of Kyobobook._search.
+        """
+        start = time.perf_counter()
+        response = await self.open_url(br, query, timeout, deadline, hedge=True)
+        timer.add('search_fetch', time.perf_counter() - start)
+        raw = response.read().strip()
+        return await self.parse(plugin.parse_search_page, log, query, raw, isbn, title, authors, timeout, timer)
+    
+    async def details(self, workers):
+        """
+        Get the details of every worker (see Worker.get_details) at the same time, without starting their threads.
+        """
+        await asyncio.gather(*[self._details(w) for w in workers])
+    
+    async def _details(self, w):
+        try:
+            await self._get_details(w)
+        except CircuitOpen as e:
+            w.log.error('Skipped getting details, %s: %r' % (e, w.url))
+        except Cancelled as e:
+            w.log.info('Stopped getting details (%s): %r' % (e, w.url))
+        except Exception as e:
+            w.log.exception('get_details failed for url: %r' % w.url, exc_info=e)
+    
+    async def _get_details(self, w):
+        if w.use_cache and await self.parse(w.lookup_cache):
+            return
+        
+        start = time.perf_counter()
+        try:
+            raw = (await self.open_url(w.browser, w.url, w.timeout, w.deadline, hedge=True)).read().strip()
+        except Cancelled:
+            raise
+        except Exception as e:
+            w.fetch_failed(e)
+            await self.parse(w.use_imported_record)
+            return
+        w.timer.add('detail_fetch', time.perf_counter() - start)
+        
+        record, candidates = await self.parse(w.parse_fetched, raw)
+        if record is None:
+            return
+        record['cover'] = await self._check_cover(w, candidates)
+        await self.parse(w.save_record, record)
+    
+    async def _check_cover(self, w, candidates):
+        # The coroutine of Worker.parse_cover
+        for img_url, size in candidates:
+            w.deadline.check()
+            start = time.perf_counter()
+            try:
+                info = (await self.open_url(w.browser, img_url, w.timeout, w.deadline, head=True)).info()
+            except Cancelled:
+                raise
+            except Exception as e:
+                w.log.warning('Failed to check image(%s) for url: %s (%s)' % (size, img_url, e))
+                continue
+            w.timer.add('cover_probe', time.perf_counter() - start)
+            if w.cover_ok(img_url, size, info):
+                return img_url
+    
+    # Requests
+    
+    async def open_url(self, br, url, timeout, deadline=None, hedge=False, head=False):
+        """
+        The coroutine of transport.open_url. The response is read completely, with head only its headers.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.io_executor, self._open_url, br, url, timeout, deadline, hedge, head)
+    
+    def _open_url(self, br, url, timeout, deadline, hedge, head):
+        # Runs in an io thread, the response is read there so that its connection is released there too
+        response = open_url(br, url, timeout, deadline, hedge=hedge, head=head)
+        try:
+            body = b'' if head else response.read()
+            status = response.getcode() if callable(getattr(response, 'getcode', None)) else 200
+            return ReplayResponse(url, status, header_items(response), body)
+        finally:
+            close = getattr(response, 'close', None)
+            if callable(close):
+                close()
+
+
+# Shared by all identify calls in this process
+async_engine = AsyncEngine()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+
+from calibre_plugins.kyobobook.deadline import Deadline
+from calibre_plugins.kyobobook.metrics import metrics, fetch_kind
+from calibre_plugins.kyobobook.cassette import ReplayResponse, header_items
+
+"""
+[ 참고 ]============================================================
+* 검색 페이지나 책 페이지가 평소(최근 요청들의 p95)보다 늦으면 같은 요청을 하나 더 보내고 먼저 끝난 쪽을 쓴다.
+  늦게 끝난 쪽은 응답을 닫아서 더 읽지 않고 연결(동시 요청 수 제한)을 돌려준다. 재시도 중이면 더 보내지 않는다.
+* 두 번째 요청도 rate limit 을 지킨다. 설정의 'Send a second request ...' 로 켠다. 기본값은 꺼져 있다.
+* 몇 번 보냈고(fired) 몇 번 이겼는지(won)는 설정 화면의 Metrics 에 나온다.
+"""
+
+HEDGE_KINDS = ('search', 'detail')
+
+# Until enough fetches were timed, hedge after DEFAULT_DELAY seconds
+MIN_SAMPLES = 20
+DEFAULT_DELAY = 2.0
+# Never hedge sooner than this, however fast kyobobook usually is
+MIN_DELAY = 0.2
+
+
+def hedging_enabled():
+    import calibre_plugins.kyobobook.config as cfg
+    return cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_HEDGE_REQUESTS, False)
+
+
+def _close(response):
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+class _Race(object):
+    """
+    The attempts of one hedged request. Once it is over, the responses still being read are closed.
+    """
+    
+    def __init__(self):
+        # Set once a response won, so that the other attempt sends no more retries
+        self.done = Event()
+        self._lock = Lock()
+        self._reading = {}
+    
+    def reading(self, n, response):
+        """
+        Returns False, after closing response, if the race is already over.
+        """
+        with self._lock:
+            if not self.done.is_set():
+                self._reading[n] = response
+                return True
+        _close(response)
+        return False
+    
+    def read(self, n):
+        with self._lock:
+            self._reading.pop(n, None)
+    
+    def end(self):
+        with self._lock:
+            self.done.set()
+            losers = list(self._reading.values())
+            self._reading.clear()
+        for response in losers:
+            _close(response)
+
+
+class Hedger(object):
+    """
+    Sends a second copy of a slow request and returns whichever response arrives first.
+    The delay before the second copy is the percentile of the recent fetch times of the same kind.
+    """
+    
+    def __init__(self, percentile=95, samples=500):
+        self.percentile = percentile
+        self._lock = Lock()
+        self._durations = dict((kind, deque(maxlen=samples)) for kind in HEDGE_KINDS)
+    
+    def record(self, kind, seconds):
+        with self._lock:
+            self._durations[kind].append(seconds)
+    
+    def delay(self, kind):
+        with self._lock:
+            durations = sorted(self._durations[kind])
+        if len(durations) < MIN_SAMPLES:
+            return DEFAULT_DELAY
+        return max(MIN_DELAY, durations[min(len(durations) - 1, int(len(durations) * self.percentile / 100))])
+    
+    def _attempt(self, results, n, race, fetch, br, url, timeout, deadline, kind):
+        start = time.perf_counter()
+        try:
+            response = fetch(br, url, timeout, deadline)
+            if not race.reading(n, response):
+                return
+            try:
+                body = response.read()
+            finally:
+                race.read(n)
+            status = response.getcode() if callable(getattr(response, 'getcode', None)) else 200
+            response = ReplayResponse(url, status, header_items(response), body)
+        except BaseException as e:
+            results.put((n, None, e))
+            return
+        # Slow attempts that lost are timed too, the delay follows how fast kyobobook answers
+        self.record(kind, time.perf_counter() - start)
+        results.put((n, response, None))
+    
+    def _start(self, results, n, race, fetch, br, url, timeout, deadline, kind):
+        t = Thread(target=self._attempt, args=(results, n, race, fetch, br, url, timeout, deadline, kind),
+                   name='KyoboBook hedge %d' % n)
+        t.daemon = True
+        t.start()
+    
+    def open(self, br, url, timeout, deadline, fetch):
+        """
+        fetch(br, url, timeout, deadline) the url, a second time with a clone of br if the first
+        is slower than usual. The response is read completely before it is returned,
+        the one that lost is closed.
+        """
+        kind = fetch_kind(url)
+        if deadline is not None:
+            deadline.check()
+        race = _Race()
+        remaining = deadline.remaining() if deadline is not None else None
+        attempt_deadline = Deadline(remaining, race.done)
+        results = Queue()
+        self._start(results, 0, race, fetch, br, url, timeout, attempt_deadline, kind)
+        hedge_at = time.perf_counter() + self.delay(kind)
+        pending, hedged, errors = 1, False, []
+        try:
+            while True:
+                if deadline is not None:
+                    deadline.check()
+                wait = 0.1 if hedged else min(0.1, max(0.0, hedge_at - time.perf_counter()))
+                try:
+                    n, response, error = results.get(timeout=wait)
+                except Empty:
+                    if not hedged and time.perf_counter() >= hedge_at:
+                        hedged = True
+                        pending += 1
+                        metrics.hedge_fired(kind)
+                        self._start(results, 1, race, fetch, br.clone_browser(), url, timeout, attempt_deadline, kind)
+                    continue
+                pending -= 1
+                if error is None:
+                    if n == 1:
+                        metrics.hedge_won(kind)
+                    return response
+                errors.append(error)
+                if not pending:
+                    raise errors[0]
+        finally:
+            race.end()
+
+
+# Shared by all identify calls in this process
+hedger = Hedger()
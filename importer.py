@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import re
+import sys
+import csv
+import time
+from functools import lru_cache
+from operator import itemgetter
+
+from calibre.ebooks.metadata import check_isbn
+
+"""
+[ 참고 ]============================================================
+* 도서 유통 쪽에서 받은 교보문고 카탈로그(CSV/TSV)를 레코드 저장소와 색인에 넣는다.
+  calibre-debug -e importer.py -- import catalog.csv [encoding]
+  calibre-debug -e importer.py -- bench [rows]
+* 파일은 chunk 단위로 읽어서 쓰기 때문에 파일이 커져도 메모리 사용량은 일정하다.
+* 교보문고 책 페이지에서 가져온 레코드는 덮어쓰지 않는다.
+* 가져온 레코드에는 책 소개가 없고 표지 주소는 확인되지 않았다. identify 는 ISBN 이나 색인으로 찾은 책에
+  이 레코드를 네트워크 없이 바로 돌려주고(partial), 책 페이지는 백그라운드에서 받아 레코드를 채운다.
+* bulk 처럼 전체 레코드가 필요한 경우에는 책 페이지를 받는다.
+"""
+
+FIELDS = ('isbn', 'title', 'authors', 'publisher', 'pubdate', 'category')
+
+# Header names (lower cased) accepted for each field
+COLUMNS = {
+    'isbn': ('isbn', 'isbn13', 'barcode', '바코드', '상품코드'),
+    'title': ('title', '도서명', '상품명', '제목'),
+    'authors': ('author', 'authors', '저자', '지은이'),
+    'publisher': ('publisher', '출판사'),
+    'pubdate': ('pubdate', 'date', 'published', '출판일', '발행일', '출간일'),
+    'category': ('category', 'categories', '분류', '카테고리'),
+}
+
+AUTHOR_SPLIT_PAT = re.compile(r'\s*[,;|/]\s*')
+PUBDATE_PAT = re.compile(r'(\d{4})\D?(\d{1,2})?\D?(\d{1,2})?')
+CATEGORY_SPLIT_PAT = re.compile(r'\s*>\s*')
+ISBN_CLEAN_PAT = re.compile(r'[^0-9Xx]')
+
+# 2016-02-04 : http://image.kyobobook.co.kr/images/book/xlarge/196/x9788994909196.jpg
+COVER_URL = 'http://image.kyobobook.co.kr/images/book/%s/%s/%s%s.jpg'
+
+# Weighted digit sums of every 3 digit string, for the ISBN-13 weights 1, 3, 1, 3, ...
+WEIGHTS_131 = {'%03d' % i: i // 100 + i // 10 % 10 * 3 + i % 10 for i in range(1000)}
+WEIGHTS_313 = {'%03d' % i: i // 100 * 3 + i // 10 % 10 + i % 10 * 3 for i in range(1000)}
+
+
+def to_barcode(isbn):
+    """
+    Kyobobook barcodes are the 13 digit ISBN. Returns None for an invalid ISBN.
+    """
+    isbn = isbn or ''
+    if not (len(isbn) == 13 and isbn.isascii() and isbn.isdigit()):
+        isbn = ISBN_CLEAN_PAT.sub('', isbn).upper()
+    if len(isbn) == 10:
+        if check_isbn(isbn) is None:
+            return None
+        isbn = '978' + isbn[:9]
+        return isbn + str(_check_digit(isbn))
+    if len(isbn) == 13 and isbn.isdigit():
+        if _check_digit(isbn) == int(isbn[12]):
+            return isbn
+    return None
+
+
+def _check_digit(isbn):
+    # ISBN-13 check digit of the first 12 digits
+    return -(WEIGHTS_131[isbn[0:3]] + WEIGHTS_313[isbn[3:6]] + WEIGHTS_131[isbn[6:9]] + WEIGHTS_313[isbn[9:12]]) % 10
+
+
+def _column_map(header):
+    # Index of each field in FIELDS order, fields missing from the header get the index just past the header
+    header = [h.strip().lower() for h in header]
+    found = []
+    for field in FIELDS:
+        found.append(next((i for i, h in enumerate(header) if h in COLUMNS[field]), len(header)))
+    missing = [f for f, i in zip(FIELDS, found) if f in ('isbn', 'title') and i == len(header)]
+    if missing:
+        raise ValueError('Catalog file has no %s column, header: %r' % (' or '.join(missing), header))
+    return found
+
+
+@lru_cache(maxsize=4096)
+def _categories(category):
+    if not category:
+        return []
+    return ['▣' + '.'.join(CATEGORY_SPLIT_PAT.split(category))]
+
+
+@lru_cache(maxsize=65536)
+def _author_names(authors):
+    return tuple(a for a in AUTHOR_SPLIT_PAT.split(authors) if a)
+
+
+@lru_cache(maxsize=4096)
+def _pubdate(pubdate):
+    match = PUBDATE_PAT.match(pubdate)
+    if not match:
+        return None
+    return '%s-%02d-%02d' % (match.group(1), int(match.group(2) or 1), int(match.group(3) or 1))
+
+
+def row_to_record(fields):
+    """
+    Build a parsed-record (see Worker.parse_record) from the FIELDS of one catalog row, or None if it is unusable.
+    """
+    isbn, title, authors, publisher, pubdate, category = map(str.strip, fields)
+    barcode = to_barcode(isbn)
+    if not barcode or not title:
+        return None
+    
+    return {
+        'id': barcode, 'title': title, 'series': None, 'series_index': None,
+        'authors': [[a, ''] for a in _author_names(authors)],
+        'isbn': barcode, 'rating': None, 'description': '', 'toc': '',
+        'cover': None, 'cover_candidates': _cover_candidates(barcode), 'categories': _categories(category),
+        'publisher': publisher or None, 'pubdate': _pubdate(pubdate), 'language': None,
+    }
+
+
+def _cover_candidates(barcode):
+    # The image urls of a details page follow the barcode, see Worker.cover_candidates.
+    # Nobody checked them yet, the worker that fetches the details page does.
+    return [[COVER_URL % ('xlarge', barcode[-3:], 'x', barcode), 'Large'],
+            [COVER_URL % ('large', barcode[-3:], 'l', barcode), 'small']]
+
+
+def iter_chunks(stream, chunk_size=10000, delimiter=None):
+    """
+    Yield lists of records read from a text stream of CSV or TSV lines.
+    """
+    first = stream.readline()
+    if delimiter is None:
+        delimiter = '\t' if '\t' in first else ','
+    header = next(csv.reader([first], delimiter=delimiter))
+    fields = itemgetter(*_column_map(header))
+    width = len(header) + 1
+    chunk = []
+    for row in csv.reader(stream, delimiter=delimiter):
+        if len(row) < width:
+            # Missing columns and the fields missing from short rows read as empty
+            row += [''] * (width - len(row))
+        record = row_to_record(fields(row))
+        if record is not None:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_stream(log, stream, chunk_size=10000, delimiter=None, store=None, index=None):
+    """
+    Import a catalog export into the record store and the catalog index.
+    Returns (records imported, records skipped because a kyobobook page was already parsed for them).
+    """
+    from calibre_plugins.kyobobook.cache import record_store, SOURCE_IMPORT
+    from calibre_plugins.kyobobook.index import catalog_index
+    from calibre_plugins.kyobobook.worker import PARSER_VERSION
+    store = store or record_store
+    index = index or catalog_index
+    
+    start = time.time()
+    imported = skipped = 0
+    index.begin_bulk()
+    try:
+        for chunk in iter_chunks(stream, chunk_size=chunk_size, delimiter=delimiter):
+            parsed = store.page_barcodes([r['id'] for r in chunk], PARSER_VERSION)
+            if parsed:
+                kept = [r for r in chunk if r['id'] not in parsed]
+                skipped += len(chunk) - len(kept)
+                chunk = kept
+            store.put_many(PARSER_VERSION, chunk, source=SOURCE_IMPORT)
+            index.add_many((r['id'], r['title'], [a[0] for a in r['authors']], r['publisher'], None) for r in chunk)
+            imported += len(chunk)
+            log.info('Imported %d catalog records (%.0f/s)' % (imported, imported / max(time.time() - start, 0.001)))
+    finally:
+        index.end_bulk()
+    log.info('Imported %d catalog records, skipped %d, in %.1f seconds' % (imported, skipped, time.time() - start))
+    return imported, skipped
+
+
+def import_file(log, path, encoding='utf-8-sig', **kw):
+    with io.open(path, 'r', encoding=encoding, newline='') as stream:
+        return import_stream(log, stream, **kw)
+
+
+def benchmark(log, rows=1000000):
+    """
+    Import a generated catalog of rows lines into a throwaway store and index and report the throughput.
+    """
+    import os
+    import shutil
+    import tempfile
+    from calibre_plugins.kyobobook.cache import RecordStore
+    from calibre_plugins.kyobobook.index import CatalogIndex
+    
+    class Lines(object):
+        # File like object generating the catalog on the fly, so that it is not held in memory
+        def __init__(self):
+            self.lines = self._lines()
+        
+        def _lines(self):
+            yield 'ISBN\tTitle\tAuthor\tPublisher\tPubDate\tCategory\n'
+            for i in range(rows):
+                isbn = '979119%06d' % i
+                yield '%s%d\t나의 문화유산답사기 %d\t유홍준, 저자%d\t창비\t2011-05-%02d\t국내도서 > 역사 > 한국사\n' % (
+                    isbn, _check_digit(isbn), i, i % 5000, i % 28 + 1)
+        
+        def readline(self):
+            return next(self.lines, '')
+        
+        def __iter__(self):
+            return self.lines
+    
+    tdir = tempfile.mkdtemp(prefix='kyobobook-import-bench-')
+    try:
+        start = time.time()
+        imported, skipped = import_stream(log, Lines(), store=RecordStore(os.path.join(tdir, 'cache.sqlite')),
+                                          index=CatalogIndex(os.path.join(tdir, 'index.sqlite')))
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+    log.info('Benchmark: %d rows in %.1f seconds, %.0f rows/s' % (imported, elapsed, imported / elapsed))
+    return imported, elapsed
+
+
+if __name__ == '__main__':
+    from calibre.utils.logging import default_log
+    args = sys.argv[1:]
+    if len(args) >= 2 and args[0] == 'import':
+        import_file(default_log, args[1], encoding=args[2] if len(args) > 2 else 'utf-8-sig')
+    elif args and args[0] == 'bench':
+        benchmark(default_log, int(args[1]) if len(args) > 1 else 1000000)
+    else:
+        print('Usage: calibre-debug -e importer.py -- import <catalog.csv|tsv> [encoding]')
+        print('       calibre-debug -e importer.py -- bench [rows]')
+        raise SystemExit(1)
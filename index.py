@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import json
+import sqlite3
+import unicodedata
+from functools import lru_cache
+from operator import add
+from threading import Lock
+
+from calibre.utils.config import config_dir
+
+"""
+[ 참고 ]============================================================
+* 한글은 띄어쓰기와 조사 때문에 단어 단위로 색인하면 잘 찾아지지 않는다.
+  ("답사기를" 로는 "답사기" 를 찾을 수 없다.) 그래서 한글 단어는 두 글자씩
+  겹쳐 자른(bigram) 토큰으로 색인하고, 검색어도 같은 방법으로 자른다.
+* 색인을 다시 만들려면 : calibre-debug -e index.py -- rebuild
+"""
+
+WORD_PAT = re.compile(r'\w+', re.UNICODE)
+HANGUL_PAT = re.compile('[가-힣]')
+NORMALIZE_PAT = re.compile(r'[\W_]+', re.UNICODE)
+
+# Shared by all index writes, json.dumps with arguments builds a new encoder on every call
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+
+def tokenize(text):
+    """
+    Split text into index tokens: Hangul words become overlapping bigrams,
+    every other word is kept whole and lower cased.
+    """
+    if not text:
+        return []
+    if not unicodedata.is_normalized('NFC', text):
+        text = unicodedata.normalize('NFC', text)
+    tokens = []
+    append = tokens.append
+    for word in WORD_PAT.findall(text.lower()):
+        if len(word) > 1 and HANGUL_PAT.search(word):
+            # Every pair of neighbouring characters
+            tokens.extend(map(add, word, word[1:]))
+        else:
+            append(word)
+    return tokens
+
+
+@lru_cache(maxsize=65536)
+def index_text(text):
+    # Authors and publishers repeat a lot in bulk imports
+    return ' '.join(tokenize(text))
+
+
+def normalize(text):
+    return NORMALIZE_PAT.sub('', unicodedata.normalize('NFC', text or '').lower())
+
+
+def author_key(name):
+    # The same for "칼 세이건", "세이건, 칼" and "세이건 칼"
+    return ' '.join(sorted(WORD_PAT.findall(unicodedata.normalize('NFC', name or '').lower())))
+
+
+class CatalogIndex(object):
+    """
+    Full text index (SQLite FTS5) over the titles, authors, publishers and series
+    of every book the plugin knows about.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY, barcode TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL, authors TEXT NOT NULL, publisher TEXT, series TEXT,
+            t_title TEXT, t_authors TEXT, t_publisher TEXT, t_series TEXT);
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            t_title, t_authors, t_publisher, t_series, content='books', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS books_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, t_title, t_authors, t_publisher, t_series)
+            VALUES ('delete', old.id, old.t_title, old.t_authors, old.t_publisher, old.t_series);
+        END;
+    """
+    
+    # Dropped during bulk imports, see begin_bulk
+    TRIGGERS = """
+        CREATE TRIGGER IF NOT EXISTS books_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, t_title, t_authors, t_publisher, t_series)
+            VALUES (new.id, new.t_title, new.t_authors, new.t_publisher, new.t_series);
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_au AFTER UPDATE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, t_title, t_authors, t_publisher, t_series)
+            VALUES ('delete', old.id, old.t_title, old.t_authors, old.t_publisher, old.t_series);
+            INSERT INTO books_fts (rowid, t_title, t_authors, t_publisher, t_series)
+            VALUES (new.id, new.t_title, new.t_authors, new.t_publisher, new.t_series);
+        END;
+    """
+    
+    UPSERT = ('INSERT INTO books (barcode, title, authors, publisher, series, t_title, t_authors, t_publisher, t_series) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (barcode) DO UPDATE SET '
+              'title=excluded.title, authors=excluded.authors, publisher=excluded.publisher, series=excluded.series, '
+              't_title=excluded.t_title, t_authors=excluded.t_authors, t_publisher=excluded.t_publisher, '
+              't_series=excluded.t_series')
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = None
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Without a sync on every commit, with WAL a power failure can only lose the last commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # t_* hold the tokenized text, books_fts indexes them as external content
+            conn.executescript(self.SCHEMA)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='books_ai'").fetchone() is None:
+                # An interrupted bulk import left the full text index out of date
+                conn.executescript(self.TRIGGERS)
+                conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def _row(barcode, title, authors, publisher=None, series=None):
+        return (barcode, title, JSON_ENCODER.encode(authors), publisher, series,
+                ' '.join(tokenize(title)), index_text(' '.join(authors)), index_text(publisher), index_text(series))
+    
+    def add(self, barcode, title, authors, publisher=None, series=None):
+        with self._lock:
+            conn = self.conn
+            conn.execute(self.UPSERT, self._row(barcode, title, authors, publisher, series))
+            conn.commit()
+    
+    def has(self, barcode):
+        with self._lock:
+            return self.conn.execute('SELECT 1 FROM books WHERE barcode=?', (barcode,)).fetchone() is not None
+    
+    def add_record(self, record):
+        self.add(record['id'], record['title'], [a[0] for a in record['authors']],
+                 record.get('publisher'), record.get('series'))
+    
+    def add_many(self, rows):
+        """
+        Index (barcode, title, authors, publisher, series) rows in a single transaction.
+        """
+        with self._lock:
+            conn = self.conn
+            conn.executemany(self.UPSERT, (self._row(*row) for row in rows))
+            conn.commit()
+    
+    def begin_bulk(self):
+        """
+        Stop updating the full text index row by row, which is much slower than
+        rebuilding it once at the end. end_bulk must be called afterwards.
+        """
+        with self._lock:
+            self.conn.executescript('DROP TRIGGER IF EXISTS books_ai; DROP TRIGGER IF EXISTS books_au;')
+    
+    def end_bulk(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+            conn.executescript(self.TRIGGERS)
+            conn.commit()
+    
+    def count(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+    
+    def clear(self):
+        with self._lock:
+            conn = self.conn
+            # Emptying the full text index at once is faster than a delete per row through books_ad
+            conn.executescript("DROP TRIGGER IF EXISTS books_ad; DELETE FROM books; "
+                               "INSERT INTO books_fts (books_fts) VALUES ('delete-all');")
+            conn.executescript(self.SCHEMA)
+            conn.commit()
+    
+    @staticmethod
+    def _match_expr(column, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        return '%s:(%s)' % (column, ' AND '.join('"%s"' % t.replace('"', '""') for t in tokens))
+    
+    def find(self, title, authors=None, limit=5):
+        """
+        Return the barcodes of indexed books that confidently match title and authors,
+        best matches first. A match is confident when the titles are equal once spaces
+        and punctuation are ignored, and one of the authors is equal too, in any order of
+        the parts of the name. Without authors nothing is confident, another edition or
+        another volume of the same title is too likely.
+        """
+        wanted_title = normalize(title)
+        wanted_authors = set(author_key(a) for a in authors or []) - {''}
+        title_expr = self._match_expr('t_title', title)
+        if title_expr is None or not wanted_title or not wanted_authors:
+            return []
+        # Any one author is enough
+        author_exprs = [e for e in (self._match_expr('t_authors', a) for a in authors) if e]
+        expr = '%s AND (%s)' % (title_expr, ' OR '.join(author_exprs))
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT b.barcode, b.title, b.authors FROM books_fts JOIN books b ON b.id = books_fts.rowid '
+                'WHERE books_fts MATCH ? ORDER BY bm25(books_fts) LIMIT ?', (expr, limit * 4)).fetchall()
+        
+        found = []
+        for barcode, found_title, found_authors in rows:
+            if normalize(found_title) != wanted_title:
+                continue
+            if wanted_authors.isdisjoint(author_key(a) for a in json.loads(found_authors)):
+                continue
+            found.append(barcode)
+            if len(found) >= limit:
+                break
+        return found
+    
+    def rebuild(self, store, parser_version):
+        """
+        Index every record in the parsed-record store again.
+        """
+        count = 0
+        batch = []
+        for record in store.iter_records(parser_version):
+            batch.append((record['id'], record['title'], [a[0] for a in record['authors']],
+                          record.get('publisher'), record.get('series')))
+            if len(batch) >= 1000:
+                self.add_many(batch)
+                count += len(batch)
+                batch = []
+        self.add_many(batch)
+        return count + len(batch)
+
+
+def index_record(log, record):
+    try:
+        catalog_index.add_record(record)
+    except Exception as e:
+        log.exception('Failed to index record: %r' % record.get('id'), exc_info=e)
+
+
+catalog_index = CatalogIndex(os.path.join(config_dir, 'plugins', 'KyoboBook', 'index.sqlite'))
+
+
+if __name__ == '__main__':
+    # calibre-debug -e index.py -- rebuild
+    import sys
+    from calibre_plugins.kyobobook.cache import record_store
+    from calibre_plugins.kyobobook.worker import PARSER_VERSION
+    if sys.argv[1:] != ['rebuild']:
+        print('Usage: calibre-debug -e index.py -- rebuild')
+        raise SystemExit(1)
+    print('Indexed %d records' % catalog_index.rebuild(record_store, PARSER_VERSION))
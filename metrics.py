@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import socket
+from collections import deque, OrderedDict
+from threading import Lock
+
+from six.moves.urllib.parse import urlparse
+
+"""
+[ 참고 ]============================================================
+* 설정 화면의 Metrics 에 보여줄 값들. calibre 를 시작한 뒤부터(또는 Reset 한 뒤부터) 센다.
+* 캐시 : index(로컬 색인), search(검색 결과), detail(책 정보, 메모리+저장소), store(저장소)
+* 받기 : search(검색 페이지), detail(책 페이지), cover(표지 확인과 다운로드)
+"""
+
+CACHE_LAYERS = ('index', 'search', 'detail', 'store')
+FETCH_KINDS = ('search', 'detail', 'cover')
+
+
+def fetch_kind(url):
+    parts = urlparse(url)
+    if parts.netloc.startswith('search.'):
+        return 'search'
+    if parts.netloc.startswith('image.'):
+        return 'cover'
+    return 'detail'
+
+
+def failure_kind(e):
+    """
+    Classify a failed request as 'throttled' (429/503), 'timeout' or 'error'.
+    """
+    code = getattr(e, 'code', None)
+    if code in (429, 503):
+        return 'throttled'
+    reason = getattr(e, 'reason', None)
+    if isinstance(e, socket.timeout) or isinstance(reason, socket.timeout) or 'timed out' in str(e):
+        return 'timeout'
+    return 'error'
+
+
+class Metrics(object):
+    """
+    Counters of the cache lookups and requests made by the plugin in this process.
+    Latencies are kept for the last samples requests of each kind.
+    """
+    
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._lock = Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.cache = OrderedDict((layer, [0, 0]) for layer in CACHE_LAYERS)  # layer -> [hits, misses]
+            self.fetches = OrderedDict((kind, {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                                               'latencies': deque(maxlen=self.samples)})
+                                       for kind in FETCH_KINDS)
+            self.failures = OrderedDict((f, 0) for f in ('error', 'timeout', 'throttled'))
+            self.rate_limited = 0
+            self.rate_limited_seconds = 0.0
+            self.retries = 0
+            self.skipped = 0
+            self.hedges = OrderedDict((kind, [0, 0]) for kind in ('search', 'detail'))  # kind -> [fired, won]
+            self.connections = [0, 0, 0]  # [opened, reused, warmed]
+            self.speculations = [0, 0]  # [started, used]
+    
+    def cache_lookup(self, layer, hit):
+        with self._lock:
+            self.cache[layer][0 if hit else 1] += 1
+    
+    def fetched(self, kind, seconds):
+        with self._lock:
+            fetch = self.fetches[kind]
+            fetch['count'] += 1
+            fetch['seconds'] += seconds
+            fetch['latencies'].append(seconds)
+    
+    def received(self, kind, size):
+        with self._lock:
+            self.fetches[kind]['bytes'] += size
+    
+    def failed(self, failure):
+        with self._lock:
+            self.failures[failure] += 1
+    
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+    
+    def skipped_request(self):
+        # A request not sent because the circuit of its host was open
+        with self._lock:
+            self.skipped += 1
+    
+    def hedge_fired(self, kind):
+        with self._lock:
+            self.hedges[kind][0] += 1
+    
+    def hedge_won(self, kind):
+        # The second request answered first
+        with self._lock:
+            self.hedges[kind][1] += 1
+    
+    def speculation_started(self):
+        # A title and authors search started alongside an ISBN search, see speculation.py
+        with self._lock:
+            self.speculations[0] += 1
+    
+    def speculation_used(self):
+        # The ISBN search found nothing and the matches of the title and authors search were used
+        with self._lock:
+            self.speculations[1] += 1
+    
+    def connection(self, reused):
+        # A request sent over a new or a kept alive connection (see pool.py)
+        with self._lock:
+            self.connections[1 if reused else 0] += 1
+    
+    def warmed(self):
+        # A connection opened ahead of its first request
+        with self._lock:
+            self.connections[2] += 1
+    
+    def waited(self, seconds):
+        # Time a request waited for the rate limiter
+        with self._lock:
+            self.rate_limited += 1
+            self.rate_limited_seconds += seconds
+    
+    def snapshot(self):
+        with self._lock:
+            cache = OrderedDict()
+            for layer, (hits, misses) in self.cache.items():
+                cache[layer] = {'hits': hits, 'misses': misses,
+                                'hit_rate': hits / (hits + misses) if hits + misses else None}
+            fetches = OrderedDict()
+            for kind, fetch in self.fetches.items():
+                latencies = sorted(fetch['latencies'])
+                fetches[kind] = {
+                    'count': fetch['count'], 'bytes': fetch['bytes'],
+                    'mean': fetch['seconds'] / fetch['count'] if fetch['count'] else None,
+                    'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None}
+            return {'since': self.started, 'cache': cache, 'fetches': fetches, 'failures': dict(self.failures),
+                    'rate_limited': self.rate_limited, 'rate_limited_seconds': self.rate_limited_seconds,
+                    'retries': self.retries, 'skipped': self.skipped,
+                    'hedges': OrderedDict((kind, {'fired': fired, 'won': won})
+                                          for kind, (fired, won) in self.hedges.items()),
+                    'connections': {'opened': self.connections[0], 'reused': self.connections[1],
+                                    'warmed': self.connections[2]},
+                    'speculations': {'started': self.speculations[0], 'used': self.speculations[1]}}
+
+
+# Shared by all identify/cover calls in this process
+metrics = Metrics()
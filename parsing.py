@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+"""
+[ 참고 ]============================================================
+* bulk 작업(bulk.py)과 보관된 페이지 다시 파싱(archive.py reparse)에서 책 페이지 파싱을 여러 프로세스로 나눈다.
+  fromstring, parse_* 의 XPath 와 정규식은 스레드로 나누면 GIL 때문에 코어 하나만 쓴다.
+* 프로세스에는 받은 페이지(bytes)를 넘기고 record(dict)와 표지 후보 URL 만 돌려받는다.
+  Metadata 는 부모 프로세스에서 만들고, 표지 확인 요청도 부모에서 보낸다.
+* 기본값(processes=1)은 프로세스 없이 부른 스레드에서 파싱한다. 프로세스는 --processes 로 켜고 MAX_PROCESSES 개까지 쓴다.
+* Windows, macOS 는 프로세스를 spawn 으로 만들기 때문에 프로세스에서 플러그인을 import 하지 못할 수 있다.
+  프로세스가 죽으면(BrokenProcessPool) 경고를 남기고 그 뒤로는 부른 스레드에서 파싱한다.
+"""
+
+# Worker processes at most, each one holds its own copy of lxml and the plugin
+MAX_PROCESSES = 8
+
+
+def parse_details_page(url, raw):
+    """
+    Parse a downloaded details page without any network access.
+    Returns the record and its cover candidates (see Worker.cover_candidates), or (None, None).
+    """
+    from calibre.utils.logging import default_log
+    from calibre_plugins.kyobobook.worker import Worker
+    w = Worker(url, None, None, default_log, 0, None)
+    root = w.parse_page(raw)
+    if root is None:
+        return None, None
+    record = w.parse_record(root, check_cover=False)
+    if record is None:
+        return None, None
+    return record, w.cover_candidates(root)
+
+
+def _parse(page):
+    # Runs in a worker process
+    url, raw = page
+    record, candidates = parse_details_page(url, raw)
+    return url, record, candidates
+
+
+class ParsePool(object):
+    """
+    Parses details pages in the calling thread, or in processes worker processes (at most MAX_PROCESSES
+    and the number of cores). Every page gives (url, record, cover candidates), record is None if the page
+    could not be parsed. Once the worker processes fail the pages are parsed in the calling thread.
+    """
+    
+    def __init__(self, log, processes=1):
+        self.log = log
+        self.processes = max(1, min(processes or 1, MAX_PROCESSES, os.cpu_count() or 1))
+        self._lock = Lock()
+        self._executor = None if self.processes == 1 else ProcessPoolExecutor(max_workers=self.processes)
+    
+    def _broken(self, e):
+        # The worker processes died or could not import the plugin, see the note above
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            self.log.warning('Parser processes failed (%s), parsing in this process instead' % e)
+            executor.shutdown(wait=False)
+    
+    def parse(self, url, raw):
+        """
+        The parsed page, waits for a worker process if there are any.
+        """
+        executor = self._executor
+        if executor is not None:
+            try:
+                return executor.submit(_parse, (url, raw)).result()
+            except BrokenProcessPool as e:
+                self._broken(e)
+        return _parse((url, raw))
+    
+    def map(self, pages, chunksize=16):
+        """
+        Parse a list of (url, raw) pages, in order.
+        """
+        done = 0
+        executor = self._executor
+        if executor is not None:
+            try:
+                for parsed in executor.map(_parse, pages, chunksize=chunksize):
+                    yield parsed
+                    done += 1
+                return
+            except BrokenProcessPool as e:
+                self._broken(e)
+        for page in pages[done:]:
+            yield _parse(page)
+    
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.shutdown()
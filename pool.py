@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import ssl
+import gzip
+import time
+import socket
+from collections import deque
+from threading import Lock, Thread
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlsplit, urljoin
+from six.moves.urllib.request import Request, getproxies, proxy_bypass
+
+from calibre_plugins.kyobobook.metrics import metrics
+
+"""
+[ 참고 ]============================================================
+* 교보문고 호스트(search., www., image.)마다 keep-alive 연결을 모아 두고 검색, Worker, 표지 확인, 표지 다운로드가 함께 쓴다.
+  요청마다 TCP/TLS 연결을 새로 맺지 않는다.
+* 호스트마다 쉬는 연결을 POOL_SIZES 개까지 idle_timeout 초 동안 남겨 둔다.
+* 헤더와 쿠키는 browser 의 것(addheaders, cookiejar)을 그대로 쓰고 redirect 도 따라간다.
+  본문은 gzip 으로 받아서 푼다. https 는 browser 의 SSL 설정(인증서 확인)을 그대로 쓴다.
+* 프록시를 쓰는 경우에는 예전처럼 browser 로 보낸다.
+* identify 가 검색을 보내는 동안 www., image. 호스트에 미리 연결해 둔다(warm). 책 페이지와 표지 확인은
+  이 연결을 쓰므로 DNS, TCP, TLS 연결을 기다리지 않는다.
+* 응답을 끝까지 읽거나 close() 하면 연결이 pool 로 돌아간다. 읽다 만 응답을 닫으면
+  DRAIN_LIMIT 이하의 남은 본문은 읽어 버리고 연결을 다시 쓴다. 표지 확인은 HEAD 요청이라 본문이 없다.
+"""
+
+# Idle connections kept per host
+DEFAULT_POOL_SIZE = 4
+POOL_SIZES = {
+    'search.kyobobook.co.kr': 4,
+    'www.kyobobook.co.kr': 8,
+    'image.kyobobook.co.kr': 8,
+}
+# Seconds an idle connection is kept, kyobobook closes them itself after a while
+DEFAULT_IDLE_TIMEOUT = 30.0
+
+MAX_REDIRECTS = 10
+# A response closed before it was read completely is drained up to this many bytes, so its connection can be reused
+DRAIN_LIMIT = 256 * 1024
+
+# Errors of a reused connection that kyobobook closed while it was idle
+STALE_ERRORS = (http_client.BadStatusLine, http_client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections per (scheme, host), shared by all identify/cover calls.
+    """
+    
+    def __init__(self, sizes=None, default_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.sizes = dict(POOL_SIZES if sizes is None else sizes)
+        self.default_size = default_size
+        self.idle_timeout = idle_timeout
+        self._lock = Lock()
+        self._idle = {}  # (scheme, netloc) -> deque of (connection, time released), newest last
+        self._warming = set()  # (scheme, netloc) being connected to by warm
+        self._context = None
+    
+    def size(self, netloc):
+        return self.sizes.get(netloc.lower(), self.default_size)
+    
+    def _connect(self, scheme, netloc, timeout, context=None):
+        if scheme == 'https':
+            if context is None:
+                if self._context is None:
+                    self._context = ssl.create_default_context()
+                context = self._context
+            return http_client.HTTPSConnection(netloc, timeout=timeout, context=context)
+        return http_client.HTTPConnection(netloc, timeout=timeout)
+    
+    def get(self, scheme, netloc, timeout, context=None):
+        """
+        An idle connection to netloc, or a new one made with the SSL context. Returns (connection, reused).
+        Idle connections all checked the certificate, see put.
+        """
+        now = time.time()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            while idle:
+                candidate, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    connection = candidate
+                    break
+                stale.append(candidate)
+        for c in stale:
+            c.close()
+        if connection is None:
+            return self._connect(scheme, netloc, timeout, context), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+    
+    def put(self, scheme, netloc, connection):
+        """
+        Keep connection for the next request to netloc, or close it if enough are idle.
+        Connections that did not check the certificate are closed, another browser may check it.
+        """
+        context = getattr(connection, '_context', None)
+        if context is not None and context.verify_mode == ssl.CERT_NONE:
+            connection.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), deque())
+            if len(idle) < self.size(netloc):
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+    
+    def warm(self, scheme, netloc, timeout, context=None):
+        """
+        Connect to netloc in the background with the SSL context, unless a connection to it is idle
+        or already being made. Returns True if a connection is being made.
+        """
+        key = (scheme, netloc)
+        with self._lock:
+            if self._idle.get(key) or key in self._warming:
+                return False
+            self._warming.add(key)
+        t = Thread(target=self._warm, args=(scheme, netloc, timeout, context), name='KyoboBook warm %s' % netloc)
+        t.daemon = True
+        t.start()
+        return True
+    
+    def _warm(self, scheme, netloc, timeout, context=None):
+        try:
+            connection = self._connect(scheme, netloc, timeout, context)
+            connection.connect()
+        except Exception:
+            # The request will connect itself, and report the error if there is one
+            return
+        finally:
+            with self._lock:
+                self._warming.discard((scheme, netloc))
+        metrics.warmed()
+        self.put(scheme, netloc, connection)
+    
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+    
+    def snapshot(self):
+        with self._lock:
+            return dict(('%s://%s' % key, len(idle)) for key, idle in self._idle.items())
+
+
+class PooledResponse(object):
+    """
+    Response read from a pooled connection, which goes back to the pool once the body was read.
+    """
+    
+    def __init__(self, url, response, release, head=False):
+        self.url, self.code = url, response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self._response = response
+        self._release = release
+        self._body = None
+        # A HEAD response has no body, its Content-Length is that of the body a GET would get
+        if not head and (self.headers.get('Content-Encoding') or '').lower() == 'gzip':
+            # Decompressed at once, the headers then describe the decompressed body like mechanize's would
+            body = self._read_all()
+            self._body = io.BytesIO(gzip.decompress(body) if body else body)
+            del self.headers['Content-Encoding']
+            del self.headers['Content-Length']
+    
+    def _read_all(self):
+        try:
+            data = self._response.read()
+        except Exception:
+            self._done(False)
+            raise
+        self._done(True)
+        return data
+    
+    def _done(self, reusable):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable and not self._response.will_close)
+    
+    def read(self, size=-1):
+        if self._body is not None:
+            return self._body.read(size)
+        if size is None or size < 0:
+            return self._read_all()
+        try:
+            data = self._response.read(size)
+        except Exception:
+            self._done(False)
+            raise
+        if not data or self._response.isclosed():
+            self._done(True)
+        return data
+    
+    def info(self):
+        return self.headers
+    
+    def geturl(self):
+        return self.url
+    
+    def getcode(self):
+        return self.code
+    
+    def close(self):
+        if self._release is None:
+            return
+        length = self._response.length
+        if length is not None and length <= DRAIN_LIMIT:
+            try:
+                self._read_all()
+                return
+            except Exception:
+                pass
+        self._done(False)
+        self._response.close()
+
+
+def request_headers(br, url, head=False):
+    # The browser's headers and cookies, as mechanize would have sent them
+    request = Request(url, headers=dict(getattr(br, 'addheaders', None) or []))
+    cookiejar = cookiejar_of(br)
+    if cookiejar is not None:
+        cookiejar.add_cookie_header(request)
+    headers = dict(request.header_items())
+    headers.setdefault('Connection', 'keep-alive')
+    if not head:
+        # Search and details pages are several times smaller gzipped, see PooledResponse.
+        # Not for the cover probes, Worker.cover_ok needs the Content-Length of the image itself
+        headers.setdefault('Accept-Encoding', 'gzip')
+    return headers, request, cookiejar
+
+
+def cookiejar_of(br):
+    try:
+        return getattr(br, 'cookiejar', None)
+    except Exception:
+        return None
+
+
+def ssl_context_of(br):
+    # The context of the browser's https handler (see calibre.utils.browser), None if it has none
+    try:
+        return br._ua_handlers['https'].ssl_context
+    except Exception:
+        return None
+
+
+_proxies = None
+
+
+def uses_proxy(scheme, netloc):
+    global _proxies
+    if _proxies is None:
+        try:
+            from calibre import get_proxies
+            _proxies = get_proxies()
+        except ImportError:
+            _proxies = getproxies()
+    proxies = _proxies
+    return bool(proxies.get(scheme)) and not proxy_bypass(netloc.split(':')[0])
+
+
+class PooledTransport(object):
+    """
+    Sends the requests over the keep-alive connections of pool instead of a new connection each time.
+    Requests that must go through a proxy are sent with the browser like LiveTransport does.
+    """
+    paced = True
+    
+    def __init__(self, pool, fallback):
+        self.pool = pool
+        self.fallback = fallback
+    
+    def open(self, br, url, timeout, head=False):
+        from calibre_plugins.kyobobook.transport import standin_url
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or uses_proxy(parts.scheme, parts.netloc):
+            return self.fallback.open(br, url, timeout, head=head)
+        url = standin_url(url)
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._get(br, url, timeout, head)
+            if response.code not in (301, 302, 303, 307, 308) or not response.headers.get('Location'):
+                break
+            response.close()
+            url = urljoin(url, response.headers['Location'])
+        else:
+            raise HTTPError(url, response.code, 'Too many redirects', response.headers, io.BytesIO())
+        if response.code >= 400:
+            body = response.read()
+            raise HTTPError(url, response.code, response.msg, response.headers, io.BytesIO(body))
+        return response
+    
+    def warm(self, urls, timeout, br=None):
+        """
+        Connect to the hosts of urls in the background with the SSL settings of br, see ConnectionPool.warm.
+        """
+        from calibre_plugins.kyobobook.transport import standin_url
+        for url in urls:
+            parts = urlsplit(url)
+            if parts.scheme in ('http', 'https') and not uses_proxy(parts.scheme, parts.netloc):
+                parts = urlsplit(standin_url(url))
+                context = ssl_context_of(br) if parts.scheme == 'https' else None
+                self.pool.warm(parts.scheme, parts.netloc, timeout, context)
+    
+    def _get(self, br, url, timeout, head=False):
+        parts = urlsplit(url)
+        scheme, netloc = parts.scheme, parts.netloc
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers, request, cookiejar = request_headers(br, url, head)
+        context = ssl_context_of(br) if scheme == 'https' else None
+        while True:
+            connection, reused = self.pool.get(scheme, netloc, timeout, context)
+            try:
+                connection.request('HEAD' if head else 'GET', path, headers=headers)
+                response = connection.getresponse()
+            except STALE_ERRORS as e:
+                connection.close()
+                if reused:
+                    # Closed by kyobobook while idle, not a failure of this request
+                    continue
+                raise URLError(e)
+            except (socket.error, http_client.HTTPException, ssl.SSLError) as e:
+                connection.close()
+                raise URLError(e)
+            break
+        metrics.connection(reused)
+        if cookiejar is not None:
+            cookiejar.extract_cookies(response, request)
+        
+        def release(reusable):
+            if reusable:
+                self.pool.put(scheme, netloc, connection)
+            else:
+                connection.close()
+        
+        return PooledResponse(url, response, release, head)
+
+
+# Shared by all identify/cover calls in this process
+connection_pool = ConnectionPool()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import sys
+import glob
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+
+"""
+[ 참고 ]============================================================
+* identify 와 Worker.run 을 cProfile 로 프로파일해서 호출마다 .prof 파일로 남긴다. 기본값은 꺼져 있다.
+  켜려면 : KYOBOBOOK_PROFILE=/tmp/kyobobook-profiles calibre-debug -g
+* cProfile 은 자신을 켠 스레드만 재기 때문에 Worker 스레드마다 따로 프로파일한다.
+  Python 3.12 부터는 cProfile 이 sys.monitoring 을 써서 프로세스 전체에서 한 번에 하나만 켤 수 있고
+  모든 스레드를 잰다. 그래서 먼저 켜진 프로파일(identify) 하나에 Worker 들이 함께 들어간다.
+* 여러 파일을 합쳐서 보려면 :
+  calibre-debug -e profiling.py -- merge /tmp/kyobobook-profiles [merged.prof] [--top 40]
+"""
+
+PROFILE_ENV = 'KYOBOBOOK_PROFILE'
+
+# From Python 3.12 on cProfile uses sys.monitoring: one profile at a time in the whole process,
+# and it sees every thread
+PROCESS_WIDE = sys.version_info >= (3, 12)
+
+
+class _Profile(object):
+    
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+        self.profile = None
+    
+    def __enter__(self):
+        self.profile = self.profiler.start(self.name)
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self.profile is None:
+            return
+        self.profiler.stop(self.profile, self.name)
+
+
+class _NoProfile(object):
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_PROFILE = _NoProfile()
+
+
+class Profiler(object):
+    """
+    Profiles a block of code in the current thread, every thread with PROCESS_WIDE, and writes
+    the profile into a directory, one file per call.
+    """
+    
+    def __init__(self, directory=None):
+        self.counter = itertools.count(1)
+        self.directory = None
+        self.enabled = False
+        # Profiles running, only one at a time with PROCESS_WIDE
+        self.active = 0
+        self.log = None
+        self._nested_logged = False
+        self._lock = threading.Lock()
+        if directory:
+            self.enable(directory)
+    
+    def enable(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.enabled = True
+    
+    def disable(self):
+        self.enabled = False
+    
+    def profile(self, name):
+        """
+        A context manager profiling its block under name, which ends up in the file name.
+        """
+        if not self.enabled:
+            return NO_PROFILE
+        return _Profile(self, name)
+    
+    def start(self, name):
+        """
+        Enable a cProfile profile for name and return it, or None if it can not run.
+        """
+        with self._lock:
+            nested = PROCESS_WIDE and self.active > 0
+            if not nested:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    error = e
+                else:
+                    self.active += 1
+                    return profile
+        if nested:
+            # Not an error, the code of name ends up in the profile already running
+            if not self._nested_logged:
+                self._nested_logged = True
+                self.warning('Profiling %s as part of the profile already running, from Python 3.12 on '
+                             'cProfile profiles every thread of the process at once' % name)
+            return None
+        self.warning('Could not profile %s, another profiler is running: %s' % (name, error))
+        return None
+    
+    def stop(self, profile, name):
+        profile.disable()
+        with self._lock:
+            self.active -= 1
+        return self.dump(profile, name)
+    
+    def warning(self, msg):
+        log = self.log
+        if log is None:
+            from calibre.utils.logging import default_log as log
+        log.warning(msg)
+    
+    def dump(self, profile, name):
+        name = re.sub(r'[^\w.-]+', '_', name)[:80]
+        path = os.path.join(self.directory, '%s-%s-%d-%d-%d.prof' % (
+            name, time.strftime('%Y%m%d%H%M%S'), os.getpid(), threading.current_thread().ident,
+            next(self.counter)))
+        profile.dump_stats(path)
+        return path
+
+
+def merge(directory, out=None, pattern='*.prof'):
+    """
+    Merge every profile in directory matching pattern into one pstats.Stats, saved to out if given.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    if not paths:
+        return None
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        try:
+            stats.add(path)
+        except Exception as e:
+            # A profile still being written, or truncated
+            print('Skipping %s: %s' % (path, e))
+    if out:
+        stats.dump_stats(out)
+    return stats
+
+
+# Shared by all identify calls in this process, enabled by the KYOBOBOOK_PROFILE environment variable
+profiler = Profiler(os.environ.get(PROFILE_ENV))
+
+
+if __name__ == '__main__':
+    # calibre-debug -e profiling.py -- merge <directory> [merged.prof] [--top N] [--pattern 'worker-*.prof']
+    import argparse
+    parser = argparse.ArgumentParser(prog='calibre-debug -e profiling.py --')
+    parser.add_argument('command', choices=['merge'])
+    parser.add_argument('directory')
+    parser.add_argument('out', nargs='?')
+    parser.add_argument('--top', type=int, default=40)
+    parser.add_argument('--pattern', default='*.prof')
+    parser.add_argument('--sort', default='cumulative')
+    opts = parser.parse_args()
+    stats = merge(opts.directory, opts.out, opts.pattern)
+    if stats is None:
+        print('No profiles in %s' % opts.directory)
+        raise SystemExit(1)
+    stats.sort_stats(opts.sort).print_stats(opts.top)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import sqlite3
+from threading import Lock, Condition
+
+from six.moves.urllib.parse import urlparse
+
+# Requests per second allowed to each kyobobook host, and how many may go out back to back.
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+
+# Requests in flight to each kyobobook host, see ConcurrencyLimiter
+DEFAULT_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+# A response slower than this many times the usual latency counts as congestion ...
+LATENCY_SPIKE_FACTOR = 3.0
+# ... but only if it also took longer than this many seconds
+LATENCY_SPIKE_MIN = 1.0
+
+
+def _refill(tokens, updated, now, rate, burst):
+    # Returns the tokens left after taking one, and 0 or the seconds until one is available
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class SharedBuckets(object):
+    """
+    Token buckets kept in an SQLite file, so that several processes (see bulk.py --shard)
+    together send no more than one rate of requests to each host.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = None
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            # Transactions are begun explicitly, see take
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Losing the buckets in a crash only gives one more burst
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._conn = conn
+        return self._conn
+    
+    def take(self, host, rate, burst):
+        with self._lock:
+            conn = self.conn
+            # Holds the write lock of the file, the other processes wait for it
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE host=?', (host,)).fetchone()
+                tokens, updated = row if row is not None else (burst, now)
+                tokens, delay = _refill(tokens, updated, now, rate, burst)
+                conn.execute('INSERT OR REPLACE INTO buckets (host, tokens, updated) VALUES (?, ?, ?)',
+                             (host, tokens, now))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return delay
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RateLimiter(object):
+    """
+    Token bucket per host shared by every request the plugin makes to kyobobook.
+    After share(path) the buckets are shared with the other processes using the same file.
+    """
+    
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate, self.burst = float(rate), float(burst)
+        self._lock = Lock()
+        self._buckets = {}  # host -> [tokens, last refill time]
+        self._shared = None
+    
+    @staticmethod
+    def host_of(url):
+        return urlparse(url).netloc.lower() or url
+    
+    def share(self, path):
+        """
+        Keep the buckets in the SQLite file path, or in this process again if path is None.
+        All the processes sharing a file should use the same rate and burst.
+        """
+        shared, self._shared = self._shared, SharedBuckets(path) if path else None
+        if shared is not None:
+            shared.close()
+    
+    def _take(self, host):
+        # Returns 0 if a token was taken, otherwise the seconds until the next one is available.
+        shared = self._shared
+        if shared is not None:
+            return shared.take(host, self.rate, self.burst)
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = [self.burst, now]
+            bucket[0], delay = _refill(bucket[0], bucket[1], now, self.rate, self.burst)
+            bucket[1] = now
+            return delay
+    
+    def wait(self, url, timeout=None):
+        """
+        Block until a request to the host of url is allowed.
+        Returns False if that would take longer than timeout seconds.
+        """
+        host = self.host_of(url)
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            delay = self._take(host)
+            if not delay:
+                return True
+            if end is not None and time.time() + delay > end:
+                return False
+            time.sleep(delay)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Adaptive limit of the requests in flight to each kyobobook host (AIMD).
+    The limit grows by one for every limit healthy responses, and is halved on a timeout,
+    a 429/5xx or a latency spike, at most once per cooldown so that one burst of failures
+    only counts once.
+    """
+    
+    def __init__(self, initial=DEFAULT_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 decrease=0.5, cooldown=1.0):
+        self.initial, self.minimum, self.maximum = float(initial), minimum, maximum
+        self.decrease, self.cooldown = decrease, cooldown
+        self._cond = Condition(Lock())
+        self._hosts = {}  # host -> {'limit', 'in_flight', 'latency', 'cut'}
+    
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {'limit': self.initial, 'in_flight': 0, 'latency': None, 'cut': 0.0}
+        return state
+    
+    def acquire(self, host, timeout=None):
+        """
+        Block until one more request to host may be sent. Returns False if that would take longer than timeout.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            state = self._host(host)
+            while state['in_flight'] >= int(state['limit']):
+                wait = None if end is None else end - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self._cond.wait(wait)
+            state['in_flight'] += 1
+            return True
+    
+    def release(self, host, latency=None, congested=False):
+        """
+        A request to host is done. congested is True if it timed out or kyobobook answered 429/5xx.
+        latency is None for a request that was never sent, which leaves the limit alone.
+        """
+        now = time.time()
+        with self._cond:
+            state = self._host(host)
+            state['in_flight'] -= 1
+            self._cond.notify_all()
+            if latency is None:
+                return
+            usual = state['latency']
+            if not congested and usual is not None and latency > max(LATENCY_SPIKE_MIN, usual * LATENCY_SPIKE_FACTOR):
+                congested = True
+            if congested:
+                if now - state['cut'] >= self.cooldown:
+                    state['limit'] = max(self.minimum, state['limit'] * self.decrease)
+                    state['cut'] = now
+            else:
+                state['limit'] = min(self.maximum, state['limit'] + 1 / state['limit'])
+                # Moving average of the healthy latencies
+                state['latency'] = latency if usual is None else usual * 0.9 + latency * 0.1
+    
+    def snapshot(self):
+        with self._cond:
+            return dict((host, {'limit': int(s['limit']), 'in_flight': s['in_flight'], 'latency': s['latency']})
+                        for host, s in self._hosts.items())
+
+
+# Shared by all identify/cover calls in this process
+rate_limiter = RateLimiter()
+concurrency_limiter = ConcurrencyLimiter()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import socket
+import random
+from threading import Lock
+from http.client import HTTPException
+from urllib.error import URLError
+from email.utils import parsedate_tz, mktime_tz
+
+from calibre_plugins.kyobobook.deadline import Cancelled
+
+"""
+[ 참고 ]============================================================
+* 일시적인 실패(timeout, 429, 5xx, 연결 끊김)는 지수적으로 늘어나는 임의의 간격(full jitter)을 두고 다시 시도한다.
+  Retry-After 헤더가 있으면 그만큼 기다린다. 남은 시간(deadline.py)보다 오래 기다려야 하면 다시 시도하지 않는다.
+* 한 호스트에서 연달아 실패하면 circuit 을 열고, reset_after 초 동안 그 호스트로 가는 요청은 보내지 않고
+  바로 CircuitOpen 으로 끝낸다. 그 뒤 요청 하나(half-open)가 성공하면 다시 닫는다.
+* 404 처럼 교보문고가 대답한 오류는 다시 시도하지 않고 실패로 세지도 않는다.
+* 네트워크 오류가 아닌 예외(plugin 코드의 버그 등)는 다시 시도하지 않고 circuit 에도 세지 않는다.
+"""
+
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 8.0
+# Longest Retry-After honored, kyobobook asking for longer is treated like an outage
+MAX_RETRY_AFTER = 60.0
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_AFTER = 30.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Failures of the connection itself, URLError and ConnectionError are OSErrors too but are listed for clarity
+TRANSIENT_ERRORS = (socket.timeout, ConnectionError, URLError, HTTPException, OSError)
+
+
+class CircuitOpen(Cancelled):
+    """
+    Raised instead of sending a request to a host that has been failing.
+    """
+
+
+def http_code(e):
+    code = getattr(e, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_transient(e):
+    """
+    True for the failures worth trying again: timeouts, throttling, server errors and lost connections.
+    Any other exception, like a bug in the plugin, is not.
+    """
+    if isinstance(e, Cancelled):
+        return False
+    code = http_code(e)
+    if code is not None:
+        return code in (408, 429) or code >= 500
+    return isinstance(e, TRANSIENT_ERRORS)
+
+
+def retry_after(e):
+    """
+    Seconds asked for by the Retry-After header of a failed response, or None.
+    """
+    info = getattr(e, 'info', None)
+    headers = info() if callable(info) else getattr(e, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """
+    How often and how long after a transient failure a request is sent again.
+    """
+    
+    def __init__(self, attempts=DEFAULT_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.attempts = attempts
+        self.base_delay, self.max_delay = base_delay, max_delay
+    
+    def delay(self, attempt, e):
+        """
+        Seconds to wait before the retry following the failure e of attempt (0 based),
+        or None if the request should not be retried.
+        """
+        if attempt + 1 >= self.attempts or not is_transient(e):
+            return None
+        after = retry_after(e)
+        if after is not None:
+            return after if after <= MAX_RETRY_AFTER else None
+        # Full jitter, so that the workers of a bulk run do not all come back at once
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Per host circuit: opened after failure_threshold transient failures in a row, then
+    requests fail fast for reset_after seconds, after which a single probe is let through.
+    """
+    
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_after=DEFAULT_RESET_AFTER):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._lock = Lock()
+        self._circuits = {}  # host -> [state, consecutive failures, time opened or probed]
+    
+    def before(self, host):
+        """
+        Raise CircuitOpen unless a request to host may be sent now.
+        """
+        now = time.time()
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit[0] == CLOSED:
+                return
+            wait = circuit[2] + self.reset_after - now
+            if wait <= 0:
+                # This request is the probe, the others keep failing fast until it is done.
+                # A probe that never reported back, like a cancelled one, is replaced after reset_after too.
+                circuit[0], circuit[2] = HALF_OPEN, now
+                return
+        raise CircuitOpen('%s is failing, skipped for %.0f more seconds' % (host, max(wait, 0)))
+    
+    def record(self, host, ok):
+        """
+        Count the outcome of a request: ok is False for a transient failure.
+        """
+        with self._lock:
+            circuit = self._circuits.setdefault(host, [CLOSED, 0, 0.0])
+            if ok:
+                circuit[:] = [CLOSED, 0, 0.0]
+                return
+            circuit[1] += 1
+            if circuit[0] == HALF_OPEN or circuit[1] >= self.failure_threshold:
+                circuit[0], circuit[2] = OPEN, time.time()
+    
+    def record_error(self, host, e):
+        """
+        Count the request that raised e. An error kyobobook answered with, like a 404, shows
+        that the host is up. Errors that are neither, like a bug in the plugin, are not counted.
+        """
+        if is_transient(e):
+            self.record(host, ok=False)
+        elif http_code(e) is not None:
+            self.record(host, ok=True)
+    
+    def state(self, host):
+        with self._lock:
+            circuit = self._circuits.get(host)
+            return circuit[0] if circuit is not None else CLOSED
+    
+    def reset(self):
+        with self._lock:
+            self._circuits.clear()
+
+
+# Shared by all identify/cover calls in this process
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
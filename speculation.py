@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+from threading import Thread
+
+from calibre_plugins.kyobobook.metrics import metrics
+
+"""
+[ 참고 ]============================================================
+* ISBN, 제목, 저자가 모두 있으면 ISBN 검색을 보내면서 제목/저자 검색도 함께 시작한다(설정에서 켠다).
+  ISBN 으로 찾지 못했을 때 identify 를 처음부터 다시 하지 않고 이미 받은 제목/저자 검색 결과를 쓴다.
+* ISBN 으로 찾으면 제목/저자 검색은 cancel 하고 결과는 버린다. 아직 보내지 않은 요청은 보내지 않는다.
+* 제목/저자 검색의 요청도 open_url 을 거치므로 rate limit, 동시 요청 수 제한, circuit breaker 를 함께 쓴다.
+"""
+
+
+def speculative_search_enabled():
+    import calibre_plugins.kyobobook.config as cfg
+    return cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_SPECULATIVE_SEARCH, False)
+
+
+class Speculation(object):
+    """
+    Runs fn(deadline) in a thread of its own, with a child of deadline, until it is known whether its result is needed.
+    """
+    
+    def __init__(self, fn, deadline, name='KyoboBook speculation'):
+        self.fn = fn
+        self.deadline = deadline.child()
+        self.name = name
+        self._thread = None
+        self._result = self._error = None
+    
+    @property
+    def started(self):
+        return self._thread is not None
+    
+    def start(self):
+        metrics.speculation_started()
+        self._thread = Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self):
+        try:
+            self._result = self.fn(self.deadline)
+        except BaseException as e:
+            self._error = e
+    
+    def cancel(self):
+        """
+        The result is not needed, fn raises Cancelled before its next request.
+        """
+        self.deadline.cancel()
+    
+    def result(self):
+        """
+        Wait for the result of fn, or raise its exception. Raises Cancelled if the deadline runs out first.
+        """
+        while self._thread.is_alive():
+            self.deadline.check()
+            self._thread.join(0.2)
+        if self._error is not None:
+            raise self._error
+        metrics.speculation_used()
+        return self._result
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import unittest
+
+"""
+Runs the tests of the plugin, offline: the pages come from the benchmark corpus (bench/corpus.py),
+served by the stand-in server (bench/standin.py) or replayed from a cassette (cassette.py).
+They test the installed plugin, install the working copy first:
+    
+    calibre-customize -b . && calibre-debug -e tests/run.py -- [-v] [test_cache test_index.ToBarcodeTest ...]
+"""
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(args=None):
+    args = list(args or [])
+    verbosity = 2 if '-v' in args else 1
+    names = [a for a in args if not a.startswith('-')]
+    loader = unittest.TestLoader()
+    if names:
+        sys.path.insert(0, TESTS_DIR)
+        suite = loader.loadTestsFromNames(names)
+    else:
+        suite = loader.discover(TESTS_DIR, top_level_dir=TESTS_DIR)
+    result = unittest.TextTestRunner(verbosity=verbosity).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
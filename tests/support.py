@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from six.moves.urllib.error import HTTPError
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench')
+sys.path.insert(0, BENCH_DIR)
+from corpus import Corpus, detail_url  # noqa: E402
+from parsers import QuietLog  # noqa: E402
+
+"""
+Shared by the tests: the benchmark corpus (bench/corpus.py), a temporary directory per test,
+and plugin preferences that are not read from or written to the calibre configuration.
+"""
+
+corpus = Corpus()
+
+
+class TempDirTestCase(unittest.TestCase):
+    # A directory of its own for every test, removed afterwards
+    
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp(prefix='kyobobook-test-')
+        self.addCleanup(shutil.rmtree, self.tdir, True)
+    
+    def path(self, name):
+        return os.path.join(self.tdir, name)
+
+
+def use_prefs(test, **values):
+    """
+    Replace the plugin preferences with their defaults, changed by values (KEY_* constant names
+    without the KEY_ prefix, e.g. STALE_WHILE_REVALIDATE=True), until the end of test.
+    """
+    import calibre_plugins.kyobobook.config as cfg
+    prefs = dict(cfg.DEFAULT_STORE_VALUES)
+    for name, value in values.items():
+        prefs[getattr(cfg, 'KEY_' + name)] = value
+    patcher = mock.patch.object(cfg, 'plugin_prefs', {cfg.STORE_NAME: prefs})
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return prefs
+
+
+def use_stores(test):
+    """
+    Give the workers (worker.py) and the plugin an empty memory cache, a record store in the directory
+    of test and no catalog index, until the end of test. Returns (metadata cache, record store).
+    """
+    from calibre_plugins.kyobobook import worker, cache as c
+    from calibre_plugins.kyobobook.cache import MetadataCache, RecordStore
+    cache, store = MetadataCache(), RecordStore(test.path('cache.sqlite'))
+    test.addCleanup(close_db, store)
+    patchers = [mock.patch.object(module, name, value) for module in (worker, c)
+                for name, value in (('metadata_cache', cache), ('record_store', store))]
+    patchers.append(mock.patch.object(worker, 'index_record', lambda log, record: None))
+    for patcher in patchers:
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return cache, store
+
+
+def use_transport(test, transport):
+    # Send the requests of open_url (transport.py) through transport until the end of test
+    from calibre_plugins.kyobobook import transport as t
+    old = t.set_transport(transport)
+    test.addCleanup(t.set_transport, old)
+    return transport
+
+
+class CorpusTransport(object):
+    """
+    Answers the requests of open_url from the corpus, without a server: the details pages by barcode
+    and the covers by image url, anything else is a 404. The (url, head) of every request is kept in requests.
+    """
+    
+    paced = False
+    
+    BARCODE_PAT = re.compile(r'barcode=(\d{13})')
+    IMAGE_PAT = re.compile(r'/[a-z](\d{13})\.jpg$')
+    
+    def __init__(self):
+        self.requests = []
+    
+    def open(self, br, url, timeout, head=False):
+        from calibre_plugins.kyobobook.cassette import ReplayResponse
+        self.requests.append((url, head))
+        body = ctype = None
+        match = self.BARCODE_PAT.search(url)
+        if match:
+            body, ctype = corpus.detail(match.group(1)), 'text/html; charset=EUC-KR'
+        match = self.IMAGE_PAT.search(url)
+        if match:
+            body, ctype = corpus.cover(match.group(1))
+        if body is None:
+            raise HTTPError(url, 404, 'Not Found', {}, None)
+        headers = [['Content-Type', ctype], ['Content-Length', str(len(body))]]
+        return ReplayResponse(url, 200, headers, b'' if head else body)
+
+
+def close_db(db):
+    # The SQLite file of a closed RecordStore or CatalogIndex can be removed on Windows too
+    if db._conn is not None:
+        db._conn.close()
+        db._conn = None
+
+
+def wait_for(condition, timeout=5.0):
+    # Poll condition until it is true or timeout seconds passed, returns its last value
+    end = time.time() + timeout
+    while True:
+        value = condition()
+        if value or time.time() >= end:
+            return value
+        time.sleep(0.01)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import zlib
+from queue import Queue
+from unittest import mock
+
+from support import (TempDirTestCase, QuietLog, CorpusTransport, corpus, detail_url, use_prefs, use_stores,
+                     use_transport, close_db)
+
+from calibre_plugins.kyobobook.archive import PageArchive, archive_page, reparse, KIND_DETAIL, KIND_SEARCH
+from calibre_plugins.kyobobook.cache import RecordStore, SOURCE_IMPORT
+from calibre_plugins.kyobobook.index import CatalogIndex
+
+# Books of the corpus with a cover
+BOOKS = [book for book in corpus.books if corpus.cover(book['barcode'])[0] is not None][:3]
+
+
+class PageArchiveTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.archive = PageArchive(self.path('pages.sqlite'))
+        self.addCleanup(close_db, self.archive)
+    
+    def pages(self):
+        return dict((url, (kind, fetched, zlib.decompress(data))) for url, kind, fetched, data in
+                    self.archive.iter_pages())
+    
+    def test_latest_copy_of_each_page(self):
+        self.archive.store('a', KIND_DETAIL, b'old', fetched=100.0)
+        self.archive.store('a', KIND_DETAIL, b'new', fetched=200.0)
+        self.archive.store('q', KIND_SEARCH, b'results', fetched=150.0)
+        self.assertEqual(self.pages(), {'a': (KIND_DETAIL, 200.0, b'new'), 'q': (KIND_SEARCH, 150.0, b'results')})
+        self.assertEqual([row[0] for row in self.archive.iter_pages(KIND_DETAIL)], ['a'])
+        self.assertEqual(self.archive.count(), 2)
+    
+    def test_same_content_stored_once(self):
+        digests = self.archive.store_many([('a', KIND_DETAIL, b'page', None), ('b', KIND_DETAIL, b'page', None)])
+        self.assertEqual(digests[0], digests[1])
+        self.assertEqual(self.archive.conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0], 1)
+    
+    def test_prune(self):
+        for i in range(5):
+            self.archive.store('url %d' % i, KIND_DETAIL, b'page %d' % i, fetched=100.0 + i)
+        self.assertEqual(self.archive.prune(3), 2)
+        self.assertEqual(sorted(self.pages()), ['url 2', 'url 3', 'url 4'])
+        self.assertEqual(self.archive.conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0], 3)
+    
+    def test_written_in_background_when_turned_on(self):
+        from calibre_plugins.kyobobook import archive
+        patcher = mock.patch.object(archive, 'page_archive', self.archive)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        use_prefs(self, ARCHIVE_PAGES=False)
+        archive_page(QuietLog(), 'a', KIND_DETAIL, b'off')
+        use_prefs(self, ARCHIVE_PAGES=True)
+        archive_page(QuietLog(), 'b', KIND_DETAIL, b'on')
+        self.archive.flush()
+        self.assertEqual(list(self.pages()), ['b'])
+
+
+class ReparseTest(TempDirTestCase):
+    """
+    archive.reparse over the corpus details pages.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.archive = PageArchive(self.path('pages.sqlite'))
+        self.store = RecordStore(self.path('cache.sqlite'))
+        self.index = CatalogIndex(self.path('index.sqlite'))
+        for db in (self.archive, self.store, self.index):
+            self.addCleanup(close_db, db)
+        self.archive.store_many([(detail_url(book), KIND_DETAIL, corpus.detail(book['barcode']), 100.0 + i)
+                                 for i, book in enumerate(BOOKS)])
+    
+    def reparse(self):
+        return reparse(QuietLog(), archive=self.archive, store=self.store, index=self.index)
+    
+    def test_records_replaced(self):
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        first = BOOKS[0]['barcode']
+        self.store.put(first, PARSER_VERSION - 1, {'id': first, 'title': 'old', 'cover': None})
+        self.assertEqual(self.reparse(), (len(BOOKS), len(BOOKS)))
+        for i, book in enumerate(BOOKS):
+            record, fetched = self.store.get(book['barcode'], PARSER_VERSION)
+            self.assertEqual((record['title'], fetched), (book['title'], 100.0 + i))
+        # The record of the older parser is gone
+        self.assertEqual(self.store.count(), len(BOOKS))
+        self.assertEqual(self.index.find(BOOKS[1]['title'], [BOOKS[1]['authors'][0][0]]), [BOOKS[1]['barcode']])
+    
+    def test_checked_cover_kept(self):
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        first, second = BOOKS[0]['barcode'], BOOKS[1]['barcode']
+        self.store.put(first, PARSER_VERSION - 1, {'id': first, 'cover': 'http://image.kyobobook.co.kr/checked.jpg'})
+        # An imported record has no checked cover
+        self.store.put(second, PARSER_VERSION, {'id': second, 'cover': 'http://image.kyobobook.co.kr/import.jpg'},
+                       source=SOURCE_IMPORT)
+        self.reparse()
+        record = self.store.get(first, PARSER_VERSION)[0]
+        self.assertEqual(record['cover'], 'http://image.kyobobook.co.kr/checked.jpg')
+        self.assertNotIn('cover_candidates', record)
+        # Without one the cover is left to be checked
+        record = self.store.get(second, PARSER_VERSION)[0]
+        self.assertIsNone(record['cover'])
+        self.assertTrue(record['cover_candidates'])
+
+
+class StoredCoverTest(TempDirTestCase):
+    """
+    The cover candidates of a reparsed record are checked the first time a worker uses it.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook
+        self.cache, self.store = use_stores(self)
+        use_prefs(self)
+        self.transport = use_transport(self, CorpusTransport())
+        self.plugin = Kyobobook(None)
+        self.book = BOOKS[0]
+        archive, index = PageArchive(self.path('pages.sqlite')), CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, archive)
+        self.addCleanup(close_db, index)
+        archive.store(detail_url(self.book), KIND_DETAIL, corpus.detail(self.book['barcode']))
+        reparse(QuietLog(), archive=archive, store=self.store, index=index)
+    
+    def lookup(self):
+        from calibre_plugins.kyobobook.worker import Worker
+        results = Queue()
+        worker = Worker(detail_url(self.book), results, self.plugin.browser, QuietLog(), 0, self.plugin)
+        self.assertTrue(worker.lookup_cache())
+        return results.get_nowait()
+    
+    def test_checked_once(self):
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        mi = self.lookup()
+        self.assertTrue(mi.has_cover)
+        self.assertEqual([head for url, head in self.transport.requests], [True])
+        cover = self.plugin.cached_identifier_to_cover_url(self.book['barcode'])
+        self.assertEqual(cover, self.transport.requests[0][0])
+        record = self.store.get(self.book['barcode'], PARSER_VERSION)[0]
+        self.assertEqual(record['cover'], cover)
+        self.assertNotIn('cover_candidates', record)
+        # The next lookups use the checked cover
+        self.cache.clear()
+        self.assertTrue(self.lookup().has_cover)
+        self.assertEqual(len(self.transport.requests), 1)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import json
+import time
+import unittest
+from threading import Thread
+from unittest import mock
+
+from support import TempDirTestCase, QuietLog
+
+from calibre_plugins.kyobobook.bulk import (Scheduler, Checkpoint, parse_book, shard_of, shard_path, merge_shards, main,
+                                            CACHED, ISBN, SEARCH)
+from calibre_plugins.kyobobook.ratelimit import SharedBuckets
+
+
+def write(path, lines):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def read(path):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+class SchedulerTest(unittest.TestCase):
+    
+    def drain(self, scheduler, done=True):
+        # Get every book waiting, as one fetcher thread would
+        got = []
+        while True:
+            book, priority = scheduler.get()
+            if book is None:
+                return got
+            got.append(book)
+            if done:
+                scheduler.done(priority)
+    
+    def test_cheapest_first(self):
+        scheduler = Scheduler(search_slots=1)
+        scheduler.put('search 1', SEARCH)
+        scheduler.put('isbn 1', ISBN)
+        scheduler.put('cached 1', CACHED)
+        scheduler.put('isbn 2', ISBN)
+        scheduler.put('cached 2', CACHED)
+        scheduler.close()
+        # A search gets its slot as soon as no stored book is waiting
+        self.assertEqual(self.drain(scheduler), ['cached 1', 'cached 2', 'search 1', 'isbn 1', 'isbn 2'])
+    
+    def test_searches_limited_while_isbns_wait(self):
+        scheduler = Scheduler(search_slots=1)
+        for i in range(3):
+            scheduler.put('search %d' % i, SEARCH)
+            scheduler.put('isbn %d' % i, ISBN)
+        scheduler.close()
+        # The searches are not done, so the one slot stays taken until no ISBN book is left
+        self.assertEqual(self.drain(scheduler, done=False),
+                         ['search 0', 'isbn 0', 'isbn 1', 'isbn 2', 'search 1', 'search 2'])
+    
+    def test_search_slot_given_back(self):
+        scheduler = Scheduler(search_slots=1)
+        for i in range(2):
+            scheduler.put('search %d' % i, SEARCH)
+            scheduler.put('isbn %d' % i, ISBN)
+        scheduler.close()
+        self.assertEqual(self.drain(scheduler), ['search 0', 'search 1', 'isbn 0', 'isbn 1'])
+    
+    def test_closed_and_empty(self):
+        scheduler = Scheduler(search_slots=1)
+        scheduler.close()
+        self.assertEqual(scheduler.get(), (None, None))
+        self.assertEqual(scheduler.get(), (None, None))
+    
+    def test_close_wakes_waiting_threads(self):
+        scheduler = Scheduler(search_slots=1)
+        got = []
+        threads = [Thread(target=lambda: got.append(scheduler.get())) for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        scheduler.put('isbn', ISBN)
+        scheduler.close()
+        for t in threads:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(got.count((None, None)), 2)
+        self.assertIn(('isbn', ISBN), got)
+    
+    def test_book_put_back_after_close(self):
+        # A fetcher thread still at work may put a book back, like an ISBN search by title
+        scheduler = Scheduler(search_slots=1)
+        scheduler.put('isbn', ISBN)
+        scheduler.close()
+        book, priority = scheduler.get()
+        scheduler.put(book, SEARCH)
+        scheduler.done(priority)
+        self.assertEqual(self.drain(scheduler), ['isbn'])
+
+
+class BooksTest(TempDirTestCase):
+    
+    def test_parse_book(self):
+        book = parse_book('89-364-7011-6')
+        self.assertEqual((book.barcode, book.title, book.authors), ('9788936470111', None, None))
+        book = parse_book('\t코스모스\t칼 세이건 & 홍승수')
+        self.assertEqual((book.barcode, book.title, book.authors), (None, '코스모스', ['칼 세이건', '홍승수']))
+    
+    def test_shard_of_isbn10_and_isbn13(self):
+        self.assertEqual(shard_of(parse_book('8936470116'), 4), shard_of(parse_book('9788936470111'), 4))
+    
+    def test_every_book_in_one_shard(self):
+        books = [parse_book('%d' % (9788936470000 + i)) for i in range(200)]
+        shards = [shard_of(book, 4) for book in books]
+        self.assertEqual(sorted(set(shards)), [0, 1, 2, 3])
+        # The same in the next run
+        self.assertEqual([shard_of(book, 4) for book in books], shards)
+    
+    def test_checkpoint(self):
+        path = self.path('done.txt')
+        checkpoint = Checkpoint(path)
+        checkpoint.add('9788936470111')
+        checkpoint.close()
+        checkpoint = Checkpoint(path)
+        self.addCleanup(checkpoint.close)
+        self.assertIn('9788936470111', checkpoint)
+        self.assertNotIn('9788932008486', checkpoint)
+
+
+class MergeTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.out, self.checkpoint = self.path('results.jsonl'), self.path('done.txt')
+        write(self.out, [json.dumps({'key': 'a', 'title': 'before'})])
+        write(shard_path(self.out, 0, 2), [json.dumps({'key': 'a', 'title': 'again'}),
+                                           json.dumps({'key': 'b', 'title': 'first'})])
+        # Killed while writing its last line
+        write(shard_path(self.out, 1, 2), [json.dumps({'key': 'c', 'title': 'second'}), '{"key": "d", "ti'])
+        write(self.checkpoint, ['a'])
+        write(shard_path(self.checkpoint, 0, 2), ['a', 'b'])
+        write(shard_path(self.checkpoint, 1, 2), ['c'])
+    
+    def check_merged(self):
+        self.assertEqual([json.loads(line) for line in read(self.out)],
+                         [{'key': 'a', 'title': 'again'}, {'key': 'b', 'title': 'first'},
+                          {'key': 'c', 'title': 'second'}])
+        self.assertEqual(read(self.checkpoint), ['a', 'b', 'c'])
+    
+    def test_merge_shards(self):
+        merge_shards(QuietLog(), self.out, self.checkpoint, 2)
+        self.check_merged()
+        self.assertEqual(shard_path(self.out, 1, 2), self.path('results.2-2.jsonl'))
+    
+    def test_merge_without_books(self):
+        self.assertEqual(main(['--out', self.out, '--checkpoint', self.checkpoint, '--merge', '2']), 0)
+        self.check_merged()
+    
+    def test_books_required_without_merge(self):
+        with self.assertRaises(SystemExit), mock.patch('sys.stderr', io.StringIO()) as stderr:
+            main(['--out', self.out])
+        self.assertIn('the list of books is required', stderr.getvalue())
+
+
+class SharedBucketsTest(TempDirTestCase):
+    
+    def buckets(self):
+        buckets = SharedBuckets(self.path('rate.sqlite'))
+        self.addCleanup(buckets.close)
+        return buckets
+    
+    def test_shared_by_processes(self):
+        # One SharedBuckets per process, the same file
+        first, second = self.buckets(), self.buckets()
+        self.assertEqual(first.take('a', 0.001, 2), 0)
+        self.assertEqual(second.take('a', 0.001, 2), 0)
+        # Both tokens are taken, by one process or the other
+        self.assertGreater(first.take('a', 0.001, 2), 0)
+        self.assertGreater(second.take('a', 0.001, 2), 0)
+        # Every host has its bucket
+        self.assertEqual(second.take('b', 0.001, 2), 0)
+    
+    def test_refilled_at_rate(self):
+        buckets = self.buckets()
+        buckets.take('a', 1000.0, 1)
+        delay = buckets.take('a', 0.5, 1)
+        self.assertTrue(0 < delay <= 2.0, delay)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import gzip
+import time
+import sqlite3
+import unittest
+from queue import Queue
+from threading import Event
+from unittest import mock
+
+from support import TempDirTestCase, QuietLog, corpus, detail_url, use_prefs, use_stores, close_db, wait_for
+
+from calibre_plugins.kyobobook.cache import MetadataCache, RecordStore, Revalidator, LAYER_SEARCH, LAYER_DETAIL
+from calibre_plugins.kyobobook.cache import SOURCE_PAGE, SOURCE_IMPORT, SCHEMA_VERSION
+from calibre_plugins.kyobobook.cache import export_snapshot, import_snapshot
+from calibre_plugins.kyobobook.index import CatalogIndex
+
+
+class MetadataCacheTest(unittest.TestCase):
+    
+    def test_fresh_then_stale(self):
+        cache = MetadataCache(ttls={LAYER_DETAIL: 60})
+        cache.put(LAYER_DETAIL, 'a', {'id': 'a'})
+        cache.put(LAYER_DETAIL, 'b', {'id': 'b'}, fetched=time.time() - 61)
+        self.assertEqual(cache.get(LAYER_DETAIL, 'a'), ({'id': 'a'}, False))
+        # Expired entries are kept, so that they can be served while being refreshed
+        self.assertEqual(cache.get(LAYER_DETAIL, 'b'), ({'id': 'b'}, True))
+        self.assertEqual(cache.get(LAYER_DETAIL, 'c'), (None, False))
+    
+    def test_ttl_per_layer(self):
+        cache = MetadataCache(ttls={LAYER_SEARCH: 10, LAYER_DETAIL: 1000})
+        fetched = time.time() - 100
+        cache.put(LAYER_SEARCH, 'q', ['url'], fetched=fetched)
+        cache.put(LAYER_DETAIL, 'q', {'id': 'q'}, fetched=fetched)
+        self.assertTrue(cache.get(LAYER_SEARCH, 'q')[1])
+        self.assertFalse(cache.get(LAYER_DETAIL, 'q')[1])
+        cache.configure(ttls={LAYER_SEARCH: 1000})
+        self.assertFalse(cache.get(LAYER_SEARCH, 'q')[1])
+    
+    def test_least_recently_used_dropped(self):
+        cache = MetadataCache(max_entries=2)
+        cache.put(LAYER_DETAIL, 'a', 1)
+        cache.put(LAYER_DETAIL, 'b', 2)
+        cache.get(LAYER_DETAIL, 'a')
+        cache.put(LAYER_DETAIL, 'c', 3)
+        self.assertEqual(cache.get(LAYER_DETAIL, 'b'), (None, False))
+        self.assertEqual(cache.get(LAYER_DETAIL, 'a')[0], 1)
+        self.assertEqual(cache.count(), 2)
+
+
+class RevalidatorTest(unittest.TestCase):
+    
+    def test_pending_key_not_queued_again(self):
+        revalidator = Revalidator(num_threads=1)
+        started, finish = Event(), Event()
+        calls = []
+        
+        def refresh():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+        
+        key = (LAYER_DETAIL, 'url')
+        self.assertTrue(revalidator.submit(key, refresh))
+        self.assertTrue(started.wait(5))
+        self.assertFalse(revalidator.submit(key, refresh))
+        finish.set()
+        # Once the refresh is done the key can be refreshed again
+        self.assertTrue(wait_for(lambda: revalidator.submit(key, lambda: calls.append(2))))
+        self.assertTrue(wait_for(lambda: len(calls) == 2))
+        self.assertEqual(calls, [1, 2])
+
+
+class RecordStoreTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.store = RecordStore(self.path('cache.sqlite'))
+        self.addCleanup(close_db, self.store)
+    
+    def test_keyed_by_parser_version(self):
+        self.store.put('9788936470111', 1, {'id': '9788936470111', 'title': 'old'}, fetched=100.0)
+        self.assertEqual(self.store.get('9788936470111', 1), ({'id': '9788936470111', 'title': 'old'}, 100.0))
+        self.assertEqual(self.store.get('9788936470111', 2), (None, None))
+        # The record of a newer parser replaces the older one, which could never be read again
+        self.store.put('9788936470111', 2, {'id': '9788936470111', 'title': 'new'})
+        self.assertEqual(self.store.get('9788936470111', 1), (None, None))
+        self.assertEqual(self.store.get('9788936470111', 2)[0]['title'], 'new')
+        self.assertEqual(self.store.count(), 1)
+    
+    def test_large_records_compressed(self):
+        record = {'id': '9788936470111', 'description': '답사기 ' * 1000}
+        self.store.put('9788936470111', 1, record)
+        self.assertEqual(self.store.get('9788936470111', 1)[0], record)
+        data = self.store.conn.execute('SELECT data FROM records').fetchone()[0]
+        self.assertLess(len(data), 1000)
+    
+    def test_shared_between_connections(self):
+        # Another calibre process reads the records of this one
+        self.store.put('9788936470111', 1, {'id': '9788936470111'})
+        other = RecordStore(self.path('cache.sqlite'))
+        self.addCleanup(close_db, other)
+        self.assertEqual(other.get('9788936470111', 1)[0], {'id': '9788936470111'})
+    
+    def test_source(self):
+        self.store.put('9788936470111', 1, {'id': '9788936470111'})
+        self.store.put_many(1, [{'id': '9788932008486'}], source=SOURCE_IMPORT)
+        self.assertIsNone(self.store.get('9788932008486', 1, source=SOURCE_PAGE)[0])
+        self.assertIsNotNone(self.store.get('9788932008486', 1, source=SOURCE_IMPORT)[0])
+        self.assertEqual(self.store.page_barcodes(None, 1), {'9788936470111'})
+        self.assertEqual(self.store.page_barcodes(['9788932008486', '9788936470111'], 1), {'9788936470111'})
+        self.assertEqual(self.store.stored_barcodes(None, 1), {'9788936470111', '9788932008486'})
+    
+    def test_merge_keeps_parsed_pages(self):
+        dumps = RecordStore.dumps
+        self.store.put('9788936470111', 1, {'id': '9788936470111', 'title': 'page'}, fetched=100.0)
+        written = self.store.merge_rows(1, [
+            ('9788936470111', 200.0, SOURCE_IMPORT, dumps({'id': '9788936470111', 'title': 'import'})),
+            ('9788932008486', 200.0, SOURCE_IMPORT, dumps({'id': '9788932008486', 'title': 'import'})),
+        ])
+        self.assertEqual(written, 1)
+        self.assertEqual(self.store.get('9788936470111', 1)[0]['title'], 'page')
+    
+    def test_migrate_store_without_source(self):
+        # A store written before catalog imports had no source column
+        path = self.path('old.sqlite')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE records (barcode TEXT NOT NULL, parser_version INTEGER NOT NULL, '
+                     'fetched REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (barcode, parser_version))')
+        conn.execute('INSERT INTO records VALUES (?, ?, ?, ?)',
+                     ('9788936470111', 1, 100.0, RecordStore.dumps({'id': '9788936470111'})))
+        conn.commit()
+        conn.close()
+        
+        store = RecordStore(path)
+        self.addCleanup(close_db, store)
+        self.assertEqual(store.get('9788936470111', 1, source=SOURCE_PAGE), ({'id': '9788936470111'}, 100.0))
+        self.assertEqual(store.conn.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        store.put('9788932008486', 1, {'id': '9788932008486'}, source=SOURCE_IMPORT)
+        self.assertEqual(store.page_barcodes(None, 1), {'9788936470111'})
+        # Opening it again does not migrate twice
+        close_db(store)
+        self.assertEqual(store.count(), 2)
+
+
+class SnapshotTest(TempDirTestCase):
+    """
+    export_snapshot and import_snapshot between two record stores.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        self.parser_version = PARSER_VERSION
+        self.source, self.target = RecordStore(self.path('source.sqlite')), RecordStore(self.path('target.sqlite'))
+        self.index = CatalogIndex(self.path('index.sqlite'))
+        for db in (self.source, self.target, self.index):
+            self.addCleanup(close_db, db)
+        self.records = [self.record('9788936470111', '나의 문화유산답사기 1', '답사기\t' * 500),
+                        self.record('9788932008486', '코스모스', '')]
+        self.source.put('9788936470111', PARSER_VERSION, self.records[0], fetched=100.0)
+        self.source.put_many(PARSER_VERSION, self.records[1:], fetched=200.0, source=SOURCE_IMPORT)
+    
+    @staticmethod
+    def record(barcode, title, description):
+        return {'id': barcode, 'title': title, 'authors': [['유홍준', '지은이']], 'publisher': '창비', 'series': None,
+                'description': description}
+    
+    def test_round_trip(self):
+        path = self.path('snapshot.gz')
+        self.assertEqual(export_snapshot(QuietLog(), path, store=self.source), 2)
+        self.assertEqual(import_snapshot(QuietLog(), path, batch_size=1, store=self.target, index=self.index),
+                         (2, 2))
+        self.assertEqual(self.target.get('9788936470111', self.parser_version, source=SOURCE_PAGE),
+                         (self.records[0], 100.0))
+        self.assertEqual(self.target.get('9788932008486', self.parser_version, source=SOURCE_IMPORT),
+                         (self.records[1], 200.0))
+        self.assertEqual(self.index.find('나의 문화유산답사기 1', ['유홍준']), ['9788936470111'])
+    
+    def test_later_records_kept(self):
+        path = self.path('snapshot.gz')
+        export_snapshot(QuietLog(), path, store=self.source)
+        self.target.put('9788936470111', self.parser_version, dict(self.records[0], title='later'), fetched=300.0)
+        self.assertEqual(import_snapshot(QuietLog(), path, store=self.target, index=self.index), (2, 1))
+        self.assertEqual(self.target.get('9788936470111', self.parser_version)[0]['title'], 'later')
+    
+    def test_other_parser_version_not_imported(self):
+        path = self.path('snapshot.gz')
+        export_snapshot(QuietLog(), path, store=self.source)
+        with gzip.open(path, 'rb') as f:
+            lines = f.read().split(b'\n', 1)
+        with gzip.open(path, 'wb') as f:
+            f.write(lines[0].replace(b'"parser_version": %d' % self.parser_version, b'"parser_version": 0') + b'\n')
+            f.write(lines[1])
+        self.assertEqual(import_snapshot(QuietLog(), path, store=self.target, index=self.index), (0, 0))
+        self.assertEqual(self.target.count(), 0)
+    
+    def test_not_a_snapshot(self):
+        path = self.path('other.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(b'{"format": "something else"}\n')
+        self.assertRaises(ValueError, import_snapshot, QuietLog(), path, store=self.target, index=self.index)
+
+
+class RecordingRevalidator(object):
+    # Remembers the refreshes asked for instead of running them
+    
+    def __init__(self):
+        self.keys = []
+    
+    def submit(self, key, func):
+        self.keys.append(key)
+        return True
+
+
+class StaleWhileRevalidateTest(TempDirTestCase):
+    """
+    Worker.lookup_cache with the cache, record store and revalidator of this test.
+    """
+    
+    BOOK = corpus.by_barcode['9788936470111']
+    
+    @classmethod
+    def setUpClass(cls):
+        from calibre_plugins.kyobobook.parsing import parse_details_page
+        cls.url = detail_url(cls.BOOK)
+        cls.record, _ = parse_details_page(cls.url, corpus.detail(cls.BOOK['barcode']))
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import worker, Kyobobook
+        self.cache, self.store = use_stores(self)
+        self.cache.configure(ttls={LAYER_DETAIL: 60})
+        self.revalidator = RecordingRevalidator()
+        patcher = mock.patch.object(worker, 'revalidator', self.revalidator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.results = Queue()
+        self.worker = worker.Worker(self.url, self.results, None, QuietLog(), 0, Kyobobook(None))
+    
+    def titles(self):
+        titles = []
+        while not self.results.empty():
+            titles.append(self.results.get_nowait().title)
+        return titles
+    
+    def test_fresh(self):
+        use_prefs(self, STALE_WHILE_REVALIDATE=True)
+        self.cache.put(LAYER_DETAIL, self.url, self.record)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [self.record['title']])
+        self.assertEqual(self.revalidator.keys, [])
+    
+    def test_stale_served_and_refreshed(self):
+        use_prefs(self, STALE_WHILE_REVALIDATE=True)
+        self.cache.put(LAYER_DETAIL, self.url, self.record, fetched=time.time() - 61)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [self.record['title']])
+        self.assertEqual(self.revalidator.keys, [(LAYER_DETAIL, self.url)])
+    
+    def test_stale_fetched_without_option(self):
+        use_prefs(self, STALE_WHILE_REVALIDATE=False)
+        self.cache.put(LAYER_DETAIL, self.url, self.record, fetched=time.time() - 61)
+        self.assertFalse(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [])
+        self.assertEqual(self.revalidator.keys, [])
+    
+    def test_stored_record(self):
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        use_prefs(self, STALE_WHILE_REVALIDATE=True)
+        self.store.put(self.BOOK['barcode'], PARSER_VERSION, self.record, fetched=time.time() - 61)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [self.record['title']])
+        self.assertEqual(self.revalidator.keys, [(LAYER_DETAIL, self.url)])
+        # It is in the memory cache now
+        self.assertIsNotNone(self.cache.get(LAYER_DETAIL, self.url)[0])
+    
+    def test_stored_record_of_older_parser_not_used(self):
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        use_prefs(self, STALE_WHILE_REVALIDATE=True)
+        self.store.put(self.BOOK['barcode'], PARSER_VERSION - 1, self.record)
+        self.assertFalse(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [])
+    
+    def test_imported_record_partial(self):
+        # Served without the details page, which is fetched in the background
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        self.store.put(self.BOOK['barcode'], PARSER_VERSION, dict(self.record, description=''), source=SOURCE_IMPORT)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.titles(), [self.record['title']])
+        self.assertEqual(self.revalidator.keys, [(LAYER_DETAIL, self.url)])
+        # Not when the full record is needed
+        self.assertFalse(self.worker.lookup_cache(partial=False))
+        self.assertEqual(self.titles(), [])
+        # The page record replaces it
+        self.cache.clear()
+        self.store.put(self.BOOK['barcode'], PARSER_VERSION, self.record)
+        self.assertTrue(self.worker.lookup_cache(partial=False))
+        self.assertEqual(len(self.revalidator.keys), 1)
+    
+    def test_built_with_current_preferences(self):
+        # The stored record does not depend on the preferences, the Metadata built from it does
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        self.store.put(self.BOOK['barcode'], PARSER_VERSION, self.record)
+        use_prefs(self, GET_CATEGORY=False)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.results.get_nowait().tags, [])
+        self.cache.clear()
+        use_prefs(self, GET_CATEGORY=True)
+        self.assertTrue(self.worker.lookup_cache())
+        self.assertEqual(self.results.get_nowait().tags, self.record['categories'])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import unittest
+from queue import Queue
+from threading import Event, Timer
+from unittest import mock
+
+from support import TempDirTestCase, QuietLog, CorpusTransport, corpus, detail_url, use_prefs, use_stores, \
+    use_transport
+from corpus import image_url
+
+from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+
+# A book of the corpus with a cover
+BOOK = next(book for book in corpus.books if corpus.cover(book['barcode'])[0] is not None)
+
+
+class RecordingLog(QuietLog):
+    
+    def __init__(self):
+        self.lines = []
+    
+    def _record(self, *args, **kwargs):
+        self.lines.append(' '.join(map(str, args)))
+    
+    __call__ = info = warning = _record
+
+
+class DeadlineTest(unittest.TestCase):
+    
+    def test_time_left(self):
+        deadline = Deadline(10)
+        self.assertLessEqual(deadline.remaining(), 10)
+        self.assertEqual(deadline.timeout_for(3), 3)
+        self.assertLessEqual(deadline.timeout_for(30), 10)
+        self.assertIsNone(Deadline().remaining())
+        self.assertEqual(Deadline().timeout_for(3), 3)
+    
+    def test_expired(self):
+        deadline = Deadline(0.05)
+        self.assertFalse(deadline.sleep(1))
+        self.assertTrue(deadline.expired())
+        self.assertRaises(Cancelled, deadline.check)
+        self.assertRaises(Cancelled, deadline.timeout_for, 3)
+    
+    def test_abort_wakes_up_sleep(self):
+        abort = Event()
+        deadline = Deadline(10, abort)
+        Timer(0.05, abort.set).start()
+        start = time.monotonic()
+        self.assertFalse(deadline.sleep(5))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(deadline.cancelled())
+        with self.assertRaises(Cancelled):
+            deadline.check()
+
+
+class ChildDeadlineTest(unittest.TestCase):
+    
+    def test_same_time_left(self):
+        parent = Deadline(10)
+        child = parent.child()
+        self.assertEqual((child.timeout, child.expires), (parent.timeout, parent.expires))
+        self.assertIsNone(Deadline().child().remaining())
+    
+    def test_cancelled_on_its_own(self):
+        parent = Deadline(10)
+        child = parent.child()
+        child.cancel()
+        self.assertRaises(Cancelled, child.check)
+        self.assertFalse(parent.cancelled())
+    
+    def test_cancelled_with_its_parent(self):
+        abort = Event()
+        child = Deadline(10, abort).child()
+        self.assertFalse(child.cancelled())
+        abort.set()
+        self.assertTrue(child.aborted())
+        self.assertRaises(Cancelled, child.timeout_for, 3)
+    
+    def test_abort_of_parent_wakes_up_sleep(self):
+        abort = Event()
+        child = Deadline(10, abort).child()
+        Timer(0.05, abort.set).start()
+        start = time.monotonic()
+        self.assertFalse(child.sleep(5))
+        self.assertLess(time.monotonic() - start, 1)
+    
+    def test_expires_with_its_parent(self):
+        child = Deadline(0.05).child()
+        self.assertFalse(child.sleep(1))
+        self.assertRaises(Cancelled, child.check)
+
+
+class DeadlinePropagationTest(TempDirTestCase):
+    """
+    The workers and the cover download of an identify stop once its deadline is cancelled.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook
+        from calibre_plugins.kyobobook.resilience import circuit_breaker
+        self.addCleanup(circuit_breaker.reset)
+        use_stores(self)
+        use_prefs(self)
+        self.transport = use_transport(self, CorpusTransport())
+        self.plugin = Kyobobook(None)
+    
+    def test_worker_stops(self):
+        from calibre_plugins.kyobobook.worker import Worker
+        abort = Event()
+        abort.set()
+        results = Queue()
+        worker = Worker(detail_url(BOOK), results, self.plugin.browser, QuietLog(), 0, self.plugin,
+                        deadline=Deadline(10, abort))
+        worker.run()
+        self.assertTrue(results.empty())
+        self.assertEqual(self.transport.requests, [])
+    
+    def identify(self, delay):
+        # What identify finds for BOOK, after delay seconds
+        from calibre.ebooks.metadata.book.base import Metadata
+        
+        def identify(log, result_queue, abort, title, authors, identifiers, timeout, timer, deadline):
+            self.deadlines.append(deadline)
+            time.sleep(delay)
+            mi = Metadata(BOOK['title'], [])
+            mi.set_identifier(self.plugin.ID_NAME, BOOK['barcode'])
+            result_queue.put(mi)
+            self.plugin.cache_identifier_to_cover_url(BOOK['barcode'], image_url(BOOK['barcode']))
+        
+        self.deadlines = []
+        patcher = mock.patch.object(self.plugin, '_identify', identify)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def download_cover(self, timeout):
+        log, results = RecordingLog(), Queue()
+        self.plugin.download_cover(log, results, Event(), title=BOOK['title'], timeout=timeout)
+        return log, results
+    
+    def test_cover_downloaded(self):
+        self.identify(0)
+        log, results = self.download_cover(10)
+        self.assertEqual(results.get_nowait()[1], corpus.cover(BOOK['barcode'])[0])
+        # The identify got the deadline of the cover download
+        self.assertEqual(self.deadlines[0].timeout, 10)
+    
+    def test_no_time_left_for_cover(self):
+        self.identify(0.3)
+        log, results = self.download_cover(0.2)
+        self.assertTrue(results.empty())
+        self.assertTrue(self.deadlines[0].expired())
+        self.assertEqual(self.transport.requests, [])
+        self.assertTrue(any(line.startswith('No time left of 0.2 seconds, not downloading the cover')
+                            for line in log.lines), log.lines)
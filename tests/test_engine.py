@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import asyncio
+from queue import Queue
+from threading import Barrier
+
+from support import TempDirTestCase, QuietLog, CorpusTransport, corpus, detail_url, use_prefs, use_stores, \
+    use_transport
+
+from calibre_plugins.kyobobook.engine import AsyncEngine, IO_THREADS
+from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+
+# Books of the corpus with a cover
+BOOKS = [book for book in corpus.books if corpus.cover(book['barcode'])[0] is not None][:3]
+
+
+class BarrierTransport(CorpusTransport):
+    # Answers once parties requests are in flight at the same time
+    
+    def __init__(self, parties):
+        CorpusTransport.__init__(self)
+        self.barrier = Barrier(parties, timeout=5)
+    
+    def open(self, br, url, timeout, head=False):
+        self.barrier.wait()
+        return CorpusTransport.open(self, br, url, timeout, head)
+
+
+class AsyncEngineTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook
+        from calibre_plugins.kyobobook.resilience import circuit_breaker
+        self.addCleanup(circuit_breaker.reset)
+        self.cache, self.store = use_stores(self)
+        use_prefs(self)
+        self.plugin = Kyobobook(None)
+        self.engine = AsyncEngine()
+    
+    def workers(self, results, deadline=None):
+        from calibre_plugins.kyobobook.worker import Worker
+        return [Worker(detail_url(book), results, self.plugin.browser, QuietLog(), i, self.plugin, timeout=5,
+                       deadline=deadline) for i, book in enumerate(BOOKS)]
+    
+    def test_details_like_worker_threads(self):
+        transport = use_transport(self, CorpusTransport())
+        results = Queue()
+        self.engine.run(self.engine.details(self.workers(results)))
+        found = sorted((mi.source_relevance, mi.title) for mi in [results.get_nowait() for i in range(results.qsize())])
+        self.assertEqual(found, [(i, book['title']) for i, book in enumerate(BOOKS)])
+        for book in BOOKS:
+            self.assertIsNotNone(self.plugin.cached_identifier_to_cover_url(book['barcode']))
+        self.assertEqual(sum(1 for url, head in transport.requests if not head), len(BOOKS))
+        # The second time they come from the cache
+        del transport.requests[:]
+        self.engine.run(self.engine.details(self.workers(Queue())))
+        self.assertEqual(transport.requests, [])
+    
+    def test_requests_beyond_the_old_thread_limit(self):
+        # The executor lets the per-host limits decide how many requests are in flight
+        self.assertGreaterEqual(IO_THREADS, 32)
+        use_transport(self, BarrierTransport(20))
+        url = detail_url(BOOKS[0])
+        
+        async def fetch_all():
+            return await asyncio.gather(*[self.engine.open_url(None, url, 5) for i in range(20)])
+        
+        responses = self.engine.run(fetch_all())
+        self.assertEqual(set(r.read() for r in responses), {corpus.detail(BOOKS[0]['barcode'])})
+    
+    def test_cancelled_with_deadline(self):
+        start = time.monotonic()
+        self.assertRaises(Cancelled, self.engine.run, asyncio.sleep(5), Deadline(0.2))
+        self.assertLess(time.monotonic() - start, 2)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import unittest
+from threading import Lock
+
+from support import wait_for
+
+from calibre_plugins.kyobobook.hedging import Hedger, _Race, MIN_SAMPLES, DEFAULT_DELAY, MIN_DELAY
+from calibre_plugins.kyobobook.cassette import ReplayResponse
+from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+from calibre_plugins.kyobobook.metrics import metrics
+
+URL = 'http://www.kyobobook.co.kr/product/detailViewKor.laf?barcode=9788936470111'
+
+
+class Browser(object):
+    
+    def clone_browser(self):
+        return self
+
+
+class Response(ReplayResponse):
+    
+    def __init__(self, body):
+        ReplayResponse.__init__(self, URL, 200, [['Content-Type', 'text/html']], body)
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+
+class Fetches(object):
+    """
+    fetch for Hedger.open, the n-th call runs the n-th of actions with the attempt's deadline.
+    """
+    
+    def __init__(self, *actions):
+        self.actions = actions
+        self.calls = []
+        self.finished = []
+        self._lock = Lock()
+    
+    def __call__(self, br, url, timeout, deadline):
+        with self._lock:
+            n = len(self.calls)
+            self.calls.append(url)
+        try:
+            return self.actions[n](deadline)
+        finally:
+            self.finished.append(n)
+
+
+def slow(deadline):
+    # Stops as soon as the other attempt won
+    if deadline.sleep(5):
+        return Response(b'slow')
+    raise Cancelled('lost')
+
+
+class HedgerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.hedger = Hedger()
+        # Usually fast, the second request goes out after MIN_DELAY
+        for i in range(MIN_SAMPLES):
+            self.hedger.record('detail', 0.01)
+    
+    def open(self, fetch, deadline=None):
+        return self.hedger.open(Browser(), URL, 10, deadline, fetch)
+    
+    def test_delay(self):
+        hedger = Hedger(percentile=50)
+        self.assertEqual(hedger.delay('detail'), DEFAULT_DELAY)
+        for i in range(100):
+            hedger.record('detail', i / 10)
+        self.assertEqual(hedger.delay('detail'), 5.0)
+        self.assertEqual(self.hedger.delay('detail'), MIN_DELAY)
+        self.assertEqual(self.hedger.delay('search'), DEFAULT_DELAY)
+    
+    def test_fast_not_hedged(self):
+        fetch = Fetches(lambda d: Response(b'page'))
+        response = self.open(fetch)
+        self.assertEqual((response.read(), response.getcode()), (b'page', 200))
+        self.assertEqual(response.info().get('Content-Type'), 'text/html')
+        self.assertEqual(len(fetch.calls), 1)
+    
+    def test_slow_hedged(self):
+        fired, won = metrics.snapshot()['hedges']['detail'].values()
+        fetch = Fetches(slow, lambda d: Response(b'fast'))
+        start = time.perf_counter()
+        self.assertEqual(self.open(fetch).read(), b'fast')
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(len(fetch.calls), 2)
+        self.assertEqual(list(metrics.snapshot()['hedges']['detail'].values()), [fired + 1, won + 1])
+        # The attempt that lost is stopped
+        self.assertTrue(wait_for(lambda: 0 in fetch.finished, timeout=2))
+    
+    def test_both_failed(self):
+        def fail(deadline):
+            time.sleep(0.3)
+            raise ValueError('failed')
+        
+        fetch = Fetches(fail, fail)
+        self.assertRaises(ValueError, self.open, fetch)
+        self.assertEqual(len(fetch.calls), 2)
+    
+    def test_first_error_waits_for_hedge(self):
+        def fail(deadline):
+            time.sleep(0.3)
+            raise ValueError('failed')
+        
+        def late(deadline):
+            time.sleep(0.2)
+            return Response(b'late')
+        
+        self.assertEqual(self.open(Fetches(fail, late)).read(), b'late')
+    
+    def test_deadline(self):
+        fetch = Fetches(slow, slow)
+        start = time.perf_counter()
+        self.assertRaises(Cancelled, self.open, fetch, Deadline(0.5))
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertTrue(wait_for(lambda: len(fetch.finished) == 2, timeout=2))
+
+
+class RaceTest(unittest.TestCase):
+    
+    def test_losers_closed(self):
+        race = _Race()
+        reading, read = Response(b'a'), Response(b'b')
+        self.assertTrue(race.reading(0, reading))
+        self.assertTrue(race.reading(1, read))
+        race.read(1)
+        race.end()
+        self.assertTrue(race.done.is_set())
+        self.assertEqual((reading.closed, read.closed), (True, False))
+        # A response arriving after the end is closed at once
+        late = Response(b'c')
+        self.assertFalse(race.reading(2, late))
+        self.assertTrue(late.closed)
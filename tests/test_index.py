@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import unittest
+from queue import Queue
+from threading import Event
+from unittest import mock
+
+from support import TempDirTestCase, QuietLog, CorpusTransport, close_db, use_prefs, use_stores, use_transport
+
+from calibre_plugins.kyobobook.index import CatalogIndex, tokenize
+from calibre_plugins.kyobobook.importer import to_barcode, iter_chunks
+
+
+class TokenizeTest(unittest.TestCase):
+    
+    def test_hangul_bigrams(self):
+        self.assertEqual(tokenize('답사기를'), ['답사', '사기', '기를'])
+        self.assertEqual(tokenize('Che Guevara 평전'), ['che', 'guevara', '평전'])
+        self.assertEqual(tokenize('칼'), ['칼'])
+        self.assertEqual(tokenize(''), [])
+
+
+class CatalogIndexFindTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.index = CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, self.index)
+        self.index.add_many([
+            ('9788936470111', '나의 문화유산답사기 1', ['유홍준'], '창비', '나의 문화유산답사기'),
+            ('9788936470128', '나의 문화유산답사기 2', ['유홍준'], '창비', '나의 문화유산답사기'),
+            ('9788936400002', '나의 문화유산답사기 1', ['홍길동'], '다른출판사', None),
+            ('9788983711892', '코스모스', ['칼 세이건', '홍승수'], '사이언스북스', None),
+            ('9788983711908', '코스모스 특별판', ['칼 세이건'], '사이언스북스', None),
+        ])
+    
+    def test_title_and_author(self):
+        self.assertEqual(self.index.find('나의 문화유산답사기 1', ['유홍준']), ['9788936470111'])
+        self.assertEqual(self.index.find('나의 문화유산답사기 2', ['유홍준']), ['9788936470128'])
+    
+    def test_punctuation_and_case_ignored(self):
+        self.assertEqual(self.index.find('나의 문화유산답사기, 1!', ['유홍준']), ['9788936470111'])
+    
+    def test_author_name_order(self):
+        self.assertEqual(self.index.find('코스모스', ['세이건, 칼']), ['9788983711892'])
+        # Any one of the authors
+        self.assertEqual(self.index.find('코스모스', ['홍승수', '아무개']), ['9788983711892'])
+    
+    def test_no_confident_match(self):
+        # Without authors another edition or volume is too likely
+        self.assertEqual(self.index.find('나의 문화유산답사기 1'), [])
+        self.assertEqual(self.index.find('나의 문화유산답사기 1', ['아무개']), [])
+        # A title only contained in the indexed one
+        self.assertEqual(self.index.find('문화유산답사기', ['유홍준']), [])
+        self.assertEqual(self.index.find('', ['유홍준']), [])
+    
+    def test_updated_book_found_by_new_title(self):
+        self.index.add('9788983711908', '코스모스 (특별판)', ['칼 세이건'])
+        self.assertEqual(self.index.find('코스모스 특별판', ['칼 세이건']), ['9788983711908'])
+        self.assertEqual(self.index.count(), 5)
+    
+    def test_bulk(self):
+        self.index.begin_bulk()
+        self.index.add_many([('9788984317475', '높고 푸른 사다리', ['공지영'], '한겨레출판', None)])
+        self.index.end_bulk()
+        self.assertEqual(self.index.find('높고 푸른 사다리', ['공지영']), ['9788984317475'])
+
+
+class ToBarcodeTest(unittest.TestCase):
+    
+    def test_isbn13(self):
+        self.assertEqual(to_barcode('9788936470111'), '9788936470111')
+        self.assertEqual(to_barcode('978-89-364-7011-1'), '9788936470111')
+        self.assertIsNone(to_barcode('9788936470112'))
+    
+    def test_isbn10(self):
+        self.assertEqual(to_barcode('8936470116'), '9788936470111')
+        self.assertEqual(to_barcode('0-306-40615-2'), '9780306406157')
+        self.assertEqual(to_barcode('080442957X'), '9780804429573')
+        self.assertEqual(to_barcode('080442957x'), '9780804429573')
+        # Wrong check digit
+        self.assertIsNone(to_barcode('0306406153'))
+    
+    def test_not_an_isbn(self):
+        for isbn in (None, '', '12345', '97889364701111', 'ISBN'):
+            self.assertIsNone(to_barcode(isbn), isbn)
+
+
+CATALOG = ('바코드\t상품명\t저자\t출판사\t출판일\t분류\n'
+           '9788936470111\t나의 문화유산답사기 1\t유홍준\t창비\t2011-05-02\t국내도서 > 여행\n'
+           '8936470116\t나의 문화유산답사기 1\t유홍준\t창비\t20110502\t\n'
+           '9788936470112\t틀린 체크 숫자\t아무개\t\t\t\n'
+           '9788984317475\t높고 푸른 사다리\n')
+
+
+class ImportTest(TempDirTestCase):
+    
+    def test_iter_chunks(self):
+        records = [r for chunk in iter_chunks(io.StringIO(CATALOG), chunk_size=2) for r in chunk]
+        self.assertEqual([r['id'] for r in records], ['9788936470111', '9788936470111', '9788984317475'])
+        self.assertEqual(records[0]['authors'], [['유홍준', '']])
+        self.assertEqual(records[0]['pubdate'], '2011-05-02')
+        self.assertEqual(records[1]['pubdate'], '2011-05-02')
+        self.assertEqual(records[0]['categories'], ['▣국내도서.여행'])
+        # The cover is left to be checked
+        self.assertIsNone(records[0]['cover'])
+        self.assertEqual(records[0]['cover_candidates'][0],
+                         ['http://image.kyobobook.co.kr/images/book/xlarge/111/x9788936470111.jpg', 'Large'])
+        # Short rows read as empty fields
+        self.assertEqual(records[2]['authors'], [])
+        self.assertIsNone(records[2]['publisher'])
+    
+    def test_import_stream(self):
+        from calibre_plugins.kyobobook.cache import RecordStore, SOURCE_IMPORT
+        from calibre_plugins.kyobobook.importer import import_stream
+        from calibre_plugins.kyobobook.worker import PARSER_VERSION
+        store, index = RecordStore(self.path('cache.sqlite')), CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, store)
+        self.addCleanup(close_db, index)
+        # A record parsed from a details page is not replaced by the catalog's
+        store.put('9788984317475', PARSER_VERSION, {'id': '9788984317475', 'title': 'page'})
+        imported, skipped = import_stream(QuietLog(), io.StringIO(CATALOG), chunk_size=1, store=store, index=index)
+        self.assertEqual((imported, skipped), (2, 1))
+        self.assertEqual(store.get('9788984317475', PARSER_VERSION)[0]['title'], 'page')
+        self.assertIsNotNone(store.get('9788936470111', PARSER_VERSION, source=SOURCE_IMPORT)[0])
+        self.assertEqual(index.find('나의 문화유산답사기 1', ['유홍준']), ['9788936470111'])
+
+
+class IndexedMatchesTest(TempDirTestCase):
+    """
+    identify looks for the book in the catalog index before searching kyobobook.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook, index
+        self.index = CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, self.index)
+        self.index.add('9788936470111', '나의 문화유산답사기 1', ['유홍준'])
+        patcher = mock.patch.object(index, 'catalog_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        use_prefs(self)
+        self.plugin = Kyobobook(None)
+    
+    def matches(self, title=None, authors=None, isbn=None):
+        return self.plugin._get_indexed_matches(QuietLog(), title, authors, isbn)
+    
+    def test_by_title_and_authors(self):
+        self.assertEqual(self.matches('나의 문화유산답사기 1', ['유홍준']),
+                         ['http://www.kyobobook.co.kr/product/detailViewKor.laf?barcode=9788936470111'])
+        self.assertEqual(self.matches('나의 문화유산답사기', ['유홍준']), [])
+    
+    def test_by_isbn(self):
+        self.assertEqual(len(self.matches(isbn='9788936470111')), 1)
+        self.assertEqual(len(self.matches(isbn='8936470116')), 1)
+        # The ISBN wins over the title, even if it is not indexed
+        self.assertEqual(self.matches('나의 문화유산답사기 1', ['유홍준'], isbn='9788984317475'), [])
+
+
+class ImportedBookTest(TempDirTestCase):
+    """
+    identify and get_cached_cover_url find an imported book without sending a request.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook, index, worker
+        from calibre_plugins.kyobobook.importer import import_stream
+        cache, store = use_stores(self)
+        self.index = CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, self.index)
+        import_stream(QuietLog(), io.StringIO(CATALOG), store=store, index=self.index)
+        self.revalidator = mock.Mock()
+        for patcher in (mock.patch.object(index, 'catalog_index', self.index),
+                        mock.patch.object(worker, 'revalidator', self.revalidator)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        use_prefs(self)
+        self.transport = use_transport(self, CorpusTransport())
+        self.plugin = Kyobobook(None)
+    
+    def test_identify(self):
+        results = Queue()
+        self.plugin.identify(QuietLog(), results, Event(), identifiers={'isbn': '8936470116'}, timeout=5)
+        mi = results.get_nowait()
+        self.assertEqual((mi.title, mi.identifiers), ('나의 문화유산답사기 1', {'kyobobook': '9788936470111'}))
+        self.assertTrue(mi.has_cover)
+        self.assertEqual(self.transport.requests, [])
+        # The details page is fetched in the background
+        self.assertEqual(self.revalidator.submit.call_count, 1)
+    
+    def test_cover_url(self):
+        self.assertEqual(self.plugin.get_cached_cover_url({'isbn': '9788936470111'}),
+                         'http://image.kyobobook.co.kr/images/book/xlarge/111/x9788936470111.jpg')
+        self.assertIsNone(self.plugin.get_cached_cover_url({'isbn': '9780306406157'}))
+        self.assertEqual(self.transport.requests, [])
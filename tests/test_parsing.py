@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from support import QuietLog, corpus, detail_url
+
+from calibre_plugins.kyobobook.parsing import ParsePool, parse_details_page
+
+PAGES = [(detail_url(book), corpus.detail(book['barcode'])) for book in corpus.books[:4]]
+TITLES = [book['title'] for book in corpus.books[:4]]
+
+
+class WarningLog(QuietLog):
+    
+    def __init__(self):
+        self.warnings = []
+    
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+class BrokenExecutor(object):
+    # Worker processes that die after the first page
+    
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+        return future
+    
+    def map(self, fn, pages, chunksize=1):
+        yield fn(pages[0])
+        raise BrokenProcessPool('A process in the process pool was terminated abruptly')
+    
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+def titles(parsed):
+    return [record['title'] if record else None for url, record, candidates in parsed]
+
+
+class ParsePoolTest(unittest.TestCase):
+    
+    def test_in_this_thread(self):
+        with ParsePool(QuietLog()) as pool:
+            self.assertEqual(pool.processes, 1)
+            self.assertEqual(titles(pool.map(PAGES)), TITLES)
+            url, record, candidates = pool.parse(*PAGES[0])
+            self.assertEqual((url, record), (PAGES[0][0], parse_details_page(*PAGES[0])[0]))
+            self.assertTrue(candidates)
+            # A page without a book
+            self.assertEqual(titles([pool.parse(PAGES[0][0], b'<html><body></body></html>')]), [None])
+    
+    def test_processes(self):
+        with mock.patch('os.cpu_count', return_value=2), ParsePool(QuietLog(), processes=4) as pool:
+            self.assertEqual(pool.processes, 2)
+            self.assertIsNotNone(pool._executor)
+            self.assertEqual(titles(pool.map(PAGES, chunksize=1)), TITLES)
+            self.assertEqual(titles([pool.parse(*PAGES[1])]), TITLES[1:2])
+    
+    def test_map_falls_back_to_this_thread(self):
+        log, executor = WarningLog(), BrokenExecutor()
+        pool = ParsePool(log)
+        pool._executor = executor
+        # Every page once, in order
+        self.assertEqual(titles(pool.map(PAGES)), TITLES)
+        self.assertEqual(len(log.warnings), 1)
+        self.assertTrue(executor.shut_down)
+        self.assertIsNone(pool._executor)
+    
+    def test_parse_falls_back_to_this_thread(self):
+        log = WarningLog()
+        pool = ParsePool(log)
+        pool._executor = BrokenExecutor()
+        self.assertEqual(titles([pool.parse(*PAGES[0]), pool.parse(*PAGES[1])]), TITLES[:2])
+        self.assertEqual(len(log.warnings), 1)
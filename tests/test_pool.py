@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import ssl
+import gzip
+import unittest
+import threading
+from queue import Queue
+from threading import Event
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from six.moves.urllib.error import HTTPError
+
+from support import TempDirTestCase, QuietLog, CorpusTransport, use_prefs, use_stores, use_transport, close_db, \
+    wait_for
+
+from calibre_plugins.kyobobook.pool import ConnectionPool, PooledTransport, DRAIN_LIMIT
+
+PAGE = '<html><title>나의 문화유산답사기 1 - 인터넷교보문고</title></html>'.encode('euc-kr') * 100
+COVER = b'\xff\xd8' + b'\0' * 20000
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAGE at /page, COVER at /cover and a redirect at /moved, gzipped when asked to, like kyobobook.
+    Remembers the path, headers and client port of every request.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = None
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        self.respond(True)
+    
+    def do_HEAD(self):
+        self.respond(False)
+    
+    def respond(self, send_body):
+        self.requests.append((self.command, self.path, dict(self.headers), self.client_address[1]))
+        headers = {}
+        if self.path == '/moved':
+            status, body = 302, b''
+            headers['Location'] = '/page'
+        elif self.path in ('/page', '/cover', '/large'):
+            status, body = 200, {'/page': PAGE, '/cover': COVER, '/large': COVER * 20}[self.path]
+        else:
+            status, body = 404, b'Not found'
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and body:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        # Connections closed by the client before the response was written
+        pass
+
+
+class PooledTransportTest(unittest.TestCase):
+    
+    def setUp(self):
+        from calibre_plugins.kyobobook import pool
+        self.requests = []
+        handler = type(str('Handler'), (KeepAliveHandler,), {'requests': self.requests})
+        self.httpd = Server(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.clear)
+        self.transport = PooledTransport(self.pool, None)
+        # The server is local, whatever proxy the machine uses
+        patcher = mock.patch.object(pool, '_proxies', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def open(self, path, head=False):
+        return self.transport.open(None, self.url + path, 5, head=head)
+    
+    def ports(self):
+        return set(port for method, path, headers, port in self.requests)
+    
+    def test_connection_reused(self):
+        for i in range(3):
+            self.assertEqual(self.open('/page').read(), PAGE)
+        self.assertEqual(len(self.ports()), 1)
+        self.assertEqual(list(self.pool.snapshot().values()), [1])
+    
+    def test_page_gzipped(self):
+        response = self.open('/page')
+        self.assertEqual(self.requests[0][2]['Accept-Encoding'], 'gzip')
+        self.assertEqual(response.read(), PAGE)
+        # The headers describe the body as read
+        self.assertIsNone(response.info().get('Content-Encoding'))
+        self.assertIsNone(response.info().get('Content-Length'))
+    
+    def test_cover_probe(self):
+        # Worker.cover_ok needs the Content-Length of the image
+        response = self.open('/cover', head=True)
+        self.assertNotIn('gzip', self.requests[0][2].get('Accept-Encoding', ''))
+        self.assertEqual(response.info().get('Content-Length'), str(len(COVER)))
+        response.close()
+        self.open('/page').read()
+        self.assertEqual(len(self.ports()), 1)
+    
+    def test_head_response_headers_kept(self):
+        # A HEAD response is not decompressed, even if the server gzipped it anyway
+        with mock.patch('calibre_plugins.kyobobook.pool.request_headers',
+                        lambda br, url, head=False: ({'Accept-Encoding': 'gzip'}, None, None)):
+            response = self.open('/cover', head=True)
+        self.assertEqual(response.info().get('Content-Encoding'), 'gzip')
+        self.assertIsNotNone(response.info().get('Content-Length'))
+        response.close()
+    
+    def test_redirect_and_error(self):
+        self.assertEqual(self.open('/moved').read(), PAGE)
+        with self.assertRaises(HTTPError) as cm:
+            self.open('/missing')
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual([path for method, path, headers, port in self.requests], ['/moved', '/page', '/missing'])
+        self.assertEqual(len(self.ports()), 1)
+    
+    def test_closed_before_read(self):
+        # What is left of the body is read so that the connection can be reused, unless it is too long
+        response = self.transport.open(mock.Mock(addheaders=[('Accept-Encoding', 'identity')]),
+                                       self.url + '/cover', 5)
+        response.read(10)
+        response.close()
+        self.assertEqual(list(self.pool.snapshot().values()), [1])
+        self.assertGreater(len(COVER) * 20, DRAIN_LIMIT)
+        response = self.transport.open(mock.Mock(addheaders=[('Accept-Encoding', 'identity')]),
+                                       self.url + '/large', 5)
+        response.read(10)
+        response.close()
+        self.assertEqual(list(self.pool.snapshot().values()), [0])
+    
+    def test_idle_connections_expire(self):
+        self.pool.idle_timeout = 0
+        self.open('/page').read()
+        self.open('/page').read()
+        self.assertEqual(len(self.ports()), 2)
+
+
+class WarmTest(unittest.TestCase):
+    
+    def test_ssl_context_of_browser(self):
+        # Warm connections check the certificate like the browser's own
+        from calibre_plugins.kyobobook import pool
+        context = ssl.create_default_context()
+        br = mock.Mock()
+        br._ua_handlers = {'https': mock.Mock(ssl_context=context)}
+        connections = ConnectionPool()
+        connection = mock.Mock()
+        with mock.patch.object(pool, '_proxies', {}), \
+                mock.patch.object(connections, '_connect', return_value=connection) as connect:
+            PooledTransport(connections, None).warm(['https://www.kyobobook.co.kr/'], 5, br)
+            self.assertTrue(wait_for(lambda: connections.snapshot()))
+        connect.assert_called_once_with('https', 'www.kyobobook.co.kr', 5, context)
+        self.assertEqual(connections.snapshot(), {'https://www.kyobobook.co.kr': 1})
+        # Not again while a connection is idle
+        self.assertFalse(connections.warm('https', 'www.kyobobook.co.kr', 5, context))
+
+
+class WarmingTransport(CorpusTransport):
+    # Remembers the hosts it was asked to connect to among the requests
+    
+    def warm(self, urls, timeout, br=None):
+        self.requests.append(('warm', urls))
+
+
+class PrewarmTest(TempDirTestCase):
+    """
+    identify connects to the book page and cover hosts while it searches.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import Kyobobook, index
+        from calibre_plugins.kyobobook.index import CatalogIndex
+        from calibre_plugins.kyobobook.resilience import circuit_breaker
+        self.addCleanup(circuit_breaker.reset)
+        use_stores(self)
+        use_prefs(self)
+        empty = CatalogIndex(self.path('index.sqlite'))
+        self.addCleanup(close_db, empty)
+        patcher = mock.patch.object(index, 'catalog_index', empty)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = use_transport(self, WarmingTransport())
+        self.plugin = Kyobobook(None)
+    
+    def test_warmed_before_search(self):
+        self.plugin.identify(QuietLog(), Queue(), Event(), title='나의 문화유산답사기', authors=['유홍준'], timeout=5)
+        self.assertEqual(self.transport.requests[0], ('warm', [self.plugin.BASE_URL, self.plugin.IMAGE_URL]))
+        self.assertIn('search.kyobobook.co.kr', self.transport.requests[1][0])
+    
+    def test_failing_hosts_skipped(self):
+        from calibre_plugins.kyobobook.transport import prewarm
+        from calibre_plugins.kyobobook.resilience import circuit_breaker, OPEN, CLOSED
+        with mock.patch.object(circuit_breaker, 'state', lambda host: OPEN if host.startswith('image.') else CLOSED):
+            prewarm([self.plugin.BASE_URL, self.plugin.IMAGE_URL], 5)
+        self.assertEqual(self.transport.requests, [('warm', [self.plugin.BASE_URL])])
+        # Transports without connections to keep are left alone
+        use_transport(self, CorpusTransport())
+        prewarm([self.plugin.BASE_URL], 5)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import unittest
+from threading import Thread
+from unittest import mock
+
+from support import TempDirTestCase
+
+from calibre_plugins.kyobobook import profiling
+from calibre_plugins.kyobobook.profiling import Profiler, merge
+
+
+class WarningLog(object):
+    
+    def __init__(self):
+        self.warnings = []
+    
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+def work():
+    return sum(range(1000))
+
+
+class ProfilerTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.profiler = Profiler(self.path('profiles'))
+        self.profiler.log = WarningLog()
+    
+    def files(self):
+        return sorted(name.partition('-')[0] for name in os.listdir(self.path('profiles')))
+    
+    def test_disabled(self):
+        self.assertIs(Profiler().profile('identify'), profiling.NO_PROFILE)
+    
+    def test_profile_written(self):
+        with self.profiler.profile('identify/답사기 1'):
+            work()
+        self.assertEqual(self.files(), ['identify_답사기_1'])
+        stats = merge(self.path('profiles'))
+        self.assertTrue(any(func[2] == 'work' for func in stats.stats))
+        self.assertEqual(self.profiler.active, 0)
+    
+    @unittest.skipIf(profiling.PROCESS_WIDE, 'one profile at a time from Python 3.12 on')
+    def test_worker_threads_profiled_on_their_own(self):
+        def run():
+            with self.profiler.profile('worker'):
+                work()
+        
+        with self.profiler.profile('identify'):
+            worker = Thread(target=run)
+            worker.start()
+            worker.join()
+        self.assertEqual(self.files(), ['identify', 'worker'])
+        self.assertEqual(self.profiler.log.warnings, [])
+    
+    def test_process_wide_profile_not_nested(self):
+        # What Python 3.12 and later do, the worker is in the identify profile
+        patcher = mock.patch.object(profiling, 'PROCESS_WIDE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with self.profiler.profile('identify'):
+            for i in range(2):
+                with self.profiler.profile('worker'):
+                    work()
+        self.assertEqual(self.files(), ['identify'])
+        self.assertEqual(len(self.profiler.log.warnings), 1)
+        self.assertIn('Python 3.12', self.profiler.log.warnings[0])
+    
+    def test_failure_logged(self):
+        profile = mock.Mock()
+        profile.enable.side_effect = ValueError('Another profiling tool is already active')
+        with mock.patch.object(profiling.cProfile, 'Profile', return_value=profile):
+            with self.profiler.profile('identify'):
+                work()
+        self.assertEqual(self.files(), [])
+        self.assertEqual(len(self.profiler.log.warnings), 1)
+        self.assertIn('Another profiling tool', self.profiler.log.warnings[0])
+        self.assertEqual(self.profiler.active, 0)
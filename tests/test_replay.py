@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+from queue import Queue
+from unittest import mock
+
+from six.moves.urllib.error import URLError
+
+from support import TempDirTestCase, QuietLog, corpus, detail_url, use_prefs, use_stores
+from corpus import image_url
+from standin import StandinServer
+
+from calibre_plugins.kyobobook.cassette import Recorder, Player, FaultInjector
+from calibre_plugins.kyobobook.transport import STANDIN_ENV
+
+# Books of the corpus with a cover
+BOOKS = [book for book in corpus.books if corpus.cover(book['barcode'])[0] is not None][:3]
+
+
+class CassetteTest(TempDirTestCase):
+    """
+    The corpus served by the stand-in server (bench/standin.py) is recorded with cassette.Recorder
+    through the pooled transport, then replayed with cassette.Player once the server is stopped.
+    The requests go through open_url like the plugin's own.
+    """
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        from calibre_plugins.kyobobook import transport, pool
+        from calibre_plugins.kyobobook.resilience import circuit_breaker
+        self.transport = transport
+        self.cassette = self.path('cassette')
+        self.addCleanup(circuit_breaker.reset)
+        use_prefs(self)
+        # The stand-in is local, whatever proxy the machine uses
+        patcher = mock.patch.object(pool, '_proxies', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def use(self, transport):
+        old = self.transport.set_transport(transport)
+        self.addCleanup(self.transport.set_transport, old)
+    
+    def record(self, func):
+        # Run func with the requests recorded from the stand-in server, returns its result and the server stats
+        from calibre_plugins.kyobobook.pool import PooledTransport, ConnectionPool
+        from calibre_plugins.kyobobook.transport import LiveTransport
+        connections = ConnectionPool()
+        self.addCleanup(connections.clear)
+        with StandinServer() as server, mock.patch.dict(os.environ, {STANDIN_ENV: server.url}):
+            self.use(Recorder(self.cassette, PooledTransport(connections, LiveTransport())))
+            result = func()
+            stats = server.stats()
+        self.use(Player(self.cassette))
+        return result, stats
+    
+    def fetch_books(self):
+        # The details page and the cover headers of every book
+        open_url = self.transport.open_url
+        fetched = {}
+        for book in BOOKS:
+            page = open_url(None, detail_url(book), 10).read()
+            response = open_url(None, image_url(book['barcode']), 10, head=True)
+            fetched[book['barcode']] = (page, response.info().get('Content-Length'))
+            response.close()
+        return fetched
+    
+    def test_replayed_as_recorded(self):
+        from calibre_plugins.kyobobook.parsing import parse_details_page
+        recorded, stats = self.record(self.fetch_books)
+        self.assertEqual(sum(stats['requests'].values()), 2 * len(BOOKS))
+        self.assertEqual(self.fetch_books(), recorded)
+        for book in BOOKS:
+            page, length = recorded[book['barcode']]
+            self.assertEqual(page, corpus.detail(book['barcode']))
+            self.assertEqual(int(length), len(corpus.cover(book['barcode'])[0]))
+            record, candidates = parse_details_page(detail_url(book), page)
+            self.assertEqual((record['id'], record['title']), (book['barcode'], book['title']))
+    
+    def test_not_in_cassette(self):
+        self.record(self.fetch_books)
+        player = Player(self.cassette)
+        self.assertRaises(URLError, player.open, None, 'http://www.kyobobook.co.kr/other', 10)
+    
+    def test_worker_offline(self):
+        # Worker.get_details gets the same book from the cassette as from the stand-in server
+        from calibre_plugins.kyobobook import Kyobobook
+        from calibre_plugins.kyobobook.worker import Worker
+        plugin = Kyobobook(None)
+        book = BOOKS[0]
+        
+        def details():
+            use_stores(self)
+            results = Queue()
+            Worker(detail_url(book), results, plugin.browser, QuietLog(), 0, plugin, use_cache=False).get_details()
+            mi = results.get_nowait()
+            self.assertTrue(results.empty())
+            return mi.title, mi.authors, mi.publisher, mi.isbn, plugin.cached_identifier_to_cover_url(book['barcode'])
+        
+        recorded, stats = self.record(details)
+        self.assertEqual(recorded[0], book['title'])
+        self.assertIsNotNone(recorded[4])
+        self.assertEqual(details(), recorded)
+    
+    def test_faults_repeat(self):
+        self.record(self.fetch_books)
+        urls = [detail_url(book) for book in BOOKS] * 4
+        
+        def outcomes():
+            injector = FaultInjector(Player(self.cassette), '404=0.3,truncate=0.3,seed=7')
+            found = []
+            for url in urls:
+                try:
+                    found.append(len(injector.open(None, url, 10).read()))
+                except Exception as e:
+                    found.append(getattr(e, 'code', None))
+            return found
+        
+        first = outcomes()
+        self.assertEqual(outcomes(), first)
+        self.assertIn(404, first)
+        # and truncated bodies
+        sizes = [len(corpus.detail(book['barcode'])) for book in BOOKS] * 4
+        self.assertTrue(any(n not in (404, size) for n, size in zip(first, sizes)))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import time
+import socket
+import unittest
+from threading import Thread
+from unittest import mock
+
+from six.moves import http_client
+from six.moves.urllib.error import HTTPError, URLError
+
+from support import wait_for
+
+from calibre_plugins.kyobobook.resilience import is_transient, CircuitBreaker, CircuitOpen, RetryPolicy
+from calibre_plugins.kyobobook.resilience import CLOSED, OPEN, HALF_OPEN
+from calibre_plugins.kyobobook.ratelimit import ConcurrencyLimiter
+from calibre_plugins.kyobobook.deadline import Cancelled
+
+
+def http_error(code, headers=None):
+    return HTTPError('http://www.kyobobook.co.kr/', code, 'HTTP Error %d' % code, headers or {}, io.BytesIO())
+
+
+class IsTransientTest(unittest.TestCase):
+    
+    def test_http_codes(self):
+        for code in (408, 429, 500, 502, 503):
+            self.assertTrue(is_transient(http_error(code)), code)
+        for code in (400, 403, 404):
+            self.assertFalse(is_transient(http_error(code)), code)
+    
+    def test_network_errors(self):
+        for e in (socket.timeout('timed out'), URLError(socket.timeout('timed out')), URLError('refused'),
+                  ConnectionResetError(), http_client.RemoteDisconnected(), http_client.IncompleteRead(b'')):
+            self.assertTrue(is_transient(e), repr(e))
+    
+    def test_not_transient(self):
+        # Bugs of the plugin and stopped requests are not worth trying again
+        for e in (ValueError(), KeyError('id'), AttributeError(), Cancelled('aborted'), CircuitOpen('open')):
+            self.assertFalse(is_transient(e), repr(e))
+
+
+class RetryPolicyTest(unittest.TestCase):
+    
+    def test_delay(self):
+        policy = RetryPolicy(attempts=3, base_delay=0.5, max_delay=8.0)
+        self.assertIsNone(policy.delay(0, http_error(404)))
+        self.assertIsNone(policy.delay(0, ValueError()))
+        self.assertLessEqual(policy.delay(1, http_error(503)), 1.0)
+        self.assertIsNone(policy.delay(2, http_error(503)))
+    
+    def test_retry_after(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.delay(0, http_error(429, {'Retry-After': '2'})), 2.0)
+        # Longer than worth waiting for
+        self.assertIsNone(policy.delay(0, http_error(429, {'Retry-After': '3600'})))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    
+    HOST = 'www.kyobobook.co.kr'
+    
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_after=0.05)
+    
+    def fail(self, times=1):
+        for _ in range(times):
+            self.breaker.record_error(self.HOST, socket.timeout('timed out'))
+    
+    def test_opens_after_failures_in_a_row(self):
+        self.fail(2)
+        self.breaker.record(self.HOST, ok=True)
+        self.fail(2)
+        self.assertEqual(self.breaker.state(self.HOST), CLOSED)
+        self.breaker.before(self.HOST)
+        self.fail()
+        self.assertEqual(self.breaker.state(self.HOST), OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.before, self.HOST)
+        # Other hosts are not affected
+        self.breaker.before('image.kyobobook.co.kr')
+    
+    def test_probe_closes(self):
+        self.fail(3)
+        time.sleep(0.06)
+        # One probe is let through, the other requests keep failing fast until it is done
+        self.breaker.before(self.HOST)
+        self.assertEqual(self.breaker.state(self.HOST), HALF_OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.before, self.HOST)
+        self.breaker.record(self.HOST, ok=True)
+        self.assertEqual(self.breaker.state(self.HOST), CLOSED)
+        self.breaker.before(self.HOST)
+    
+    def test_failed_probe_opens_again(self):
+        self.fail(3)
+        time.sleep(0.06)
+        self.breaker.before(self.HOST)
+        self.fail()
+        self.assertEqual(self.breaker.state(self.HOST), OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.before, self.HOST)
+    
+    def test_errors_counted(self):
+        # A 404 shows that kyobobook is up, a bug of the plugin says nothing about it
+        self.fail(2)
+        self.breaker.record_error(self.HOST, http_error(404))
+        self.fail(2)
+        self.breaker.record_error(self.HOST, ValueError())
+        self.assertEqual(self.breaker.state(self.HOST), CLOSED)
+        self.breaker.record_error(self.HOST, http_error(503))
+        self.assertEqual(self.breaker.state(self.HOST), OPEN)
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    
+    HOST = 'www.kyobobook.co.kr'
+    
+    def test_acquire_and_release(self):
+        limiter = ConcurrencyLimiter(initial=2)
+        self.assertTrue(limiter.acquire(self.HOST))
+        self.assertTrue(limiter.acquire(self.HOST))
+        self.assertFalse(limiter.acquire(self.HOST, timeout=0.05))
+        limiter.release(self.HOST)
+        self.assertTrue(limiter.acquire(self.HOST, timeout=0.05))
+        self.assertEqual(limiter.snapshot()[self.HOST]['in_flight'], 2)
+    
+    def test_release_wakes_waiting(self):
+        limiter = ConcurrencyLimiter(initial=1)
+        limiter.acquire(self.HOST)
+        acquired = []
+        t = Thread(target=lambda: acquired.append(limiter.acquire(self.HOST, timeout=5)))
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        limiter.release(self.HOST, latency=0.1)
+        t.join(5)
+        self.assertEqual(acquired, [True])
+    
+    def test_limit_adapts(self):
+        limiter = ConcurrencyLimiter(initial=4, cooldown=0)
+        # The limit grows by about one for every limit healthy responses
+        for _ in range(5):
+            limiter.acquire(self.HOST)
+            limiter.release(self.HOST, latency=0.1)
+        self.assertEqual(limiter.snapshot()[self.HOST]['limit'], 5)
+        limiter.acquire(self.HOST)
+        limiter.release(self.HOST, latency=0.1, congested=True)
+        self.assertEqual(limiter.snapshot()[self.HOST]['limit'], 2)
+        # A request that was never sent says nothing about the host
+        limiter.acquire(self.HOST)
+        limiter.release(self.HOST)
+        self.assertEqual(limiter.snapshot()[self.HOST]['limit'], 2)
+
+
+class FakeTransport(object):
+    # Answers every request with body, or raises error
+    
+    paced = True
+    
+    def __init__(self, body=b'x' * 100, error=None, response_class=None):
+        from calibre_plugins.kyobobook.cassette import ReplayResponse
+        self.body, self.error = body, error
+        self.response_class = response_class or ReplayResponse
+    
+    def open(self, br, url, timeout, head=False):
+        if self.error is not None:
+            raise self.error
+        return self.response_class(url, 200, [['Content-Length', str(len(self.body))]], self.body)
+
+
+class SlotReleaseTest(unittest.TestCase):
+    """
+    open_url holds a connection slot of the ConcurrencyLimiter until the response is read or closed.
+    """
+    
+    URL = 'http://slots.kyobobook.co.kr/product/detailViewKor.laf?barcode=9788936470111'
+    HOST = 'slots.kyobobook.co.kr'
+    
+    def setUp(self):
+        from calibre_plugins.kyobobook import transport
+        from calibre_plugins.kyobobook.resilience import circuit_breaker, retry_policy
+        self.transport = transport
+        self.addCleanup(circuit_breaker.reset)
+        patcher = mock.patch.object(retry_policy, 'attempts', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def use(self, fake):
+        old = self.transport.set_transport(fake)
+        self.addCleanup(self.transport.set_transport, old)
+    
+    def in_flight(self):
+        from calibre_plugins.kyobobook.ratelimit import concurrency_limiter
+        return concurrency_limiter.snapshot().get(self.HOST, {}).get('in_flight', 0)
+    
+    def test_released_when_read(self):
+        self.use(FakeTransport())
+        response = self.transport.open_url(None, self.URL, 5)
+        self.assertEqual(self.in_flight(), 1)
+        response.read(10)
+        self.assertEqual(self.in_flight(), 1)
+        response.read()
+        self.assertEqual(self.in_flight(), 0)
+    
+    def test_released_when_closed(self):
+        self.use(FakeTransport())
+        response = self.transport.open_url(None, self.URL, 5, head=True)
+        response.info()
+        response.close()
+        self.assertEqual(self.in_flight(), 0)
+        # Only once
+        response.close()
+        self.assertEqual(self.in_flight(), 0)
+    
+    def test_released_when_dropped(self):
+        self.use(FakeTransport())
+        self.transport.open_url(None, self.URL, 5)
+        self.assertTrue(wait_for(lambda: self.in_flight() == 0))
+    
+    def test_released_on_error(self):
+        self.use(FakeTransport(error=http_error(404)))
+        self.assertRaises(HTTPError, self.transport.open_url, None, self.URL, 5)
+        self.assertEqual(self.in_flight(), 0)
+    
+    def test_released_when_read_fails(self):
+        from calibre_plugins.kyobobook.cassette import ReplayResponse
+        
+        class BrokenResponse(ReplayResponse):
+            def read(self, size=-1):
+                raise http_client.IncompleteRead(b'')
+        
+        self.use(FakeTransport(response_class=BrokenResponse))
+        response = self.transport.open_url(None, self.URL, 5)
+        self.assertRaises(http_client.IncompleteRead, response.read)
+        self.assertEqual(self.in_flight(), 0)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import unittest
+from threading import Event
+
+from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+from calibre_plugins.kyobobook.metrics import metrics
+from calibre_plugins.kyobobook.speculation import Speculation
+
+
+def speculations():
+    return metrics.snapshot()['speculations']
+
+
+def search(deadline):
+    # Sends a request every 10 milliseconds, like a search and its details pages
+    for i in range(3):
+        deadline.check()
+        time.sleep(0.01)
+    return ['match']
+
+
+class SpeculationTest(unittest.TestCase):
+    
+    def test_result_used(self):
+        before = speculations()
+        speculation = Speculation(search, Deadline(10))
+        self.assertFalse(speculation.started)
+        speculation.start()
+        self.assertTrue(speculation.started)
+        self.assertEqual(speculation.result(), ['match'])
+        self.assertEqual(speculations(), {'started': before['started'] + 1, 'used': before['used'] + 1})
+    
+    def test_cancelled_before_its_next_request(self):
+        before = speculations()
+        started, stop = Event(), Event()
+        
+        def fn(deadline):
+            started.set()
+            stop.wait(5)
+            return search(deadline)
+        speculation = Speculation(fn, Deadline(10))
+        speculation.start()
+        started.wait(5)
+        speculation.cancel()
+        stop.set()
+        self.assertRaises(Cancelled, speculation.result)
+        # Not used
+        self.assertEqual(speculations()['used'], before['used'])
+    
+    def test_error_raised(self):
+        def fn(deadline):
+            raise ValueError('broken page')
+        speculation = Speculation(fn, Deadline(10))
+        speculation.start()
+        self.assertRaises(ValueError, speculation.result)
+    
+    def test_result_waits_no_longer_than_the_deadline(self):
+        stop = Event()
+        self.addCleanup(stop.set)
+        speculation = Speculation(lambda deadline: stop.wait(5), Deadline(0.1))
+        speculation.start()
+        start = time.monotonic()
+        self.assertRaises(Cancelled, speculation.result)
+        self.assertLess(time.monotonic() - start, 1)
+    
+    def test_aborted_with_the_identify(self):
+        abort = Event()
+        speculation = Speculation(search, Deadline(10, abort))
+        abort.set()
+        speculation.start()
+        self.assertRaises(Cancelled, speculation.result)
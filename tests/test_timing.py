@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import unittest
+from threading import Thread
+
+from calibre_plugins.kyobobook.timing import PhaseTimer, PhaseStats
+
+
+class PhaseTimerTest(unittest.TestCase):
+    
+    def test_phases_added_up(self):
+        timer = PhaseTimer('details')
+        with timer('fetch'):
+            time.sleep(0.01)
+        with timer('fetch'):
+            pass
+        timer.add('parse', 0.5)
+        timer.stop()
+        data = timer.as_dict()
+        self.assertEqual(list(data['phases']), ['fetch', 'parse'])
+        self.assertEqual(data['phases']['fetch']['count'], 2)
+        self.assertGreaterEqual(data['phases']['fetch']['seconds'], 0.01)
+        self.assertEqual(data['phases']['parse'], {'seconds': 0.5, 'count': 1})
+        self.assertGreaterEqual(data['total'], 0.01)
+        summary = timer.summary()
+        self.assertTrue(summary.startswith('details timing: '), summary)
+        self.assertIn('(x2)', summary)
+        self.assertIn('parse 500 ms', summary)
+    
+    def test_phase_timed_when_it_fails(self):
+        timer = PhaseTimer()
+        with self.assertRaises(ValueError):
+            with timer('parse'):
+                raise ValueError()
+        self.assertEqual(timer.as_dict()['phases']['parse']['count'], 1)
+    
+    def test_shared_between_threads(self):
+        # The identify thread and its workers add to the same timer
+        timer = PhaseTimer()
+        
+        def work():
+            for i in range(1000):
+                timer.add('parse', 0.001)
+        
+        threads = [Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(timer.as_dict()['phases']['parse']['count'], 4000)
+
+
+class PhaseStatsTest(unittest.TestCase):
+    
+    def test_totals(self):
+        stats, seen = PhaseStats(), []
+        stats.listeners.append(lambda timer: 1 / 0)
+        stats.listeners.append(seen.append)
+        for seconds in (0.2, 0.4):
+            timer = PhaseTimer()
+            timer.add('fetch', seconds)
+            stats.record(timer.stop())
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['count'], 2)
+        self.assertEqual(snapshot['phases']['fetch']['count'], 2)
+        self.assertAlmostEqual(snapshot['phases']['fetch']['mean'], 0.3)
+        # A broken listener does not stop the others
+        self.assertEqual(len(seen), 2)
+        stats.reset()
+        self.assertEqual(stats.snapshot()['count'], 0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import json
+from threading import Thread
+from unittest import mock
+
+from support import TempDirTestCase
+
+from calibre_plugins.kyobobook.tracing import Tracer, NULL_SPAN, to_chrome
+
+
+class TracerTest(TempDirTestCase):
+    
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.tracer = Tracer(self.path('trace.jsonl'))
+        self.addCleanup(self.tracer.disable)
+    
+    def spans(self):
+        with io.open(self.path('trace.jsonl'), encoding='utf-8') as f:
+            return dict((s['name'], s) for s in map(json.loads, f))
+    
+    def test_disabled(self):
+        self.assertIs(Tracer().span('identify'), NULL_SPAN)
+        self.tracer.disable()
+        self.assertIs(self.tracer.span('identify'), NULL_SPAN)
+    
+    def test_nested(self):
+        with self.tracer.span('identify', title='답사기') as identify:
+            with self.tracer.span('search') as search:
+                search.set(bytes=10)
+            
+            def work():
+                # A worker thread names its parent
+                with self.tracer.span('worker', parent=identify.id):
+                    pass
+            
+            worker = Thread(target=work)
+            worker.start()
+            worker.join()
+        with self.assertRaises(ValueError):
+            with self.tracer.span('parse'):
+                raise ValueError()
+        spans = self.spans()
+        self.assertEqual(spans['identify']['attrs'], {'title': '답사기'})
+        self.assertIsNone(spans['identify']['parent'])
+        self.assertEqual(spans['search']['parent'], identify.id)
+        self.assertEqual(spans['search']['attrs'], {'bytes': 10})
+        self.assertEqual(spans['worker']['parent'], identify.id)
+        self.assertNotEqual(spans['worker']['tid'], spans['search']['tid'])
+        self.assertEqual(spans['search']['outcome'], 'ok')
+        self.assertEqual(spans['parse']['outcome'], 'error: ValueError')
+        self.assertIsNone(spans['parse']['parent'])
+        self.assertLessEqual(spans['identify']['start'], spans['search']['start'])
+        self.assertLessEqual(spans['search']['end'], spans['identify']['end'])
+    
+    def test_phases_are_spans(self):
+        from calibre_plugins.kyobobook import timing
+        patcher = mock.patch.object(timing, 'tracer', self.tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        timer = timing.PhaseTimer()
+        with self.tracer.span('identify') as identify:
+            with timer('search_read') as span:
+                span.set(bytes=5)
+        spans = self.spans()
+        self.assertEqual((spans['search_read']['parent'], spans['search_read']['attrs']), (identify.id, {'bytes': 5}))
+        self.assertEqual(timer.as_dict()['phases']['search_read']['count'], 1)
+    
+    def test_to_chrome(self):
+        with self.tracer.span('identify'):
+            with self.tracer.span('search'):
+                pass
+        self.assertEqual(to_chrome(self.path('trace.jsonl'), self.path('trace.json')), 2)
+        with io.open(self.path('trace.json'), encoding='utf-8') as f:
+            events = json.load(f)['traceEvents']
+        spans = dict((e['name'], e) for e in events if e['ph'] == 'X')
+        self.assertEqual(sorted(spans), ['identify', 'search'])
+        self.assertEqual(spans['identify']['ts'], 0)
+        self.assertGreaterEqual(spans['search']['ts'], 0)
+        self.assertEqual(spans['search']['args']['parent'], spans['identify']['args']['id'])
+        self.assertEqual([e['ph'] for e in events if e['name'] == 'thread_name'], ['M'])
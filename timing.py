@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter
+
+from calibre_plugins.kyobobook.tracing import tracer, NULL_SPAN
+
+"""
+[ 참고 ]============================================================
+* identify 한 번에 걸린 시간을 단계별로 잰다. (검색 페이지 받기, 디코딩, 파싱, 책 페이지 받기, parse_* ...)
+* 책 페이지는 Worker 스레드들이 동시에 처리하므로 단계별 시간의 합은 전체 시간보다 길 수 있다.
+* 여러 identify 의 합계는 identify_stats 에 모인다. (bulk 작업에서 사용)
+"""
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'start')
+    
+    def __init__(self, timer, name):
+        self.timer, self.name = timer, name
+    
+    def __enter__(self):
+        self.start = perf_counter()
+        return NULL_SPAN
+    
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, perf_counter() - self.start)
+
+
+class _TracedPhase(_Phase):
+    # Also a span of the trace, only used while tracing
+    __slots__ = ('span',)
+    
+    def __enter__(self):
+        self.span = tracer.span(self.name)
+        self.span.__enter__()
+        self.start = perf_counter()
+        return self.span
+    
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, perf_counter() - self.start)
+        self.span.__exit__(*exc_info)
+
+
+class PhaseTimer(object):
+    """
+    Time spent in each phase of one identify, added to by the identify thread and its workers.
+    Entering a phase returns its trace span (see tracing.py) to set attributes on:
+
+        with timer('search_read') as span:
+            raw = response.read()
+            span.set(bytes=len(raw))
+    """
+    
+    def __init__(self, name='identify'):
+        self.name = name
+        self.started = perf_counter()
+        self.elapsed = None
+        self.phases = OrderedDict()  # phase -> [seconds, count]
+        self._lock = Lock()
+    
+    def __call__(self, phase):
+        if tracer.enabled:
+            return _TracedPhase(self, phase)
+        return _Phase(self, phase)
+    
+    def add(self, phase, seconds):
+        with self._lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                self.phases[phase] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+    
+    def stop(self):
+        self.elapsed = perf_counter() - self.started
+        return self
+    
+    def as_dict(self):
+        with self._lock:
+            return {'name': self.name, 'total': self.elapsed,
+                    'phases': OrderedDict((p, {'seconds': s, 'count': n}) for p, (s, n) in self.phases.items())}
+    
+    def summary(self):
+        with self._lock:
+            phases = ', '.join('%s %.0f ms%s' % (p, s * 1000, ' (x%d)' % n if n > 1 else '')
+                               for p, (s, n) in self.phases.items())
+        total = self.elapsed if self.elapsed is not None else perf_counter() - self.started
+        return '%s timing: %.0f ms total; %s' % (self.name, total * 1000, phases)
+
+
+class PhaseStats(object):
+    """
+    Totals of the phase timings of every identify in this process. Listeners are called
+    with each finished PhaseTimer.
+    """
+    
+    def __init__(self):
+        self._lock = Lock()
+        self.listeners = []
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.phases = OrderedDict()  # phase -> [seconds, count]
+    
+    def record(self, timer):
+        data = timer.as_dict()
+        with self._lock:
+            self.count += 1
+            self.total += data['total'] or 0
+            for phase, entry in data['phases'].items():
+                totals = self.phases.setdefault(phase, [0.0, 0])
+                totals[0] += entry['seconds']
+                totals[1] += entry['count']
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(timer)
+            except Exception:
+                # A broken listener must not fail the identify
+                pass
+    
+    def snapshot(self):
+        """
+        Return {'count', 'total', 'phases': {phase: {'seconds', 'count', 'mean'}}}, times in seconds.
+        """
+        with self._lock:
+            return {'count': self.count, 'total': self.total,
+                    'phases': OrderedDict((p, {'seconds': s, 'count': n, 'mean': s / n if n else 0})
+                                          for p, (s, n) in self.phases.items())}
+
+
+# Shared by all identify calls in this process
+identify_stats = PhaseStats()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import io
+import os
+import json
+import time
+import itertools
+import threading
+
+"""
+[ 참고 ]============================================================
+* identify 의 각 단계를 span 으로 기록해서 JSON lines 파일로 남긴다. 기본값은 꺼져 있다.
+  켜려면 : KYOBOBOOK_TRACE=/tmp/kyobobook-trace.jsonl calibre-debug -g
+* span 은 identify > (검색 단계들, worker > (책 페이지 단계들, parse_*, cover_probe)) 처럼 중첩된다.
+* 크롬(chrome://tracing, Perfetto)에서 보려면 :
+  calibre-debug -e tracing.py -- chrome /tmp/kyobobook-trace.jsonl /tmp/kyobobook-trace.json
+"""
+
+TRACE_ENV = 'KYOBOBOOK_TRACE'
+
+
+class NullSpan(object):
+    """
+    What the tracer hands out when it is disabled, does nothing.
+    """
+    id = None
+    
+    def set(self, **attrs):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    
+    def __init__(self, tracer, name, parent, attrs):
+        self.tracer = tracer
+        self.id = next(tracer.ids)
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = self.end = None
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def __enter__(self):
+        self.start = time.time()
+        self.tracer._push(self)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+        self.tracer._pop(self)
+        if exc_type is not None:
+            self.attrs['outcome'] = 'error: %s' % exc_type.__name__
+        thread = threading.current_thread()
+        self.tracer.write({
+            'id': self.id, 'parent': self.parent, 'name': self.name, 'start': self.start, 'end': self.end,
+            'pid': os.getpid(), 'tid': thread.ident, 'thread': thread.name,
+            'outcome': self.attrs.pop('outcome', 'ok'), 'attrs': self.attrs})
+
+
+class Tracer(object):
+    """
+    Writes nested spans as JSON lines. Spans started in a thread are children of the span
+    the thread is in, a span started in another thread (a worker) takes its parent explicitly.
+    """
+    
+    def __init__(self, path=None):
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = None
+        self.path = None
+        self.enabled = False
+        if path:
+            self.enable(path)
+    
+    def enable(self, path):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self.path = path
+            self._file = io.open(path, 'a', encoding='utf-8')
+            self.enabled = True
+    
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    def span(self, name, parent=False, **attrs):
+        """
+        A span to use as a context manager. parent is the id of the parent span,
+        by default the span the current thread is in.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        if parent is False:
+            parent = self.current().id
+        return Span(self, name, parent, attrs)
+    
+    def current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else NULL_SPAN
+    
+    def _push(self, span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+    
+    def _pop(self, span):
+        stack = self._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+    
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=repr) + '\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self._file.flush()
+
+
+def to_chrome(jsonl_path, out_path):
+    """
+    Convert a trace to the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+    """
+    spans = []
+    with io.open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                spans.append(json.loads(line))
+    origin = min(s['start'] for s in spans) if spans else 0
+    events = []
+    threads = {}
+    for s in spans:
+        threads[(s['pid'], s['tid'])] = s['thread']
+        args = dict(s['attrs'], outcome=s['outcome'], id=s['id'], parent=s['parent'])
+        events.append({'name': s['name'], 'ph': 'X', 'pid': s['pid'], 'tid': s['tid'],
+                       'ts': (s['start'] - origin) * 1e6, 'dur': (s['end'] - s['start']) * 1e6, 'args': args})
+    for (pid, tid), name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+    with io.open(out_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, ensure_ascii=False))
+    return len(spans)
+
+
+# Shared by all identify calls in this process, enabled by the KYOBOBOOK_TRACE environment variable
+tracer = Tracer(os.environ.get(TRACE_ENV))
+
+
+if __name__ == '__main__':
+    # calibre-debug -e tracing.py -- chrome trace.jsonl trace.json
+    import sys
+    args = sys.argv[1:]
+    if len(args) != 3 or args[0] != 'chrome':
+        print('Usage: calibre-debug -e tracing.py -- chrome <trace.jsonl> <trace.json>')
+        raise SystemExit(1)
+    print('Converted %d spans' % to_chrome(args[1], args[2]))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, YongSeok Choi <sseeookk@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+from threading import Lock
+
+from six.moves.urllib.parse import urlsplit
+
+from calibre_plugins.kyobobook.ratelimit import rate_limiter, concurrency_limiter
+from calibre_plugins.kyobobook.metrics import metrics, fetch_kind, failure_kind
+from calibre_plugins.kyobobook.cassette import from_environ
+from calibre_plugins.kyobobook.deadline import Cancelled
+from calibre_plugins.kyobobook.resilience import retry_policy, circuit_breaker, is_transient, CircuitOpen, OPEN
+from calibre_plugins.kyobobook.hedging import hedger, hedging_enabled
+from calibre_plugins.kyobobook.pool import PooledTransport, connection_pool
+
+# When set, every kyobobook request goes to this local stand-in server instead (see bench/standin.py)
+STANDIN_ENV = 'KYOBOBOOK_STANDIN_URL'
+
+
+def standin_url(url):
+    """
+    Rewrite a kyobobook url to http://<stand-in>/<host>/<path>?<query> if a stand-in server is configured.
+    """
+    base = os.environ.get(STANDIN_ENV)
+    if not base:
+        return url
+    parts = urlsplit(url)
+    if not parts.netloc.endswith('kyobobook.co.kr'):
+        return url
+    return '%s/%s%s%s' % (base.rstrip('/'), parts.netloc, parts.path or '/', '?' + parts.query if parts.query else '')
+
+
+class LiveTransport(object):
+    """
+    Sends the requests with the browser, each on a new connection. Used through a proxy, see pool.py.
+    Transports wrapping it (see pool.py and cassette.py) have the same open method,
+    paced is False for those that never reach kyobobook and need no rate limit.
+    With head only the headers are needed, a transport may still send a GET. The browser does,
+    closing its response drops the connection without reading the body.
+    """
+    paced = True
+    
+    def open(self, br, url, timeout, head=False):
+        return br.open_novisit(standin_url(url), timeout=timeout)
+
+
+class CountingResponse(object):
+    """
+    Response of open_url, counts the bytes read from it.
+    """
+    
+    def __init__(self, response, kind):
+        self._response, self._kind = response, kind
+    
+    def read(self, *args):
+        data = self._response.read(*args)
+        metrics.received(self._kind, len(data))
+        return data
+    
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class SlotResponse(object):
+    """
+    Response of a paced request, holds its connection slot of the ConcurrencyLimiter until
+    the body was read or the response closed. The latency reported includes reading the body.
+    """
+    
+    def __init__(self, response, host, sent):
+        self._response, self._host, self._sent = response, host, sent
+        self._lock = Lock()
+        self._held = True
+    
+    def read(self, *args):
+        try:
+            data = self._response.read(*args)
+        except Exception as e:
+            self._release(congested=is_transient(e))
+            raise
+        if not data or not args or args[0] is None or args[0] < 0:
+            self._release()
+        return data
+    
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._release()
+    
+    def _release(self, congested=False):
+        with self._lock:
+            if not self._held:
+                return
+            self._held = False
+        concurrency_limiter.release(self._host, time.perf_counter() - self._sent, congested)
+    
+    def __del__(self):
+        # A response dropped without being read or closed
+        self._release()
+    
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def open_url(br, url, timeout, deadline=None, hedge=False, head=False):
+    """
+    Open url with the browser br. All the plugin's requests to kyobobook go through here.
+    With a deadline (see deadline.py) the request gets no more than the time left, and
+    Cancelled is raised instead once there is none or the identify was aborted.
+    Transient failures are retried and hosts that keep failing are skipped, see resilience.py.
+    With hedge, a second request is sent if the first is slow and hedging is turned on, see hedging.py.
+    With head, only the headers of the response are used, like when a cover is checked.
+    """
+    if hedge and hedging_enabled():
+        return hedger.open(br, url, timeout, deadline, _open_resilient)
+    return _open_resilient(br, url, timeout, deadline, head)
+
+
+def _open_resilient(br, url, timeout, deadline, head=False):
+    host = rate_limiter.host_of(url)
+    attempt = 0
+    while True:
+        try:
+            circuit_breaker.before(host)
+        except CircuitOpen:
+            metrics.skipped_request()
+            raise
+        try:
+            response = _open(br, url, timeout, deadline, head)
+        except Cancelled:
+            raise
+        except Exception as e:
+            circuit_breaker.record_error(host, e)
+            delay = retry_policy.delay(attempt, e)
+            if delay is None:
+                raise
+            if deadline is not None:
+                remaining = deadline.remaining()
+                if remaining is not None and remaining < delay:
+                    raise
+                if not deadline.sleep(delay):
+                    raise
+            else:
+                time.sleep(delay)
+            metrics.retried()
+            attempt += 1
+            continue
+        circuit_breaker.record(host, ok=True)
+        return response
+
+
+def _open(br, url, timeout, deadline, head=False):
+    kind = fetch_kind(url)
+    if deadline is not None:
+        deadline.check()
+    if not transport.paced:
+        return _send(br, url, timeout, deadline, kind, head)
+    
+    # Wait for a free connection to the host (see ConcurrencyLimiter), then for the request rate limit
+    host = rate_limiter.host_of(url)
+    start = time.perf_counter()
+    if not concurrency_limiter.acquire(host, timeout=deadline.remaining() if deadline is not None else None):
+        raise Cancelled('No time left to wait for a free connection to %s' % host)
+    latency, congested = None, False
+    try:
+        if not rate_limiter.wait(url, timeout=deadline.remaining() if deadline is not None else None):
+            raise Cancelled('No time left to wait for the request rate limit')
+        waited = time.perf_counter() - start
+        if waited > 0.001:
+            metrics.waited(waited)
+        sent = time.perf_counter()
+        try:
+            response = _send(br, url, timeout, deadline, kind, head)
+        except Cancelled:
+            raise
+        except Exception as e:
+            latency = time.perf_counter() - sent
+            # Timeouts, 429/5xx and lost connections make the limit smaller, answers like 404 do not
+            congested = is_transient(e)
+            raise
+    except BaseException:
+        concurrency_limiter.release(host, latency, congested)
+        raise
+    return SlotResponse(response, host, sent)
+
+
+def _send(br, url, timeout, deadline, kind, head=False):
+    if deadline is not None:
+        timeout = deadline.timeout_for(timeout)
+    
+    start = time.perf_counter()
+    try:
+        response = transport.open(br, url, timeout, head=head)
+    except Exception as e:
+        metrics.failed(failure_kind(e))
+        raise
+    # Time until the response headers arrived
+    metrics.fetched(kind, time.perf_counter() - start)
+    return CountingResponse(response, kind)
+
+
+def prewarm(urls, timeout, br=None):
+    """
+    Connect to the kyobobook hosts of urls in the background, if the transport keeps connections
+    (see pool.py) and the host is not being skipped for failing. https connections use the SSL settings of br.
+    """
+    warm = getattr(transport, 'warm', None)
+    if warm is None:
+        return
+    warm([url for url in urls if circuit_breaker.state(rate_limiter.host_of(url)) != OPEN], timeout, br)
+
+
+def set_transport(new):
+    """
+    Send the requests of open_url through new instead, returns the transport used until now.
+    """
+    global transport
+    old, transport = transport, new
+    return old
+
+
+# Recording, replaying and fault injection are set up from the environment, see cassette.py
+transport = from_environ(PooledTransport(connection_pool, LiveTransport()))
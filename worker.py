@@ -23,24 +23,48 @@ from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import canonicalize_lang
 
 import calibre_plugins.kyobobook.config as cfg
+from calibre_plugins.kyobobook.cache import metadata_cache, record_store, revalidator, LAYER_DETAIL
+from calibre_plugins.kyobobook.cache import SOURCE_PAGE, SOURCE_IMPORT
+from calibre_plugins.kyobobook.transport import open_url
+from calibre_plugins.kyobobook.archive import archive_page, KIND_DETAIL
+from calibre_plugins.kyobobook.index import index_record
+from calibre_plugins.kyobobook.timing import PhaseTimer
+from calibre_plugins.kyobobook.tracing import tracer
+from calibre_plugins.kyobobook.profiling import profiler
+from calibre_plugins.kyobobook.metrics import metrics
+from calibre_plugins.kyobobook.deadline import Deadline, Cancelled
+from calibre_plugins.kyobobook.resilience import CircuitOpen
 
 from six import text_type as unicode
 
 import contextlib
 
+# Bump whenever a parse_* method changes what ends up in the parsed record,
+# records stored by older versions are then ignored.
+PARSER_VERSION = 1
+
 
 class Worker(Thread):  # Get details
     """
     Get book details from Kyobobook book page in a separate thread
     """
     
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
+    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20, use_cache=True,
+                 timer=None, deadline=None):
         Thread.__init__(self)
         self.daemon = True
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        self.use_cache = use_cache
+        # Shared with the identify that started this worker
+        self.timer = timer if timer is not None else PhaseTimer('details')
+        # Also shared with the identify, the worker stops before its next request once it is aborted or out of time
+        self.deadline = deadline if deadline is not None else Deadline(timeout)
+        # The span of the thread creating the worker is the parent of the worker's span
+        self.trace_parent = tracer.current().id
+        # No browser when reparsing archived pages offline
+        self.browser = browser.clone_browser() if browser is not None else None
         self.cover_url = self.book_id = self.isbn = None
         
         lm = {
@@ -61,31 +85,116 @@ class Worker(Thread):  # Get details
                 self.lang_map[name] = code
     
     def run(self):
-        try:
-            self.get_details()
-        except Exception as e:
-            self.log.exception('get_details failed for url: %r' % self.url, exc_info=e)
+        # cProfile only sees the thread it was enabled in, so every worker is profiled on its own
+        with profiler.profile('worker-%s' % self.url.rpartition('barcode=')[2]), \
+                tracer.span('worker', parent=self.trace_parent, url=self.url, relevance=self.relevance):
+            try:
+                self.get_details()
+            except CircuitOpen as e:
+                self.log.error('Skipped getting details, %s: %r' % (e, self.url))
+            except Cancelled as e:
+                self.log.info('Stopped getting details (%s): %r' % (e, self.url))
+            except Exception as e:
+                self.log.exception('get_details failed for url: %r' % self.url, exc_info=e)
     
     def get_details(self):
+        if self.use_cache and self.lookup_cache():
+            return
+        
         try:
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+            raw = self.fetch_page()
+        except Cancelled:
+            raise
         except Exception as e:
-            if callable(getattr(e, 'getcode', None)) and getattr(e, "getcode")() == 404:
-                self.log.error('URL malformed: %r' % self.url)
-                return
-            attr = getattr(e, 'args', [None])
-            attr = attr if attr else [None]
-            if isinstance(attr[0], socket.timeout):
-                msg = 'Kyobobook timed out. Try again later.'
-                self.log.error(msg)
-            else:
-                msg = 'Failed to make details query: %r' % self.url
-                self.log.exception(msg)
+            self.fetch_failed(e)
+            self.use_imported_record()
             return
         
+        with self.timer('archive'):
+            archive_page(self.log, self.url, KIND_DETAIL, raw)
+        
+        self.deadline.check()
+        root = self.parse_page(raw)
+        if root is None:
+            return
+        
+        self.parse_details(root)
+    
+    def lookup_cache(self, partial=True):
+        """
+        Put the cached details in the result queue, see get_cached_details. Returns True if there were any.
+        """
+        with self.timer('detail_cache') as span:
+            hit = self.get_cached_details(partial=partial)
+            metrics.cache_lookup('detail', hit)
+            span.set(outcome='hit' if hit else 'miss')
+        return hit
+    
+    def fetch_page(self):
+        # Download the details page
+        with self.timer('detail_fetch') as span:
+            raw = open_url(self.browser, self.url, self.timeout, self.deadline, hedge=True).read().strip()
+            span.set(bytes=len(raw))
+        return raw
+    
+    def fetch_failed(self, e):
+        # Log why the details page could not be downloaded
+        if callable(getattr(e, 'getcode', None)) and getattr(e, "getcode")() == 404:
+            self.log.error('URL malformed: %r' % self.url)
+            return
+        attr = getattr(e, 'args', [None])
+        attr = attr if attr else [None]
+        if isinstance(attr[0], socket.timeout) or isinstance(getattr(e, 'reason', None), socket.timeout):
+            msg = 'Kyobobook timed out. Try again later.'
+            self.log.error(msg)
+        else:
+            msg = 'Failed to make details query: %r' % self.url
+            self.log.exception(msg)
+    
+    def use_imported_record(self):
+        # Without the details page, the record imported from a catalog export is better than nothing
+        try:
+            record, fetched = record_store.get(self.parse_book_id(self.url), PARSER_VERSION, source=SOURCE_IMPORT)
+        except Exception as e:
+            self.log.exception('Failed to read imported record for url: %r' % self.url, exc_info=e)
+            return False
+        if record is None:
+            return False
+        record['partial'] = True
+        self.log.info('Using the imported catalog record: %r' % self.url)
+        self.result_queue.put(self.build_metadata(record))
+        return True
+    
+    def parse_fetched(self, raw, parser=None):
+        """
+        Archive and parse a downloaded details page, without checking its cover.
+        Returns the record and the cover urls to check (see cover_candidates), or (None, None).
+        parser is a ParsePool (see parsing.py) to parse the page with instead of this thread.
+        """
+        with self.timer('archive'):
+            archive_page(self.log, self.url, KIND_DETAIL, raw)
+        
+        self.deadline.check()
+        if parser is not None:
+            with self.timer('parse'):
+                _, record, candidates = parser.parse(self.url, raw)
+            return record, candidates
+        root = self.parse_page(raw)
+        if root is None:
+            return None, None
+        record = self.parse_record(root, check_cover=False)
+        if record is None:
+            return None, None
+        return record, self.cover_candidates(root)
+    
+    def parse_page(self, raw):
+        """
+        Decode a raw details page and make sure it really is a book page. Returns None if it is not.
+        """
         # open('c:\\Kyobobook1.html', 'wb').write(raw)
         # raw = raw.decode('utf-8', errors='replace')  # 00
-        raw = raw.decode('euc-kr', 'ignore')  # kyobo detail page : EUC-KR
+        with self.timer('detail_decode'):
+            raw = raw.decode('euc-kr', 'ignore')  # kyobo detail page : EUC-KR
         # open('c:\\Kyobobook2.html', 'wb').write(raw)
         
         # if '<title>404 - ' in raw:
@@ -93,11 +202,14 @@ class Worker(Thread):  # Get details
         # return
         
         try:
-            root = fromstring(clean_ascii_chars(raw))
+            with self.timer('detail_clean'):
+                raw = clean_ascii_chars(raw)
+            with self.timer('detail_fromstring'):
+                root = fromstring(raw)
         except Exception as e:
             msg = 'Failed to parse Kyobobook details page: %r' % self.url
             self.log.exception(msg, exe_info=e)
-            return
+            return None
         
         try:
             # Look at the <title> attribute for page to make sure that we were actually returned
@@ -111,22 +223,114 @@ class Worker(Thread):  # Get details
                 # search fail : " - 인터넷교보문고"
                 if page_title is None or page_title == " - 인터넷교보문고":
                     self.log.error('Failed to see search results in page title: %r' % self.url)
-                    return
+                    return None
         except Exception as e:
             msg = 'Failed to read Kyobobook page title: %r' % self.url
             self.log.exception(msg, exe_info=e)
-            return
+            return None
         
         errmsg = root.xpath('//*[@id="errorMessage"]')
         if errmsg:
             msg = 'Failed to parse Kyobobook details page: %r' % self.url
             msg += tostring(errmsg, method='text', encoding=unicode).strip()
             self.log.error(msg)
-            return
+            return None
         
-        self.parse_details(root)
+        return root
+    
+    def get_cached_details(self, partial=True):
+        """
+        Put the cached details for this url in the result queue. Returns False if they have to be fetched.
+        Expired details are only used when stale-while-revalidate is enabled, and are refreshed in
+        the background. A partial record imported from a catalog export is used unless partial is False,
+        the details page is then fetched in the background.
+        """
+        record, stale = metadata_cache.get(LAYER_DETAIL, self.url)
+        if record is None:
+            record, stale = self.get_stored_record()
+        if record is None:
+            return False
+        if record.get('partial'):
+            if not partial:
+                return False
+            revalidator.submit((LAYER_DETAIL, self.url), self.refresh)
+            self.log.info('Using the imported catalog record, getting the details page in background: %r' % self.url)
+        elif stale:
+            if not cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_STALE_WHILE_REVALIDATE, False):
+                return False
+            revalidator.submit((LAYER_DETAIL, self.url), self.refresh)
+            self.log.info('Using expired cached details, refreshing in background: %r' % self.url)
+        else:
+            self.log.info('Using cached details: %r' % self.url)
+        
+        self.result_queue.put(self.build_metadata(record))
+        return True
+    
+    def get_stored_record(self):
+        # Look for a record parsed earlier, possibly by another calibre process, then for an imported one.
+        # Imported catalog records have no description and an unchecked cover, they are marked partial.
+        book_id = self.parse_book_id(self.url)
+        try:
+            record, fetched = record_store.get(book_id, PARSER_VERSION, source=SOURCE_PAGE)
+            if record is None:
+                record, fetched = record_store.get(book_id, PARSER_VERSION, source=SOURCE_IMPORT)
+                if record is not None:
+                    record['partial'] = True
+        except Exception as e:
+            self.log.exception('Failed to read stored record for url: %r' % self.url, exc_info=e)
+            return None, False
+        metrics.cache_lookup('store', record is not None)
+        if record is None:
+            return None, False
+        if record.get('cover_candidates') and not record.get('partial'):
+            record = self.check_stored_cover(record, fetched)
+        metadata_cache.put(LAYER_DETAIL, self.url, record, fetched=fetched)
+        return metadata_cache.get(LAYER_DETAIL, self.url)
+    
+    def check_stored_cover(self, record, fetched):
+        # A record reparsed from an archived page has cover candidates no one checked yet, see archive.reparse
+        if self.browser is None:
+            return record
+        record = dict(record)
+        with self.timer('parse_cover'):
+            record['cover'] = self.check_cover([tuple(c) for c in record.pop('cover_candidates')])
+        try:
+            record_store.put(record['id'], PARSER_VERSION, record, fetched=fetched)
+        except Exception as e:
+            self.log.exception('Failed to store record for url: %r' % self.url, exc_info=e)
+        return record
+    
+    def refresh(self):
+        # Runs on a revalidator thread, the parsed details end up in the cache
+        from queue import Queue
+        from calibre.utils.logging import default_log
+        Worker(self.url, Queue(), self.browser, default_log, self.relevance, self.plugin,
+               timeout=self.timeout, use_cache=False).get_details()
     
     def parse_details(self, root):
+        record = self.parse_record(root)
+        if record is None:
+            return
+        self.save_record(record)
+    
+    def save_record(self, record):
+        # Cache, store and index the parsed record, then hand it to calibre
+        metadata_cache.put(LAYER_DETAIL, self.url, record)
+        with self.timer('store'):
+            try:
+                record_store.put(record['id'], PARSER_VERSION, record)
+            except Exception as e:
+                self.log.exception('Failed to store record for url: %r' % self.url, exc_info=e)
+            index_record(self.log, record)
+        
+        self.result_queue.put(self.build_metadata(record))
+    
+    def parse_record(self, root, check_cover=True):
+        """
+        Extract every field of the details page into a plain dict that can be serialized.
+        The record does not depend on the plugin preferences, they are applied by build_metadata.
+        Without check_cover the cover is left to the caller, see cover_candidates.
+        """
         try:
             book_id = self.parse_book_id(self.url)
         except Exception as e:
@@ -134,13 +338,15 @@ class Worker(Thread):  # Get details
             book_id = None
         
         try:
-            (title, series, series_index) = self.parse_title_series(root)
+            with self.timer('parse_title_series'):
+                (title, series, series_index) = self.parse_title_series(root)
         except Exception as e:
             self.log.exception('Error parsing title and series for url: %r' % self.url, exe_info=e)
             title = series = series_index = None
         
         try:
-            authors = self.parse_authors(root)
+            with self.timer('parse_authors'):
+                authors = self.parse_authors_with_roles(root) or []
         except Exception as e:
             self.log.exception('Error parsing authors for url: %r' % self.url, exe_info=e)
             authors = []
@@ -150,55 +356,96 @@ class Worker(Thread):  # Get details
             self.log.error('Kyobobook: %r Title: %r Authors: %r' % (book_id, title, authors))
             return
         
-        mi = Metadata(title, authors)
-        if series:
-            mi.series = series
-            mi.series_index = series_index
-        mi.set_identifier(self.plugin.ID_NAME, book_id)
-        self.book_id = book_id
+        record = {
+            'id': book_id, 'title': title, 'series': series, 'series_index': series_index,
+            'authors': [list(a) for a in authors], 'isbn': None, 'rating': None,
+            'description': '', 'toc': '', 'cover': None, 'categories': [],
+            'publisher': None, 'pubdate': None, 'language': None,
+        }
         
         try:
-            isbn = self.parse_isbn(root)
-            if isbn:
-                self.isbn = mi.isbn = isbn
+            with self.timer('parse_isbn'):
+                record['isbn'] = self.parse_isbn(root) or None
         except Exception as e:
             self.log.exception('Error parsing ISBN for url: %r' % self.url, exe_info=e)
         
         try:
-            mi.rating = self.parse_rating(root)
+            with self.timer('parse_rating'):
+                record['rating'] = self.parse_rating(root)
         except Exception as e:
             self.log.exception('Error parsing ratings for url: %r' % self.url, exe_info=e)
         
         try:
-            mi.comments = self.parse_comments(root)
+            with self.timer('parse_comments'):
+                record['description'] = self.parse_description(root)
+                record['toc'] = self.parse_toc(root)
         except Exception as e:
             self.log.exception('Error parsing comments for url: %r' % self.url, exe_info=e)
         
-        try:
-            self.cover_url = self.parse_cover(root)
-        except Exception as e:
-            self.log.exception('Error parsing cover for url: %r' % self.url, exe_info=e)
-        mi.has_cover = bool(self.cover_url)
+        if check_cover:
+            try:
+                with self.timer('parse_cover'):
+                    record['cover'] = self.parse_cover(root)
+            except Cancelled:
+                # Not stored without its checked cover
+                raise
+            except Exception as e:
+                self.log.exception('Error parsing cover for url: %r' % self.url, exe_info=e)
         
         try:
-            tags = self.parse_tags(root)
-            if tags:
-                mi.tags = tags
+            with self.timer('parse_tags'):
+                record['categories'] = self.parse_categories(root)
         except Exception as e:
             self.log.exception('Error parsing tags for url: %r' % self.url, exe_info=e)
         
         try:
-            mi.publisher, mi.pubdate = self.parse_publisher_and_date(root)
+            with self.timer('parse_publisher_and_date'):
+                publisher, pubdate = self.parse_publisher_and_date(root)
+            record['publisher'] = publisher
+            record['pubdate'] = pubdate.strftime('%Y-%m-%d') if pubdate else None
         except Exception as e:
             self.log.exception('Error parsing publisher and date for url: %r' % self.url, exe_info=e)
         
         try:
-            lang = self._parse_language(root)
-            if lang:
-                mi.language = lang
+            with self.timer('parse_language'):
+                record['language'] = self._parse_language(root)
         except Exception as e:
             self.log.exception('Error parsing language for url: %r' % self.url, exe_info=e)
         
+        return record
+    
+    def build_metadata(self, record):
+        """
+        Build the Metadata for a parsed record, applying the current plugin preferences.
+        """
+        mi = Metadata(record['title'], self.select_authors(record['authors']))
+        if record['series']:
+            mi.series = record['series']
+            mi.series_index = record['series_index']
+        mi.set_identifier(self.plugin.ID_NAME, record['id'])
+        self.book_id = record['id']
+        
+        if record['isbn']:
+            self.isbn = mi.isbn = record['isbn']
+        mi.rating = record['rating']
+        mi.comments = self.build_comments(record['description'], record['toc'])
+        
+        self.cover_url = record['cover']
+        # The unchecked cover of a partial record is checked when it is downloaded
+        mi.has_cover = bool(self.cover_url or record.get('partial') and record.get('cover_candidates'))
+        
+        tags = self.build_tags(record['categories'])
+        if tags:
+            mi.tags = tags
+        
+        mi.publisher = record['publisher']
+        if record['pubdate']:
+            from calibre.utils.date import utc_tz
+            mi.pubdate = datetime.datetime.strptime(record['pubdate'], '%Y-%m-%d').replace(tzinfo=utc_tz)
+        
+        if record['language']:
+            mi.language = record['language']
+        
         mi.source_relevance = self.relevance
         
         if self.book_id:
@@ -207,9 +454,9 @@ class Worker(Thread):  # Get details
             if self.cover_url:
                 self.plugin.cache_identifier_to_cover_url(self.book_id, self.cover_url)
         
-        self.plugin.clean_downloaded_metadata(mi)
-        
-        self.result_queue.put(mi)
+        with self.timer('clean_downloaded_metadata'):
+            self.plugin.clean_downloaded_metadata(mi)
+        return mi
     
     @staticmethod
     def parse_book_id(url):
@@ -276,6 +523,12 @@ class Worker(Thread):  # Get details
         return title_text, series_name, series_index
     
     def parse_authors(self, root):
+        authors = self.parse_authors_with_roles(root)
+        if authors is None:
+            return
+        return self.select_authors(authors)
+    
+    def parse_authors_with_roles(self, root):
         # Build a dict of authors with their contribution if any in values
         authors_elements = root.xpath("//span[@title='%s']/preceding-sibling::node()" % u'출판사')
         
@@ -315,8 +568,10 @@ class Worker(Thread):  # Get details
         # item.reverse()
         item: list[(str, str)] = list(authors_type_map.items())
         item.reverse()
-        authors_type_map = OrderedDict(item)
-        
+        return item
+    
+    @staticmethod
+    def select_authors(authors_with_roles):
         # User either requests all authors, or only the primary authors (latter is the default)
         # If only primary authors, only bring them in if:
         # 1. They have no author type specified
@@ -325,7 +580,7 @@ class Worker(Thread):  # Get details
         get_all_authors = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_ALL_AUTHORS]
         authors = []
         valid_contrib = None
-        for a, contrib in authors_type_map.items():
+        for a, contrib in authors_with_roles:
             if get_all_authors:
                 authors.append(a)
             else:
@@ -352,13 +607,14 @@ class Worker(Thread):  # Get details
     
     @staticmethod
     def parse_comments(root):
+        return Worker.build_comments(Worker.parse_description(root), Worker.parse_toc(root))
+    
+    @staticmethod
+    def parse_description(root):
         description_nodes = root.xpath(
             "//*[preceding-sibling::comment()[. = ' *** s:%s *** '] "
             "and following-sibling::comment()[. = ' *** //e:%s *** ']]" % (u'책소개', u'책소개'))
         
-        default_append_toc = cfg.DEFAULT_STORE_VALUES[cfg.KEY_APPEND_TOC]
-        append_toc = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_APPEND_TOC, default_append_toc)
-        
         comments = ''
         if description_nodes:
             for description_node in description_nodes:
@@ -366,66 +622,85 @@ class Worker(Thread):  # Get details
             while comments.find('  ') >= 0:
                 comments = comments.replace('  ', ' ')
             comments = sanitize_comments_html(comments)
+        return comments
+    
+    @staticmethod
+    def parse_toc(root):
+        toc_node = root.xpath(
+            '//div[@class="box_detail_content"]/h2[@class="title_detail_basic" and contains(text(),"%s")]'
+            '/following-sibling::div' % u"목차")
+        if toc_node:
+            toc = tostring(toc_node[0], method='html', encoding=unicode)
+            return sanitize_comments_html(toc)
+        return ''
+    
+    @staticmethod
+    def build_comments(description, toc):
+        default_append_toc = cfg.DEFAULT_STORE_VALUES[cfg.KEY_APPEND_TOC]
+        append_toc = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_APPEND_TOC, default_append_toc)
         
-        if append_toc:
-            toc_node = root.xpath(
-                '//div[@class="box_detail_content"]/h2[@class="title_detail_basic" and contains(text(),"%s")]'
-                '/following-sibling::div' % u"목차")
-            if toc_node:
-                toc = tostring(toc_node[0], method='html')
-                toc = sanitize_comments_html(toc)
-                comments += '<h3>[목차]</h3><div id="toc">' + toc + "</div>"
+        comments = description or ''
+        if append_toc and toc:
+            comments += '<h3>[목차]</h3><div id="toc">' + toc + "</div>"
         
         if comments:
             comments += "<hr />" + '<div><div style="float:right">[kyobobook]</div></div>'
         return comments
     
     def parse_cover(self, root):
+        return self.check_cover(self.cover_candidates(root))
+    
+    def check_cover(self, candidates):
+        """
+        The first of the cover candidates (see cover_candidates) that kyobobook has an image for.
+        """
+        if self.browser is None:
+            # Reparsing offline, the image can not be checked
+            return candidates[0][0] if candidates else None
+        for img_url, size in candidates:
+            self.deadline.check()
+            try:
+                # Unfortunately Kyobobook sometimes have broken links so we need to do
+                # an additional request to see if the URL actually exists
+                with self.timer('cover_probe') as span, contextlib.closing(
+                        open_url(self.browser, img_url, self.timeout, self.deadline, head=True)) as response:
+                    info = response.info()
+                    span.set(url=img_url, bytes=info.get('Content-Length'))
+            except Cancelled:
+                raise
+            except Exception as e:
+                self.log.warning('Failed to check image(%s) for url: %s (%s)' % (size, img_url, e))
+                continue
+            if self.cover_ok(img_url, size, info):
+                return img_url
+    
+    def cover_candidates(self, root):
+        """
+        The cover image urls of a details page, as (url, size) in the order they are checked.
+        """
         # <meta property="og:image" content="http://image.kyobobook.co.kr/images/book/xlarge/547/x9780132990547.jpg"/>
         # 2016-02-04
         # <meta property="og:image" content="http://image.kyobobook.co.kr/images/book/medium/196/m9788994909196.jpg"/>
         # http://image.kyobobook.co.kr/images/book/large/196/l9788994909196.jpg
         # http://image.kyobobook.co.kr/images/book/xlarge/196/x9788994909196.jpg
-        
+        candidates = []
         imgcol_node = root.xpath('//meta[@property="og:image"]/@content')
-        img_url_checked = None
-        info = ""
-        if imgcol_node:
-            img_url = imgcol_node[0]
-            
-            # http://image.kyobobook.co.kr/newimages/apps/b2b_academy/common/noimage_150_215.gif
-            if "noimage" not in img_url:
-                with contextlib.suppress(Exception):  # pass Exceptions
-                    # Unfortunately Kyobobook sometimes have broken links so we need to do
-                    # an additional request to see if the URL actually exists
-                    # meta 노드가 있어도 파일이 없다고 나오는 경우가 있다.
-                    info = self.browser.open_novisit(img_url, timeout=self.timeout).info()
-                    if int(info.get('Content-Length')) > 1000:
-                        img_url_checked = img_url
-                    else:
-                        self.log.warning('Broken image(Large) for url: %s' % img_url)
-                
-        if not img_url_checked:
-            # imgcol_node = root.xpath('//p[@class="book_img_box"]/img/@src')  # 2016-02-04
-            imgcol_node = root.xpath('//div[@class="cover"]//img/@src')  # 2021-07-06
-            if imgcol_node:
-                img_url = imgcol_node[0]
-                
-                # http://image.kyobobook.co.kr/newimages/apps/b2b_academy/common/noimage_150_215.gif
-                if "noimage" not in img_url:
-                    try:
-                        # Unfortunately Kyobobook sometimes have broken links so we need to do
-                        # an additional request to see if the URL actually exists
-                        info = self.browser.open_novisit(img_url, timeout=self.timeout).info()
-                        if int(info.get('Content-Length')) > 1000:
-                            img_url_checked = img_url
-                        else:
-                            self.log.warning('Broken image(small) for url: %s' % img_url)
-                    except Exception as e:
-                        self.log.exception("Error at parse_cover (img tag)", exe_info=e)
-                        pass
-        if img_url_checked:
-            return img_url_checked
+        # http://image.kyobobook.co.kr/newimages/apps/b2b_academy/common/noimage_150_215.gif
+        if imgcol_node and "noimage" not in imgcol_node[0]:
+            candidates.append((imgcol_node[0], 'Large'))
+        # imgcol_node = root.xpath('//p[@class="book_img_box"]/img/@src')  # 2016-02-04
+        imgcol_node = root.xpath('//div[@class="cover"]//img/@src')  # 2021-07-06
+        if imgcol_node and "noimage" not in imgcol_node[0]:
+            candidates.append((imgcol_node[0], 'small'))
+        return candidates
+    
+    def cover_ok(self, img_url, size, info):
+        # meta 노드가 있어도 파일이 없다고 나오는 경우가 있다.
+        length = info.get('Content-Length')
+        if length and int(length) > 1000:
+            return True
+        self.log.warning('Broken image(%s) for url: %s' % (size, img_url))
+        return False
     
     @staticmethod
     def parse_isbn(root):
@@ -464,25 +739,33 @@ class Worker(Thread):  # Get details
     
     @staticmethod
     def parse_tags(root):
+        return Worker.build_tags(Worker.parse_categories(root))
+    
+    @staticmethod
+    def build_tags(categories):
+        category_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_CATEGORY]
+        if category_lookup:
+            return list(categories)
+        return []
+    
+    @staticmethod
+    def parse_categories(root):
         # Kyobobook have both"tags" and Genres(category)
         # We will use those as tags (with a bit of massaging)
         
         calibre_tags = list()
         
-        category_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_CATEGORY]
-        
-        if category_lookup:
-            genres_node = root.xpath('//div[@class="location_zone pathGroup"]/p[@class="location"]')
-            # self.log.info("Parsing categories")
-            if genres_node:
-                # self.log.info("Found genres_node")
-                for genre in genres_node:
-                    genre = re.sub(r"\s{2,}", " ", genre.text_content().strip())
-                    genre = re.sub(r"^\s*(국내도서|외국도서)\s*>\s*", "", genre)
-                    
-                    # tag에 ▣를 붙이고
-                    # 계단 형식의 태그를 위해 > 대신 . 으로 구분
-                    calibre_tags.append("▣" + ".".join(re.split(r"\s*>\s*", genre)))
+        genres_node = root.xpath('//div[@class="location_zone pathGroup"]/p[@class="location"]')
+        # self.log.info("Parsing categories")
+        if genres_node:
+            # self.log.info("Found genres_node")
+            for genre in genres_node:
+                genre = re.sub(r"\s{2,}", " ", genre.text_content().strip())
+                genre = re.sub(r"^\s*(국내도서|외국도서)\s*>\s*", "", genre)
+                
+                # tag에 ▣를 붙이고
+                # 계단 형식의 태그를 위해 > 대신 . 으로 구분
+                calibre_tags.append("▣" + ".".join(re.split(r"\s*>\s*", genre)))
         
         # tags_list = root.xpath('//div[@id="div_itemtaglist"]//a[contains(@href,"tagname=")]/text()')
         # #self.log.info("Parsing tags")